@@ -0,0 +1,177 @@
+# benchmarks/common.py
+# Shared helpers for the benchmark suite: data loading with synthetic scale-up, timing and result files.
+# Run benchmarks from the repository root (python -m benchmarks.run_benchmarks) so data/ and evaluator/ resolve.
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+import numpy as np
+from typing import List, Tuple
+from data import *
+
+GEO_TRAIN_PATH = 'data/geo_train.tsv'
+GEO_DEV_PATH = 'data/geo_dev.tsv'
+GEO_TEST_PATH = 'data/geo_test.tsv'
+# The full 880-example GeoQuery corpus, split 600/280
+GEO880_PATHS = ['data/geo880_train600.tsv', 'data/geo880_test280.tsv']
+
+
+def perturb_question(x: str, rng: random.Random) -> str:
+    """
+    Makes a slightly different copy of a question by dropping, duplicating or swapping one word. The final token
+    (usually "?") is left alone so the copies still look like questions.
+    :param x: question to perturb
+    :param rng: RNG to draw the edit from
+    :return: the perturbed question
+    """
+    toks = tokenize(x)
+    if len(toks) < 3:
+        return x
+    i = rng.randrange(len(toks) - 2)
+    op = rng.randrange(3)
+    if op == 0:
+        del toks[i]
+    elif op == 1:
+        toks.insert(i, toks[i])
+    else:
+        toks[i], toks[i + 1] = toks[i + 1], toks[i]
+    return ' '.join(toks)
+
+
+def scale_dataset(data: List[Tuple[str, str]], factor: int, seed=0) -> List[Tuple[str, str]]:
+    """
+    Synthetic scale-up of a dataset: the original pairs plus factor - 1 perturbed copies of each
+    :param data: list of (question, logical form) pairs
+    :param factor: size multiplier; 1 returns data unchanged
+    :param seed: RNG seed for the perturbations
+    :return: list of len(data) * factor pairs
+    """
+    rng = random.Random(seed)
+    scaled = list(data)
+    for _ in range(factor - 1):
+        scaled.extend((perturb_question(x, rng), y) for (x, y) in data)
+    return scaled
+
+
+def load_geo_splits(train_scale=1, decoder_len_limit=65, seed=0):
+    """
+    Loads and indexes the GeoQuery train/dev/test splits, optionally scaling up the training set
+    :return: (train, dev, test, input_indexer, output_indexer) as returned by index_datasets
+    """
+    train, dev, test = load_datasets(GEO_TRAIN_PATH, GEO_DEV_PATH, GEO_TEST_PATH, domain="geo")
+    return index_datasets(scale_dataset(train, train_scale, seed), dev, test, decoder_len_limit)
+
+
+def load_geo880_lfs() -> List[str]:
+    """
+    :return: the preprocessed logical forms of all 880 GeoQuery examples
+    """
+    return [y for path in GEO880_PATHS for (x, y) in load_dataset(path, domain="geo")]
+
+
+def model_args(argv=None):
+    """
+    :param argv: model flags to override, e.g. ['--epochs', '1']
+    :return: an args bundle with the defaults of add_models_args, as train_model_encdec expects it
+    """
+    from model_args import add_models_args
+    parser = argparse.ArgumentParser()
+    add_models_args(parser)
+    args = parser.parse_args(argv if argv is not None else [])
+    args.print_dataset = False
+    return args
+
+
+def time_calls(fn, repeat: int) -> List[float]:
+    """
+    :param fn: zero-argument callable to time
+    :param repeat: number of calls
+    :return: wall time of each call in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize_times(times: List[float]):
+    """
+    :return: mean/p50/p90/min of the given times, in milliseconds
+    """
+    times_ms = 1000.0 * np.asarray(times)
+    return {'mean_ms': float(times_ms.mean()), 'p50_ms': float(np.percentile(times_ms, 50)),
+            'p90_ms': float(np.percentile(times_ms, 90)), 'min_ms': float(times_ms.min()), 'n': len(times)}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return "unknown"
+
+
+def write_results(path: str, results):
+    """
+    Writes benchmark results plus enough metadata (commit, versions, threads) to compare runs across commits
+    :param path: JSON file to write
+    :param results: benchmark name -> dict of measurements
+    """
+    meta = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': np.__version__}
+    try:
+        import torch
+        meta['torch'] = torch.__version__
+        meta['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+    with open(path, "w") as out:
+        json.dump({'meta': meta, 'results': results}, out, indent=2, sort_keys=True)
+    print("Wrote benchmark results to %s" % path)
+
+
+def check_fused_inference(model, exs: List[Example], atol=1e-4) -> float:
+    """
+    Checks FusedGateTables against the unfused modules: encoder outputs and states on each example, and decoder
+    logits and states along its gold output. Raises an AssertionError on a mismatch.
+    :param model: Seq2SeqSemanticParser with a unidirectional encoder
+    :param exs: examples to compare on
+    :param atol: largest absolute difference allowed
+    :return: the largest absolute difference seen
+    """
+    import torch
+    from models import FusedGateTables
+    model.eval()
+    tables = FusedGateTables(model)
+    max_diff = 0.0
+
+    def compare(fused, unfused, what, ex):
+        nonlocal max_diff
+        diff = (fused - unfused).abs().max().item()
+        assert diff <= atol, "%s differs by %g on %s" % (what, diff, ex.x)
+        max_diff = max(max_diff, diff)
+
+    with torch.no_grad():
+        for ex in exs:
+            enc_output, h_n, c_n = tables.encode(ex.x_indexed)
+            embedded = model.input_emb(torch.LongTensor(ex.x_indexed).unsqueeze(0))
+            ref_output, _, (ref_h, ref_c) = model.encoder(embedded, torch.LongTensor([len(ex.x_indexed)]))
+            ref_output, ref_h, ref_c = ref_output.permute([1, 0, 2]), ref_h.unsqueeze(0), ref_c.unsqueeze(0)
+            for fused, unfused, what in [(enc_output, ref_output, "encoder output"), (h_n, ref_h, "encoder h"),
+                                         (c_n, ref_c, "encoder c")]:
+                compare(fused, unfused, what, ex)
+            fused_h, fused_c = h_n, c_n
+            # Gold outputs of held-out examples can contain tokens missing from the output indexer (index -1)
+            known = [y for y in ex.y_indexed[:-1] if y >= 0]
+            for token in [model.output_indexer.index_of(SOS_SYMBOL)] + known:
+                logits, fused_h, fused_c = tables.decoder_step(token, fused_h, fused_c, ref_output)
+                ref_logits, _, (ref_h, ref_c) = model.decoder(model.output_emb(torch.LongTensor([[token]])), ref_h,
+                                                              ref_c, None, ref_output)
+                for fused, unfused, what in [(logits, ref_logits, "decoder logits"), (fused_h, ref_h, "decoder h"),
+                                             (fused_c, ref_c, "decoder c")]:
+                    compare(fused, unfused, what, ex)
+    return max_diff
@@ -0,0 +1,389 @@
+# benchmarks/run_benchmarks.py
+# Training and inference throughput benchmarks on GeoQuery. From the repository root:
+#   python -m benchmarks.run_benchmarks --out bench_results.json
+#   python -m benchmarks.run_benchmarks --only nearest_neighbor lf_format --scales 1 2 4 8
+
+import argparse
+import random
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+from benchmarks.common import *
+from data import *
+from utils import *
+from lf_evaluator import *
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='run_benchmarks.py')
+    parser.add_argument('--out', type=str, default='bench_results.json', help='path to write the JSON results to')
+    parser.add_argument('--only', type=str, nargs='*', default=None, help='names of the benchmarks to run (default: all)')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 4], help='synthetic train-set multipliers')
+    parser.add_argument('--train_scales', type=int, nargs='+', default=[1], help='train-set multipliers for the epoch-time benchmark')
+    parser.add_argument('--model_path', type=str, default=None, help='trained model to benchmark decoding with (default: the model from train_epoch, or an untrained one)')
+    parser.add_argument('--latency_examples', type=int, default=50, help='number of dev examples to time batch-1 decoding on')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions for the cheap benchmarks')
+    parser.add_argument('--backend_epochs', type=int, default=5, help='epochs to train each backend for in the backends comparison')
+    parser.add_argument('--backend_batch_size', type=int, default=2, help='batch size for the backends comparison')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+class BenchContext(object):
+    """
+    State shared between benchmarks: the indexed data and the model, which is trained once by train_epoch and reused
+    by the decoding benchmarks
+    """
+    def __init__(self, args):
+        self.args = args
+        self.train, self.dev, self.test, self.input_indexer, self.output_indexer = load_geo_splits()
+        self.model = None
+
+    def get_model(self):
+        if self.model is None:
+            import torch
+            from models import Seq2SeqSemanticParser
+            if self.args.model_path is not None:
+                self.model = torch.load(self.args.model_path, weights_only=False)
+            else:
+                # An untrained model rarely emits EOS, so it measures the worst case of 100 decoder steps per example
+                torch.manual_seed(self.args.seed)
+                margs = model_args()
+                self.model = Seq2SeqSemanticParser(self.input_indexer, self.output_indexer, margs.emb_dim, margs.hidden_size)
+        return self.model
+
+
+def bench_train_epoch(ctx):
+    """
+    Wall time of one epoch of train_model_encdec, on the real train split and on synthetic scale-ups of it
+    """
+    from models import train_model_encdec
+    results = {}
+    for scale in ctx.args.train_scales:
+        train, dev, test, input_indexer, output_indexer = load_geo_splits(train_scale=scale, seed=ctx.args.seed)
+        start = time.perf_counter()
+        model = train_model_encdec(train, dev, input_indexer, output_indexer, model_args(['--epochs', '1']))
+        secs = time.perf_counter() - start
+        results['x%d' % scale] = {'epoch_sec': secs, 'examples': len(train), 'examples_per_sec': len(train) / secs,
+                                  'tokens_per_sec': sum(len(ex.y_indexed) for ex in train) / secs}
+        if scale == 1 and ctx.args.model_path is None:
+            ctx.model = model
+    return results
+
+
+def bench_seq2seq_decode(ctx):
+    """
+    Seq2SeqSemanticParser.decode latency at batch size 1 and throughput when decoding whole (scaled-up) dev sets
+    """
+    model = ctx.get_model()
+    exs = ctx.dev[:ctx.args.latency_examples]
+    latencies = []
+    tokens = 0
+    for ex in exs:
+        start = time.perf_counter()
+        derivs = model.decode([ex])
+        latencies.append(time.perf_counter() - start)
+        tokens += len(derivs[0][0].y_toks) + 1
+    results = {'batch1': summarize_times(latencies), 'batch1_tokens_per_sec': tokens / sum(latencies)}
+    for scale in ctx.args.scales:
+        exs = ctx.dev * scale
+        start = time.perf_counter()
+        model.decode(exs)
+        secs = time.perf_counter() - start
+        results['batch_%d' % len(exs)] = {'sec': secs, 'examples_per_sec': len(exs) / secs}
+    return results
+
+
+def bench_fused_decode(ctx):
+    """
+    Batch-1 decode latency of the LSTM model with and without FusedGateTables (--fused_inference), after checking
+    that the fused steps match the unfused modules
+    """
+    model = ctx.get_model()
+    exs = ctx.dev[:ctx.args.latency_examples]
+    results = {'max_abs_diff': check_fused_inference(model, exs)}
+    for fused in [False, True]:
+        model.fused_inference = fused
+        latencies = []
+        tokens = 0
+        for ex in exs:
+            start = time.perf_counter()
+            derivs = model.decode([ex])
+            latencies.append(time.perf_counter() - start)
+            tokens += len(derivs[0][0].y_toks) + 1
+        results['fused' if fused else 'unfused'] = dict(summarize_times(latencies),
+                                                         us_per_token=1e6 * sum(latencies) / tokens)
+    model.fused_inference = False
+    return results
+
+
+def bench_shortlist(ctx):
+    """
+    Per-decoder-step cost of the LSTM model scoring the full output vocabulary vs an OutputShortlist, as the output
+    vocabulary grows. The real vocabulary is padded with synthetic entity constants, which no question retrieves, so
+    the shortlist stays the size it has on GeoQuery. Untrained models of the default sizes, with and without
+    FusedGateTables.
+    """
+    import copy
+    import torch
+    from models import Seq2SeqSemanticParser, OutputShortlist
+    exs = ctx.dev[:ctx.args.latency_examples]
+    margs = model_args()
+    results = {}
+    for vocab_size in [len(ctx.output_indexer), 1000, 5000, 20000]:
+        output_indexer = copy.deepcopy(ctx.output_indexer)
+        while len(output_indexer) < vocab_size:
+            output_indexer.add_and_get_index("const%i" % len(output_indexer))
+        shortlist = OutputShortlist(ctx.input_indexer, output_indexer, ctx.train)
+        synthetic = set(range(len(ctx.output_indexer), vocab_size))
+        shortlist.structural -= synthetic
+        shortlist.constants |= synthetic
+        torch.manual_seed(ctx.args.seed)
+        model = Seq2SeqSemanticParser(ctx.input_indexer, output_indexer, margs.emb_dim, margs.hidden_size)
+        row = {'avg_shortlist_size': float(np.mean([len(shortlist.candidates(ex)) for ex in exs]))}
+        for fused in [False, True]:
+            model.fused_inference = fused
+            for name, sl in [('full', None), ('shortlist', shortlist)]:
+                model.output_shortlist = sl
+                model.decode_stats.clear()
+                start = time.perf_counter()
+                model.decode(exs)
+                secs = time.perf_counter() - start
+                row['%s%s_us_per_step' % ('fused_' if fused else '', name)] = 1e6 * secs / model.decode_stats['decoder_calls']
+        results['vocab_%d' % vocab_size] = row
+    return results
+
+
+def bench_sparse_embeddings(ctx):
+    """
+    Training step time of the LSTM model with dense Adam over everything vs sparse embedding gradients with SparseAdam
+    (--sparse_embeddings), as the input vocabulary grows. The real vocabulary is padded with unused synthetic words;
+    steps run on the same real batches with chunked teacher forcing (memory_bounded_loss).
+    """
+    import copy
+    import torch
+    from models import Seq2SeqSemanticParser, make_optimizer, make_training_dataset
+    dataset = make_training_dataset(ctx.train, ctx.input_indexer, ctx.output_indexer)
+    margs = model_args()
+    num_steps = 20
+    results = {}
+    for vocab_size in [len(ctx.input_indexer), 10000, 50000, 200000]:
+        input_indexer = copy.deepcopy(ctx.input_indexer)
+        while len(input_indexer) < vocab_size:
+            input_indexer.add_and_get_index("word%i" % len(input_indexer))
+        row = {}
+        for sparse in [False, True]:
+            torch.manual_seed(ctx.args.seed)
+            model = Seq2SeqSemanticParser(input_indexer, ctx.output_indexer, margs.emb_dim, margs.hidden_size)
+            optimizer = make_optimizer(model, margs.lr, sparse)
+            step_secs = 0.0
+            optimizer_secs = 0.0
+            for i in range(num_steps + 1):
+                inp_lens, x, out_lens, y = dataset[2 * i:2 * i + 2]
+                start = time.perf_counter()
+                optimizer.zero_grad()
+                model.memory_bounded_loss(x, inp_lens, y, out_lens, 16).backward()
+                optimizer_start = time.perf_counter()
+                optimizer.step()
+                end = time.perf_counter()
+                # The first step allocates the optimizer state
+                if i > 0:
+                    step_secs += end - start
+                    optimizer_secs += end - optimizer_start
+            name = 'sparse' if sparse else 'dense'
+            row[name + '_step_ms'] = 1000.0 * step_secs / num_steps
+            row[name + '_optimizer_ms'] = 1000.0 * optimizer_secs / num_steps
+        results['input_vocab_%d' % vocab_size] = row
+    return results
+
+
+def bench_serving(ctx):
+    """
+    DecodeServer throughput on the dev set and total memory (PSS, shared pages split between processes) for growing
+    numbers of forked workers over one frozen shared-memory model. Needs a saved model (--model_path).
+    """
+    import os
+    from serving import load_frozen_model, DecodeServer
+    if ctx.args.model_path is None:
+        return 'skipped: needs --model_path'
+    model = load_frozen_model(ctx.args.model_path)
+    results = {}
+    for num_workers in sorted(set([1, 2, 4, os.cpu_count()])):
+        with DecodeServer(model, num_workers) as server:
+            # Warm up every worker before timing
+            server.decode(ctx.dev[:8 * num_workers])
+            start = time.perf_counter()
+            server.decode(ctx.dev)
+            secs = time.perf_counter() - start
+            results['workers_%d' % num_workers] = dict(server.memory_report() or {}, examples_per_sec=len(ctx.dev) / secs)
+    return results
+
+
+def bench_nearest_neighbor(ctx):
+    """
+    NearestNeighborSemanticParser.decode time on the dev set as the training set grows
+    """
+    from nearest_neighbor import NearestNeighborSemanticParser
+    results = {}
+    for scale in ctx.args.scales:
+        train, dev, test, input_indexer, output_indexer = load_geo_splits(train_scale=scale, seed=ctx.args.seed)
+        parser = NearestNeighborSemanticParser(train)
+        times = time_calls(lambda: parser.decode(dev), max(1, ctx.args.repeat // scale))
+        results['train_%d' % len(train)] = dict(summarize_times(times), examples_per_sec=len(dev) / min(times))
+    return results
+
+
+def bench_lf_format(ctx):
+    """
+    GeoqueryDomain.format_lf/format_lfs and geoquery_preprocess_lf_batch over all 880 GeoQuery logical forms, and
+    compare_answers (which also runs the Java evaluator) on the dev set if java is installed
+    """
+    domain = GeoqueryDomain()
+    lfs = load_geo880_lfs()
+    results = {}
+    for scale in ctx.args.scales:
+        scaled = lfs * scale
+        times = time_calls(lambda: [domain.format_lf(lf) for lf in scaled], ctx.args.repeat)
+        results['format_lf_%d' % len(scaled)] = dict(summarize_times(times), lfs_per_sec=len(scaled) / min(times))
+        scaled_toks = [tokenize(lf) for lf in scaled]
+        times = time_calls(lambda: domain.format_lfs(scaled_toks), ctx.args.repeat)
+        results['format_lfs_%d' % len(scaled)] = dict(summarize_times(times), lfs_per_sec=len(scaled) / min(times))
+    raw_lf_toks = [tokenize(y) for path in GEO880_PATHS for (x, y) in load_dataset(path, domain=None)]
+    times = time_calls(lambda: geoquery_preprocess_lf_batch(raw_lf_toks), ctx.args.repeat)
+    results['preprocess_lf_batch_%d' % len(raw_lf_toks)] = summarize_times(times)
+    if shutil.which('java') is not None:
+        derivs = [[Derivation(ex, 1.0, ex.y_tok)] for ex in ctx.dev]
+        times = time_calls(lambda: domain.compare_answers([ex.y for ex in ctx.dev], derivs, quiet=True), 1)
+        results['compare_answers_%d' % len(ctx.dev)] = summarize_times(times)
+    else:
+        results['compare_answers'] = 'skipped: java not found'
+    return results
+
+
+def bench_beam(ctx):
+    """
+    Beam.add throughput for a range of beam sizes with random scores
+    """
+    rng = random.Random(ctx.args.seed)
+    scores = [rng.random() for _ in range(20000)]
+    results = {}
+    for size in [1, 10, 100]:
+        def fill():
+            beam = Beam(size)
+            for i, score in enumerate(scores):
+                beam.add(i, score)
+        times = time_calls(fill, ctx.args.repeat)
+        results['size_%d' % size] = dict(summarize_times(times), adds_per_sec=len(scores) / min(times))
+    return results
+
+
+def bench_backends(ctx):
+    """
+    LSTM vs transformer backend: train both with the same epochs and batch size, then compare training time, decoding
+    throughput on the dev set and dev accuracy (denotation accuracy only if java is installed)
+    """
+    import torch
+    from models import train_model_encdec
+    use_java = shutil.which('java') is not None
+    results = {}
+    for model_type in ['lstm', 'transformer']:
+        torch.manual_seed(ctx.args.seed)
+        margs = model_args(['--model_type', model_type, '--epochs', str(ctx.args.backend_epochs),
+                            '--batch_size', str(ctx.args.backend_batch_size)])
+        start = time.perf_counter()
+        model = train_model_encdec(ctx.train, ctx.dev, ctx.input_indexer, ctx.output_indexer, margs)
+        train_secs = time.perf_counter() - start
+        start = time.perf_counter()
+        model.decode(ctx.dev)
+        decode_secs = time.perf_counter() - start
+        exact, token_acc, denotation = evaluate(ctx.dev, model, print_output=False, use_java=use_java)
+        results[model_type] = {'epoch_sec': train_secs / ctx.args.backend_epochs,
+                               'train_examples_per_sec': ctx.args.backend_epochs * len(ctx.train) / train_secs,
+                               'decode_examples_per_sec': len(ctx.dev) / decode_secs,
+                               'dev_exact_match': exact, 'dev_token_accuracy': token_acc,
+                               'dev_denotation_accuracy': denotation if use_java else None}
+    return results
+
+
+# Programs for bench_startup: each imports what its mode needs, makes one prediction and reports whether torch got
+# imported. nearest_neighbor_with_torch imports the models the way main.py used to, for comparison.
+_LOAD_GEO = """
+from benchmarks.common import *
+train, dev, test, input_indexer, output_indexer = load_geo_splits()
+"""
+STARTUP_PROGRAMS = [
+    ('lf_evaluator', """
+from lf_evaluator import *
+from benchmarks.common import *
+GeoqueryDomain().format_lf(load_geo880_lfs()[0])
+"""),
+    ('nearest_neighbor', """
+from lf_evaluator import *
+from nearest_neighbor import *
+""" + _LOAD_GEO + """
+NearestNeighborSemanticParser(train).decode(dev[:1])
+"""),
+    ('nearest_neighbor_with_torch', """
+from lf_evaluator import *
+from models import *
+""" + _LOAD_GEO + """
+NearestNeighborSemanticParser(train).decode(dev[:1])
+"""),
+    ('seq2seq', """
+import torch
+from models import *
+""" + _LOAD_GEO + """
+torch.load(sys.argv[1], weights_only=False).decode(dev[:1])
+"""),
+]
+
+
+def bench_startup(ctx):
+    """
+    Import-to-first-prediction time of each entry mode: wall time of a fresh interpreter that imports the mode's
+    modules, loads what it needs and makes one prediction. The seq2seq mode needs --model_path.
+    """
+    results = {}
+    for name, program in STARTUP_PROGRAMS:
+        if name == 'seq2seq' and ctx.args.model_path is None:
+            results[name] = 'skipped: needs --model_path'
+            continue
+        program = "import sys\n" + program + "\nprint('torch' in sys.modules)\n"
+        argv = [sys.executable, '-c', program] + ([ctx.args.model_path] if ctx.args.model_path is not None else [])
+        times = []
+        for _ in range(ctx.args.repeat):
+            start = time.perf_counter()
+            out = subprocess.check_output(argv, stderr=subprocess.DEVNULL).decode("utf-8")
+            times.append(time.perf_counter() - start)
+        results[name] = dict(summarize_times(times), imports_torch=out.strip().split('\n')[-1] == 'True')
+    return results
+
+
+BENCHMARKS = [('train_epoch', bench_train_epoch),
+              ('seq2seq_decode', bench_seq2seq_decode),
+              ('fused_decode', bench_fused_decode),
+              ('shortlist', bench_shortlist),
+              ('sparse_embeddings', bench_sparse_embeddings),
+              ('serving', bench_serving),
+              ('nearest_neighbor', bench_nearest_neighbor),
+              ('lf_format', bench_lf_format),
+              ('beam', bench_beam),
+              ('backends', bench_backends),
+              ('startup', bench_startup)]
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    ctx = BenchContext(args)
+    results = {}
+    for name, bench in BENCHMARKS:
+        if args.only is not None and name not in args.only:
+            continue
+        print("=======%s=======" % name)
+        results[name] = bench(ctx)
+        print(results[name])
+    write_results(args.out, results)
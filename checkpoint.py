@@ -0,0 +1,95 @@
+# checkpoint.py
+
+import os
+import re
+import random
+import tempfile
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint_e(\d+)_s(\d+)\.pt$")
+
+
+def checkpoint_name(epoch: int, step: int) -> str:
+    """
+    :param epoch: epoch the run is in when the checkpoint is written
+    :param step: number of batches of that epoch already consumed
+    :return: file name of the checkpoint; names sort in training order
+    """
+    return "checkpoint_e%04d_s%07d.pt" % (epoch, step)
+
+
+def capture_rng_state():
+    """
+    :return: the Python, NumPy and torch RNG states, enough to replay the exact same random stream on resume
+    """
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    """
+    Inverse of capture_rng_state
+    :param state: dict returned by capture_rng_state
+    """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def list_checkpoints(checkpoint_dir: str):
+    """
+    :param checkpoint_dir: directory checkpoints are written to
+    :return: paths of all checkpoints in the directory, oldest first
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return []
+    names = sorted(name for name in os.listdir(checkpoint_dir) if CHECKPOINT_PATTERN.match(name))
+    return [os.path.join(checkpoint_dir, name) for name in names]
+
+
+def save_checkpoint(checkpoint_dir: str, state, epoch: int, step: int, keep=3) -> str:
+    """
+    Writes state atomically (temp file in the same directory, fsync, then rename) so that a job killed mid-write never
+    leaves a truncated checkpoint behind, then deletes all but the newest keep checkpoints.
+    :param checkpoint_dir: directory to write to; created if missing
+    :param state: picklable dict to save
+    :param epoch: epoch the run is in
+    :param step: number of batches of that epoch already consumed
+    :param keep: number of checkpoints to retain; <= 0 keeps everything
+    :return: path of the written checkpoint
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, checkpoint_name(epoch, step))
+    fd, tmp_path = tempfile.mkstemp(dir=checkpoint_dir, prefix=".tmp_checkpoint_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if keep > 0:
+        for old_path in list_checkpoints(checkpoint_dir)[:-keep]:
+            os.remove(old_path)
+    return path
+
+
+def load_latest_checkpoint(checkpoint_dir: str):
+    """
+    :param checkpoint_dir: directory checkpoints are written to
+    :return: the newest checkpoint dict in the directory, or None if there isn't one
+    """
+    paths = list_checkpoints(checkpoint_dir)
+    if len(paths) == 0:
+        return None
+    print("Resuming from checkpoint %s" % paths[-1])
+    # Checkpoints hold RNG states and Indexers, so they can't be loaded in weights_only mode
+    return torch.load(paths[-1], weights_only=False)
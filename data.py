@@ -1,7 +1,10 @@
 from utils import *
 from typing import List, Tuple
 import random
+import operator
+import numpy as np
 from collections import Counter
+from itertools import chain
 
 
 class Example(object):
@@ -14,14 +17,17 @@ class Example(object):
         y: the raw logical form as a string
         y_tok: tokenized logical form, a list of strings
         y_indexed: indexed logical form, a list of ints
+        entities: placeholder -> entity name tokens if the example was anonymized (see entities.py), else None. Only
+        x_indexed and y_indexed hold placeholders; x_tok and y_tok stay as in the data.
     """
-    def __init__(self, x: str, x_tok: List[str], x_indexed: List[int], y, y_tok, y_indexed):
+    def __init__(self, x: str, x_tok: List[str], x_indexed: List[int], y, y_tok, y_indexed, entities=None):
         self.x = x
         self.x_tok = x_tok
         self.x_indexed = x_indexed
         self.y = y
         self.y_tok = y_tok
         self.y_indexed = y_indexed
+        self.entities = entities
 
     def __repr__(self):
         return " ".join(self.x_tok) + " => " + " ".join(self.y_tok) + "\n   indexed as: " + repr(self.x_indexed) + " => " + repr(self.y_indexed)
@@ -104,25 +110,58 @@ def index(x_tok: List[str], indexer: Indexer) -> List[int]:
     return [indexer.index_of(xi) if indexer.index_of(xi) >= 0 else indexer.index_of(UNK_SYMBOL) for xi in x_tok]
 
 
-def index_data(data, input_indexer: Indexer, output_indexer: Indexer, example_len_limit):
+def index_data(data, input_indexer: Indexer, output_indexer: Indexer, example_len_limit, anonymizer=None):
     """
     Indexes the given data
     :param data:
     :param input_indexer:
     :param output_indexer:
     :param example_len_limit:
+    :param anonymizer: EntityAnonymizer (see entities.py) replacing entities by placeholders in the indexed sequences
     :return:
     """
     data_indexed = []
     for (x, y) in data:
         x_tok = tokenize(x)
-        y_tok = tokenize(y)[0:example_len_limit]
-        data_indexed.append(Example(x, x_tok, index(x_tok, input_indexer), y, y_tok,
-                                          index(y_tok, output_indexer) + [output_indexer.index_of(EOS_SYMBOL)]))
+        y_tok = tokenize(y)
+        if anonymizer is not None:
+            model_x_tok, model_y_tok, entities = anonymizer.anonymize(x_tok, y_tok)
+        else:
+            model_x_tok, model_y_tok, entities = x_tok, y_tok, None
+        data_indexed.append(Example(x, x_tok, index(model_x_tok, input_indexer), y, y_tok[0:example_len_limit],
+                                    index(model_y_tok[0:example_len_limit], output_indexer) + [output_indexer.index_of(EOS_SYMBOL)],
+                                    entities))
     return data_indexed
 
 
-def index_datasets(train_data, dev_data, test_data, example_len_limit, unk_threshold=0.0) -> (List[Example], List[Example], List[Example], Indexer, Indexer):
+def extend_indexers(train_data, input_indexer: Indexer, output_indexer: Indexer, unk_threshold=0.0, anonymizer=None):
+    """
+    Adds the input words occurring more than unk_threshold times in train_data and all its output tokens to the
+    indexers, after the symbols they already have, so indices that are already assigned never change
+    :param train_data: list of (question, logical form) pairs
+    :param unk_threshold: see index_datasets
+    :param anonymizer: see index_data; the indexers then hold placeholders instead of entity names
+    """
+    tokenized = [(tokenize(x), tokenize(y)) for (x, y) in train_data]
+    if anonymizer is not None:
+        tokenized = [anonymizer.anonymize(x_tok, y_tok)[:2] for (x_tok, y_tok) in tokenized]
+    input_word_counts = Counter()
+    # Count words and build the indexers
+    for (x_tok, y_tok) in tokenized:
+        for word in x_tok:
+            input_word_counts[word] += 1.0
+    # Index all input words above the UNK threshold
+    for word in input_word_counts.keys():
+        if input_word_counts[word] > unk_threshold + 0.5:
+            input_indexer.add_and_get_index(word)
+    # Index all output tokens in train
+    for (x_tok, y_tok) in tokenized:
+        for tok in y_tok:
+            output_indexer.add_and_get_index(tok)
+
+
+def index_datasets(train_data, dev_data, test_data, example_len_limit, unk_threshold=0.0, input_indexer: Indexer = None,
+                   output_indexer: Indexer = None, anonymizer=None) -> (List[Example], List[Example], List[Example], Indexer, Indexer):
     """
     Indexes train and test datasets where all words occurring less than or equal to unk_threshold times are
     replaced by UNK tokens.
@@ -132,6 +171,9 @@ def index_datasets(train_data, dev_data, test_data, example_len_limit, unk_thres
     :param example_len_limit:
     :param unk_threshold: threshold below which words are replaced with unks. If 0.0, the model doesn't see any
     UNKs at train time
+    :param input_indexer/output_indexer: existing indexers (e.g. of a model being fine-tuned) to extend with the new
+    symbols of train_data, in place, instead of building new ones
+    :param anonymizer: EntityAnonymizer (see entities.py) to replace entities with placeholders in the indexed data
     :return:
 
     example:
@@ -139,77 +181,123 @@ def index_datasets(train_data, dev_data, test_data, example_len_limit, unk_thres
     indexed as: [2, 3, 4, 5, 6, 7, 8] => [3, 4, 5, 6, 4, 7, 4, 8, 9, 6, 10, 4, 8, 6, 5, 9, 6, 11, 4, 8, 6, 12, 4, 13, 9, 9, 9, 9, 2]
 
     """
-    input_word_counts = Counter()
-    # Count words and build the indexers
-    for (x, y) in train_data:
-        for word in tokenize(x):
-            input_word_counts[word] += 1.0
-    input_indexer = Indexer()
-    output_indexer = Indexer()
-    # Reserve 0 for the pad symbol for convenience
-    input_indexer.add_and_get_index(PAD_SYMBOL)
-    input_indexer.add_and_get_index(UNK_SYMBOL)
-    output_indexer.add_and_get_index(PAD_SYMBOL)
-    output_indexer.add_and_get_index(SOS_SYMBOL)
-    output_indexer.add_and_get_index(EOS_SYMBOL)
-    # Index all input words above the UNK threshold
-    for word in input_word_counts.keys():
-        if input_word_counts[word] > unk_threshold + 0.5:
-            input_indexer.add_and_get_index(word)
-    # Index all output tokens in train
-    for (x, y) in train_data:
-        for y_tok in tokenize(y):
-            output_indexer.add_and_get_index(y_tok)
+    if input_indexer is None or output_indexer is None:
+        input_indexer = Indexer()
+        output_indexer = Indexer()
+        # Reserve 0 for the pad symbol for convenience
+        input_indexer.add_and_get_index(PAD_SYMBOL)
+        input_indexer.add_and_get_index(UNK_SYMBOL)
+        output_indexer.add_and_get_index(PAD_SYMBOL)
+        output_indexer.add_and_get_index(SOS_SYMBOL)
+        output_indexer.add_and_get_index(EOS_SYMBOL)
+    extend_indexers(train_data, input_indexer, output_indexer, unk_threshold, anonymizer)
     # Index things
-    train_data_indexed = index_data(train_data, input_indexer, output_indexer, example_len_limit)
-    dev_data_indexed = index_data(dev_data, input_indexer, output_indexer, example_len_limit)
-    test_data_indexed = index_data(test_data, input_indexer, output_indexer, example_len_limit)
+    train_data_indexed = index_data(train_data, input_indexer, output_indexer, example_len_limit, anonymizer)
+    dev_data_indexed = index_data(dev_data, input_indexer, output_indexer, example_len_limit, anonymizer)
+    test_data_indexed = index_data(test_data, input_indexer, output_indexer, example_len_limit, anonymizer)
     return train_data_indexed, dev_data_indexed, test_data_indexed, input_indexer, output_indexer
 
 
 ##################################################
 # YOU SHOULD NOT NEED TO LOOK AT THESE FUNCTIONS #
 ##################################################
-def print_evaluation_results(test_data, selected_derivs, denotation_correct, example_freq=50, print_output=True):
+def print_evaluation_results(test_data, selected_derivs, denotation_correct, example_freq=50, print_output=True,
+                             num_sampled_examples=0, bootstrap_samples=0):
     """
     Prints output and accuracy. YOU SHOULD NOT NEED TO CALL THIS DIRECTLY -- instead call evaluate in main.py, which
     wraps this.
     :param test_data:
     :param selected_derivs:
     :param denotation_correct:
-    :param example_freq: How often to print output
+    :param example_freq: How often to print output (0 to print no examples)
     :param print_output: True if we should print the scores, false otherwise (you should never need to set this False)
+    :param num_sampled_examples: if > 0, print this many randomly chosen examples instead of every example_freq-th
+    :param bootstrap_samples: if > 0, also print 95% bootstrap confidence intervals of the scores from this many
+    resamples of the examples (see bootstrap_scores)
     :return: List[float] which is [exact matches, token level accuracy, denotation matches]
     """
-    num_exact_match = 0
-    num_tokens_correct = 0
-    num_denotation_match = 0
-    total_tokens = 0
-    for i, ex in enumerate(test_data):
-        pred_y_toks = selected_derivs[i].y_toks if i < len(selected_derivs) else [""]
-        if print_output and i % example_freq == example_freq - 1:
+    pred_y_toks = [deriv.y_toks for deriv in selected_derivs[:len(test_data)]]
+    pred_y_toks += [[""]] * (len(test_data) - len(pred_y_toks))
+    exact_match, tokens_correct, num_tokens = score_predictions(pred_y_toks, [ex.y_tok for ex in test_data])
+    denotation_match = np.asarray(denotation_correct[:len(test_data)], dtype=bool)
+    if print_output:
+        if num_sampled_examples > 0:
+            shown = sorted(random.Random(0).sample(range(len(test_data)), min(num_sampled_examples, len(test_data))))
+        elif example_freq > 0:
+            shown = range(example_freq - 1, len(test_data), example_freq)
+        else:
+            shown = []
+        for i in shown:
             print('Example %d' % i)
-            print('  x      = "%s"' % ex.x)
-            print('  y_tok  = "%s"' % ex.y_tok)
-            print('  y_pred = "%s"' % pred_y_toks)
-        # Compute accuracy metrics
-        y_pred = ' '.join(pred_y_toks)
-        # Check exact match
-        if y_pred == ' '.join(ex.y_tok):
-            num_exact_match += 1
-        # Check position-by-position token correctness
-        num_tokens_correct += sum(a == b for a, b in zip(pred_y_toks, ex.y_tok))
-        total_tokens += len(ex.y_tok)
-        # Check correctness of the denotation
-        if denotation_correct[i]:
-            num_denotation_match += 1
+            print('  x      = "%s"' % test_data[i].x)
+            print('  y_tok  = "%s"' % test_data[i].y_tok)
+            print('  y_pred = "%s"' % pred_y_toks[i])
+    num_exact_match = int(exact_match.sum())
+    num_tokens_correct = int(tokens_correct.sum())
+    num_denotation_match = int(denotation_match.sum())
+    total_tokens = int(num_tokens.sum())
     if print_output:
         print("Exact logical form matches: %s" % (render_ratio(num_exact_match, len(test_data))))
         print("Token-level accuracy: %s" % (render_ratio(num_tokens_correct, total_tokens)))
         print("Denotation matches: %s" % (render_ratio(num_denotation_match, len(test_data))))
+        if bootstrap_samples > 0:
+            intervals = bootstrap_scores(exact_match, tokens_correct, num_tokens, denotation_match, bootstrap_samples)
+            for name, (low, high) in zip(["Exact logical form matches", "Token-level accuracy", "Denotation matches"],
+                                         intervals):
+                print("%s 95%% CI: [%.3f, %.3f]" % (name, low, high))
     return [num_exact_match / len(test_data), num_tokens_correct / total_tokens, num_denotation_match / len(test_data)]
 
 
+def score_predictions(pred_y_toks: List[List[str]], gold_y_toks: List[List[str]]):
+    """
+    Scores predicted logical forms against the gold ones with array operations. Exact matches are found with one pass
+    of list comparisons; for the other examples, both sides are flattened into token arrays and position j of each
+    prediction is compared to position j of its gold output with one gather over all of them.
+    :return: per-example arrays: exact match (bool), number of tokens correct in position, and gold length
+    """
+    exact_match = np.fromiter(map(operator.eq, pred_y_toks, gold_y_toks), dtype=bool, count=len(gold_y_toks))
+    gold_lens = np.fromiter(map(len, gold_y_toks), dtype=np.int64, count=len(gold_y_toks))
+    tokens_correct = np.where(exact_match, gold_lens, 0)
+    rest = np.flatnonzero(~exact_match)
+    if len(rest) == 0:
+        return exact_match, tokens_correct, gold_lens
+    pred_rest = [pred_y_toks[i] for i in rest]
+    pred_toks = np.fromiter(chain.from_iterable(pred_rest), dtype=object)
+    gold_toks = np.fromiter(chain.from_iterable(gold_y_toks[i] for i in rest), dtype=object)
+    pred_lens = np.fromiter(map(len, pred_rest), dtype=np.int64, count=len(rest))
+    pred_starts = np.cumsum(pred_lens) - pred_lens
+    gold_starts = np.cumsum(gold_lens[rest]) - gold_lens[rest]
+    # Positions compared: j < min(pred len, gold len) of every example
+    overlap = np.minimum(pred_lens, gold_lens[rest])
+    rows = np.repeat(np.arange(len(rest)), overlap)
+    positions = np.arange(overlap.sum()) - np.repeat(np.cumsum(overlap) - overlap, overlap)
+    same = pred_toks[pred_starts[rows] + positions] == gold_toks[gold_starts[rows] + positions]
+    tokens_correct[rest] = np.bincount(rows, weights=same, minlength=len(rest))
+    return exact_match, tokens_correct, gold_lens
+
+
+def bootstrap_scores(exact_match, tokens_correct, num_tokens, denotation_match, num_samples=1000, alpha=0.05,
+                     seed=0):
+    """
+    Percentile bootstrap confidence intervals of the scores of print_evaluation_results, resampling examples with
+    replacement. Examples with the same per-example scores are interchangeable, so a resample is drawn as multinomial
+    counts over the distinct score tuples, which gives the same distribution as resampling example indices at a cost
+    independent of the number of examples.
+    :param exact_match/tokens_correct/num_tokens/denotation_match: per-example arrays, as from score_predictions
+    :return: (low, high) for exact match, token-level accuracy and denotation match
+    """
+    scores = np.stack([exact_match, tokens_correct, num_tokens, denotation_match], axis=1).astype(np.int64)
+    # Each tuple packed into one integer, as np.unique over rows is much slower than over scalars
+    radix = scores.max(axis=0) + 1
+    place = np.concatenate([np.cumprod(radix[::-1])[::-1][1:], [1]])
+    keys, counts = np.unique(scores @ place, return_counts=True)
+    distinct = keys[:, None] // place % radix
+    resampled = np.random.RandomState(seed).multinomial(len(scores), counts / counts.sum(), size=num_samples)
+    sums = resampled @ distinct
+    samples = [sums[:, 0] / len(scores), sums[:, 1] / np.maximum(sums[:, 2], 1), sums[:, 3] / len(scores)]
+    return [tuple(np.percentile(sample, [100 * alpha / 2, 100 * (1 - alpha / 2)])) for sample in samples]
+
+
 def render_ratio(numer, denom):
     return "%i / %i = %.3f" % (numer, denom, float(numer) / denom)
 
@@ -221,17 +309,35 @@ def geoquery_preprocess_lf(lf):
     :param lf:
     :return:
     """
-    cur_vars = []
-    toks = lf.split(' ')
+    return ' '.join(geoquery_preprocess_lf_toks(lf.split(' ')))
+
+
+def geoquery_preprocess_lf_toks(toks: List[str]) -> List[str]:
+    """
+    Token-level version of geoquery_preprocess_lf. Variables (single letters) are replaced by NV at their first
+    occurrence and by V<i> afterwards, where i counts how many variables were introduced after them. Runs in O(n) by
+    remembering the position at which each variable was introduced.
+    :param toks: tokens of a raw logical form
+    :return: the standardized tokens
+    """
+    var_positions = {}
     new_toks = []
     for w in toks:
-        if w.isalpha() and len(w) == 1:
-            if w in cur_vars:
-                ind_from_end = len(cur_vars) - cur_vars.index(w) - 1
-                new_toks.append('V%d' % ind_from_end)
-            else:
-                cur_vars.append(w)
+        if len(w) == 1 and w.isalpha():
+            pos = var_positions.get(w)
+            if pos is None:
+                var_positions[w] = len(var_positions)
                 new_toks.append('NV')
+            else:
+                new_toks.append('V%d' % (len(var_positions) - pos - 1))
         else:
             new_toks.append(w)
-    return ' '.join(new_toks)
+    return new_toks
+
+
+def geoquery_preprocess_lf_batch(lf_toks_list: List[List[str]]) -> List[List[str]]:
+    """
+    :param lf_toks_list: tokenized raw logical forms
+    :return: geoquery_preprocess_lf_toks applied to each of them
+    """
+    return [geoquery_preprocess_lf_toks(toks) for toks in lf_toks_list]
@@ -0,0 +1,151 @@
+# distill.py
+# Knowledge distillation: trains a small student parser against the per-step output distributions of a larger trained
+# teacher, optionally also on questions without gold logical forms that the teacher labels itself.
+
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+from typing import List
+from data import *
+from entities import is_placeholder, restore_entities
+from lf_evaluator import *
+from models import *
+
+
+def distillation_loss(teacher: nn.Module, alpha: float, temperature: float):
+    """
+    Builds the loss_fn train_model_encdec uses to train the student: per gold position,
+        alpha * CE(student, gold) + (1 - alpha) * T^2 * KL(softmax(teacher / T) || softmax(student / T))
+    summed over the batch like the models' own losses. The T^2 factor keeps the KL gradients on the same scale as the
+    CE ones as T changes (Hinton et al., 2015).
+    :param teacher: trained parser exposing teacher_forced_logits; it is put in eval mode and never updated
+    :param alpha: weight of the gold cross-entropy term
+    :param temperature: softmax temperature of the KL term
+    :return: loss_fn(student, x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor) -> scalar loss tensor
+    """
+    teacher.eval()
+
+    def loss_fn(student, x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor):
+        with torch.no_grad():
+            teacher_logits = teacher.teacher_forced_logits(x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor)
+        student_logits = student.teacher_forced_logits(x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor)
+        max_out_len = student_logits.shape[1]
+        mask = (torch.arange(max_out_len).unsqueeze(0) < out_lens_tensor.unsqueeze(1)).float()
+        vocab_size = student_logits.shape[-1]
+        ce = F.cross_entropy(student_logits.reshape(-1, vocab_size), y_tensor[:, :max_out_len].reshape(-1),
+                             reduction='none').view_as(mask)
+        kl = F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                      F.log_softmax(teacher_logits / temperature, dim=-1), reduction='none', log_target=True).sum(-1)
+        return ((alpha * ce + (1 - alpha) * temperature * temperature * kl) * mask).sum()
+    return loss_fn
+
+
+def load_questions(path: str) -> List[str]:
+    """
+    :param path: file with one question per line; tab-separated files (e.g. data/*.tsv) contribute their first column
+    :return: the non-empty questions
+    """
+    questions = []
+    with open(path) as f:
+        for line in f:
+            question = line.rstrip('\n').split('\t')[0].strip()
+            if len(question) > 0:
+                questions.append(question)
+    return questions
+
+
+def teacher_label(teacher, questions: List[str], input_indexer: Indexer, output_indexer: Indexer,
+                  example_len_limit: int) -> List[Example]:
+    """
+    Sequence-level distillation data: the teacher's greedy outputs on the given questions, used as if they were gold.
+    If the teacher was trained with anonymized entities, the questions are anonymized with its anonymizer the same way
+    index_data does it: the indexed sides keep the placeholders and y_tok gets the entity names back.
+    :param teacher: trained parser
+    :param questions: unlabeled questions
+    :param example_len_limit: outputs are truncated to this many tokens, as in index_data
+    :return: one Example per question the teacher produced a non-empty logical form for (that only refers to entities
+    of the question, if anonymized)
+    """
+    anonymizer = getattr(teacher, 'anonymizer', None)
+    unlabeled = []
+    for x in questions:
+        x_tok = tokenize(x)
+        if anonymizer is not None:
+            model_x_tok, _, entities = anonymizer.anonymize(x_tok)
+        else:
+            model_x_tok, entities = x_tok, None
+        unlabeled.append(Example(x, x_tok, index(model_x_tok, input_indexer), "", [], [], entities))
+    labeled = []
+    for ex, derivs in zip(unlabeled, teacher.decode(unlabeled)):
+        model_y_tok = derivs[0].y_toks[0:example_len_limit]
+        if len(model_y_tok) == 0:
+            continue
+        y_tok = restore_entities(model_y_tok, ex.entities) if ex.entities else model_y_tok
+        if anonymizer is not None and any(is_placeholder(tok) for tok in y_tok):
+            continue
+        y_indexed = [output_indexer.index_of(y) for y in model_y_tok] + [output_indexer.index_of(EOS_SYMBOL)]
+        labeled.append(Example(ex.x, ex.x_tok, ex.x_indexed, " ".join(y_tok), y_tok, y_indexed, ex.entities))
+    return labeled
+
+
+def _check_same_vocab(teacher, input_indexer: Indexer, output_indexer: Indexer):
+    if teacher.input_indexer.objs_to_ints != input_indexer.objs_to_ints or \
+            teacher.output_indexer.objs_to_ints != output_indexer.objs_to_ints:
+        raise ValueError("The teacher was trained with a different vocabulary; distill with the train_path (and "
+                         "decoder_len_limit) it was trained on")
+
+
+def train_distilled_student(teacher, train_data: List[Example], dev_data: List[Example], input_indexer: Indexer,
+                            output_indexer: Indexer, args) -> nn.Module:
+    """
+    Trains a student of size args.student_emb_dim/args.student_hidden_size (backend args.model_type) with
+    train_model_encdec and the distillation loss. Questions from args.distill_unlabeled_path that aren't in the
+    training set are labeled by the teacher and added to the training data.
+    :param teacher: trained parser sharing input_indexer/output_indexer
+    :return: the trained student
+    """
+    _check_same_vocab(teacher, input_indexer, output_indexer)
+    if args.distill_unlabeled_path is not None:
+        train_questions = set(ex.x for ex in train_data)
+        questions = [q for q in load_questions(args.distill_unlabeled_path) if q not in train_questions]
+        pseudo_labeled = teacher_label(teacher, questions, input_indexer, output_indexer, args.decoder_len_limit)
+        print("Teacher labeled %i of %i unlabeled questions" % (len(pseudo_labeled), len(questions)))
+        train_data = train_data + pseudo_labeled
+    student_args = argparse.Namespace(**vars(args))
+    student_args.emb_dim = args.student_emb_dim
+    student_args.hidden_size = args.student_hidden_size
+    return train_model_encdec(train_data, dev_data, input_indexer, output_indexer, student_args,
+                              loss_fn=distillation_loss(teacher, args.distill_alpha, args.distill_temperature))
+
+
+def decode_latency_ms(decoder, test_data: List[Example]) -> float:
+    """
+    :return: mean wall time in milliseconds to decode one example at batch size 1, the way a server sees queries
+    """
+    start = time.perf_counter()
+    for ex in test_data:
+        decoder.decode([ex])
+    return 1000.0 * (time.perf_counter() - start) / max(len(test_data), 1)
+
+
+def report_distillation_tradeoff(teacher, student, test_data: List[Example], use_java=True):
+    """
+    Evaluates teacher and student on test_data and prints their accuracy next to their size and per-query latency
+    :return: name -> {exact, token, denotation, latency_ms, params}
+    """
+    results = {}
+    for name, decoder in [('teacher', teacher), ('student', student)]:
+        print("=======%s=======" % name.upper())
+        exact, token_acc, denotation = evaluate(test_data, decoder, print_output=False, use_java=use_java)
+        results[name] = {'exact': exact, 'token': token_acc, 'denotation': denotation,
+                         'latency_ms': decode_latency_ms(decoder, test_data),
+                         'params': sum(p.numel() for p in decoder.parameters())}
+    print("%-8s %10s %8s %8s %11s %12s" % ("model", "params", "exact", "token", "denotation", "ms/example"))
+    for name, res in results.items():
+        print("%-8s %10i %8.3f %8.3f %11.3f %12.2f" % (name, res['params'], res['exact'], res['token'],
+                                                       res['denotation'], res['latency_ms']))
+    print("Student is %.1fx smaller and %.1fx faster per query" %
+          (results['teacher']['params'] / results['student']['params'],
+           results['teacher']['latency_ms'] / results['student']['latency_ms']))
+    return results
@@ -0,0 +1,135 @@
+# ensemble.py
+# Ensembles of Seq2SeqSemanticParser checkpoints (e.g. several seeds) decoded in one vectorized computation.
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from typing import List
+from torch.func import stack_module_state
+from data import *
+from models import *
+
+
+class EnsembleSemanticParser(object):
+    """
+    Greedy decoder for an ensemble of M Seq2SeqSemanticParsers with the same vocabularies and sizes. The members'
+    parameters are stacked along a leading model dimension (torch.func.stack_module_state), so the encoder and every
+    decoder step run for all members at once as batched matmuls, instead of M separate decodes. Each step takes the
+    argmax of the members' log-probabilities averaged over the ensemble. As in FusedGateTables, embeddings are folded
+    into the LSTM input projections, one [M x vocab size x 4 * hidden] table per side.
+
+    Attributes:
+        models: the member models
+        input_indexer/output_indexer: the members' (shared) indexers
+    """
+    def __init__(self, models: List[Seq2SeqSemanticParser]):
+        first = models[0]
+        for model in models:
+            if not isinstance(model, Seq2SeqSemanticParser) or model.encoder.bidirect:
+                raise ValueError("Ensembles are only supported for Seq2SeqSemanticParser with a unidirectional encoder")
+            if model.input_indexer.objs_to_ints != first.input_indexer.objs_to_ints or \
+                    model.output_indexer.objs_to_ints != first.output_indexer.objs_to_ints:
+                raise ValueError("Ensemble members must share their vocabularies")
+        self.models = models
+        self.input_indexer = first.input_indexer
+        self.output_indexer = first.output_indexer
+        for model in models:
+            model.eval()
+        params, _ = stack_module_state(models)
+        with torch.no_grad():
+            self.enc_gates = torch.matmul(params['input_emb.word_embedding.weight'],
+                                          params['encoder.rnn.weight_ih_l0'].transpose(1, 2)) + \
+                (params['encoder.rnn.bias_ih_l0'] + params['encoder.rnn.bias_hh_l0']).unsqueeze(1)
+            self.dec_gates = torch.matmul(params['output_emb.word_embedding.weight'],
+                                          params['decoder.rnn.weight_ih_l0'].transpose(1, 2)) + \
+                (params['decoder.rnn.bias_ih_l0'] + params['decoder.rnn.bias_hh_l0']).unsqueeze(1)
+            self.enc_w_hh = params['encoder.rnn.weight_hh_l0'].transpose(1, 2).contiguous()
+            self.dec_w_hh = params['decoder.rnn.weight_hh_l0'].transpose(1, 2).contiguous()
+            self.out_w = params['decoder.W.weight'].transpose(1, 2).contiguous()
+            self.out_b = params['decoder.W.bias'].unsqueeze(1)
+        self.hidden_size = first.encoder.hidden_size
+
+    def __len__(self):
+        return len(self.models)
+
+    def _lstm_cell(self, gates_x, h, c, w_hh):
+        """
+        One LSTM step for every member
+        :param gates_x: [M x 4 * hidden] input gate pre-activations
+        :param h/c: [M x hidden] states
+        :param w_hh: [M x hidden x 4 * hidden] transposed recurrent weights
+        """
+        gates = gates_x + torch.bmm(h.unsqueeze(1), w_hh).squeeze(1)
+        i, f, g, o = gates.chunk(4, dim=1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        return h, c
+
+    def encode(self, x_indexed: List[int]):
+        """
+        :return: each member's encoder outputs [M x sent len x hidden] and final states h and c, [M x hidden] each
+        """
+        gates_x = self.enc_gates[:, torch.LongTensor(x_indexed)]
+        h = c = torch.zeros(len(self), self.hidden_size)
+        outputs = []
+        for t in range(len(x_indexed)):
+            h, c = self._lstm_cell(gates_x[:, t], h, c, self.enc_w_hh)
+            outputs.append(h)
+        return torch.stack(outputs, dim=1), h, c
+
+    def step_log_probs(self, token: int, h, c, enc_outputs):
+        """
+        One attention decoder step for every member
+        :param token: previous output token
+        :param enc_outputs: [M x sent len x hidden]
+        :return: the ensemble's log-probabilities [1 x output vocab size] (mean of the members') and new states h and c
+        """
+        h, c = self._lstm_cell(self.dec_gates[:, token], h, c, self.dec_w_hh)
+        with PROFILER.phase("attention"):
+            prob = F.softmax(torch.bmm(enc_outputs, h.unsqueeze(2)), dim=1)
+            attention = torch.bmm(enc_outputs.transpose(1, 2), prob).squeeze(2)
+        logits = torch.baddbmm(self.out_b, torch.cat([h, attention], dim=1).unsqueeze(1), self.out_w).squeeze(1)
+        return F.log_softmax(logits, dim=1).mean(dim=0, keepdim=True), h, c
+
+    def greedy_decode(self, ex: Example):
+        """
+        :return: the predicted output token indices (without EOS) and their total ensemble log probability. If the
+        ensemble has a grammar_constraint (see LFGrammarConstraint), only well-formed logical forms can be produced.
+        """
+        constraint = getattr(self, 'grammar_constraint', None)
+        state = constraint.initial_states(1) if constraint is not None else None
+        with PROFILER.phase("encoder_forward"):
+            enc_outputs, h, c = self.encode(ex.x_indexed)
+        token = self.output_indexer.index_of(SOS_SYMBOL)
+        end_token = self.output_indexer.index_of(EOS_SYMBOL)
+        entry_word = []
+        prob = 0.0
+        while len(entry_word) < MAX_DECODE_LEN:
+            with PROFILER.phase("decoder_step"):
+                log_probs, h, c = self.step_log_probs(token, h, c, enc_outputs)
+                if constraint is not None:
+                    log_probs = constraint.apply(log_probs, state, MAX_DECODE_LEN - len(entry_word))
+                    log_probs = F.log_softmax(log_probs, dim=1)
+                best, token = torch.max(log_probs, dim=1)
+                prob += best.item()
+                token = token.item()
+            if token == end_token:
+                break
+            if constraint is not None:
+                state = constraint.advance(state, torch.LongTensor([token]))
+            entry_word.append(token)
+        return entry_word, prob
+
+    def decode(self, test_data: List[Example]) -> List[List[Derivation]]:
+        """
+        :param test_data: List[Example] to decode
+        :return: a one-best list of Derivations for each example
+        """
+        derivs = []
+        with torch.no_grad():
+            for ex in test_data:
+                entry_word, prob = self.greedy_decode(ex)
+                PROFILER.count("decode_examples")
+                PROFILER.count("decode_tokens", len(entry_word) + 1)
+                derivs.append([Derivation(ex, np.exp(prob), [self.output_indexer.get_object(y) for y in entry_word])])
+        return derivs
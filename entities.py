@@ -0,0 +1,181 @@
+# entities.py
+# Entity anonymization for GeoQuery: names from the knowledge base (states, cities, rivers, places) are matched in the
+# question with a trie and replaced by typed placeholders (STATE0, CITY0, ...) on both the question and logical form
+# side, so the decoder emits one token per entity instead of spelling it out. Placeholders in predictions are mapped
+# back to the names before the logical forms are formatted or written out.
+
+import re
+from typing import Dict, List, Tuple
+from data import *
+
+GEOBASE_PATH = 'evaluator/domains/dbquery/geoquery/1/geobase.dlog'
+
+# Entity types in order of preference for names that have several (e.g. "new york" the state or the city)
+ENTITY_TYPES = ['state', 'city', 'river', 'place']
+
+
+def load_geobase_entities(path=GEOBASE_PATH) -> Dict[Tuple[str, ...], Tuple[str, Tuple[str, ...]]]:
+    """
+    Reads the entity names out of the Geobase facts the evaluator executes logical forms against (the lexicon files
+    next to it only cover predicates). Abbreviations ('in', 'me', 'or', ...) are left out: they collide with common
+    question words. Rivers can also be mentioned as "<name> river", while logical forms always use the bare name.
+    :return: question phrase tokens -> (entity type, name tokens as they appear in logical forms)
+    """
+    # fact name -> type of the quoted names at these argument positions
+    fields = {'state': [(0, 'state'), (2, 'city'), (6, 'city'), (7, 'city'), (8, 'city'), (9, 'city')],
+              'city': [(2, 'city')], 'river': [(0, 'river')], 'mountain': [(2, 'place')], 'lake': [(0, 'place')],
+              'highlow': [(2, 'place'), (4, 'place')]}
+    entities = {}
+    with open(path) as f:
+        for line in f:
+            m = re.match(r"(\w+)\((.*)\)\.\s*$", line.strip())
+            if m is None or m.group(1) not in fields:
+                continue
+            # Top-level arguments; the bracketed state lists of rivers and lakes are kept as one argument
+            args = [arg.strip() for arg in re.findall(r"\[[^\]]*\]|'[^']*'|[^,]+", m.group(2))]
+            for i, entity_type in fields[m.group(1)]:
+                if i < len(args) and args[i].startswith("'"):
+                    name = tuple(args[i].strip("'").split())
+                    if len(name) == 0:
+                        continue
+                    phrases = [name, name + ('river',)] if entity_type == 'river' else [name]
+                    for phrase in phrases:
+                        if phrase not in entities or \
+                                ENTITY_TYPES.index(entity_type) < ENTITY_TYPES.index(entities[phrase][0]):
+                            entities[phrase] = (entity_type, name)
+    return entities
+
+
+class EntityTrie(object):
+    """
+    Token-level trie over entity names supporting leftmost-longest matching in a token sequence
+    """
+    def __init__(self, entities: Dict[Tuple[str, ...], Tuple[str, Tuple[str, ...]]]):
+        """
+        :param entities: phrase tokens -> value returned for matches of the phrase, as from load_geobase_entities
+        """
+        self.root = {}
+        for phrase, value in entities.items():
+            node = self.root
+            for tok in phrase:
+                node = node.setdefault(tok, {})
+            node[None] = value
+
+    def find(self, toks: List[str]) -> List[Tuple[int, int, Tuple[str, Tuple[str, ...]]]]:
+        """
+        :return: non-overlapping (start, end, value) spans of entity phrases in toks, preferring the longest phrase at
+        the leftmost position
+        """
+        spans = []
+        i = 0
+        while i < len(toks):
+            node = self.root
+            match = None
+            j = i
+            while j < len(toks) and toks[j] in node:
+                node = node[toks[j]]
+                j += 1
+                if None in node:
+                    match = (i, j, node[None])
+            if match is not None:
+                spans.append(match)
+                i = match[1]
+            else:
+                i += 1
+        return spans
+
+
+class EntityAnonymizer(object):
+    """
+    Replaces the entities of a question, and their mentions as arguments of the logical form, with placeholders
+    <TYPE><i> numbered in order of appearance per type. Logical form mentions are found with entity_arguments.
+    """
+    def __init__(self, entities: Dict[Tuple[str, ...], Tuple[str, Tuple[str, ...]]]):
+        self.trie = EntityTrie(entities)
+
+    @classmethod
+    def from_geobase(cls, path=GEOBASE_PATH):
+        return cls(load_geobase_entities(path))
+
+    def anonymize(self, x_tok: List[str], y_tok: List[str] = None):
+        """
+        :param x_tok: question tokens
+        :param y_tok: logical form tokens, if known
+        :return: anonymized x_tok, anonymized y_tok (None if not given), and the placeholder -> name tokens map (the
+        names as logical forms write them)
+        """
+        entities = {}
+        placeholders = {}
+        counts = {}
+        new_x_tok = []
+        last = 0
+        for start, end, (entity_type, name) in self.trie.find(x_tok):
+            if name not in placeholders:
+                placeholders[name] = "%s%i" % (entity_type.upper(), counts.get(entity_type, 0))
+                counts[entity_type] = counts.get(entity_type, 0) + 1
+                entities[placeholders[name]] = list(name)
+            new_x_tok.extend(x_tok[last:start])
+            new_x_tok.append(placeholders[name])
+            last = end
+        new_x_tok.extend(x_tok[last:])
+        if y_tok is None:
+            return new_x_tok, None, entities
+        new_y_tok = []
+        last = 0
+        for start, end, name in entity_arguments(y_tok):
+            if name in placeholders:
+                new_y_tok.extend(y_tok[last:start])
+                new_y_tok.append(placeholders[name])
+                last = end
+        new_y_tok.extend(y_tok[last:])
+        return new_x_tok, new_y_tok, entities
+
+
+def entity_arguments(y_tok: List[str]) -> List[Tuple[int, int, Tuple[str, ...]]]:
+    """
+    :param y_tok: logical form tokens
+    :return: (start, end, name tokens) spans of the entity arguments of the logical form: the argument right after
+    `_xxxid (`, a single token or a quoted span ' rhode island ' for multi-word names
+    """
+    spans = []
+    for i in range(2, len(y_tok)):
+        if not (y_tok[i - 2].startswith('_') and y_tok[i - 2].endswith('id') and y_tok[i - 1] == '('):
+            continue
+        if y_tok[i] == "'" and "'" in y_tok[i + 1:]:
+            end = y_tok.index("'", i + 1)
+            spans.append((i, end + 1, tuple(y_tok[i + 1:end])))
+        else:
+            spans.append((i, i + 1, tuple(y_tok[i:i + 1])))
+    return spans
+
+
+def is_placeholder(tok: str) -> bool:
+    """
+    :return: True if tok has the form of an entity placeholder (STATE0, CITY1, ...)
+    """
+    return re.match(r"(%s)\d+$" % "|".join(t.upper() for t in ENTITY_TYPES), tok) is not None
+
+
+def restore_entities(y_toks: List[str], entities: Dict[str, List[str]]) -> List[str]:
+    """
+    Puts the names back in place of the placeholders of a predicted logical form; multi-word names are quoted as in
+    the data. Placeholders the question has no entity for are left as they are.
+    """
+    restored = []
+    for tok in y_toks:
+        name = entities.get(tok)
+        if name is None:
+            restored.append(tok)
+        elif len(name) == 1:
+            restored.append(name[0])
+        else:
+            restored.extend(["'"] + name + ["'"])
+    return restored
+
+
+def restore_derivations(test_data: List[Example], all_derivs: List[List[Derivation]]) -> List[List[Derivation]]:
+    """
+    :return: all_derivs with restore_entities applied for every example that was anonymized
+    """
+    return [[Derivation(ex, d.p, restore_entities(d.y_toks, ex.entities)) for d in derivs] if ex.entities else derivs
+            for ex, derivs in zip(test_data, all_derivs)]
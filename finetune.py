@@ -0,0 +1,50 @@
+# finetune.py
+# Warm-start fine-tuning: continues training a saved model on new labeled queries. The model's vocabularies are
+# extended with the new tokens (existing indices never move) and its embeddings and output layer grown to match, so
+# only the new data (plus an optional replay sample of old data) needs training.
+
+import random
+from typing import List
+from data import *
+from models import *
+
+
+def load_replay_data(path: str, domain: str, input_indexer: Indexer, output_indexer: Indexer,
+                     example_len_limit: int, anonymizer=None) -> List[Example]:
+    """
+    Loads old training data to replay during fine-tuning, extending the indexers with any symbols they're missing
+    :param anonymizer: EntityAnonymizer the model's data is indexed with, if any (see index_data)
+    :return: the indexed examples
+    """
+    replay = load_dataset(path, domain=domain)
+    extend_indexers(replay, input_indexer, output_indexer, anonymizer=anonymizer)
+    return index_data(replay, input_indexer, output_indexer, example_len_limit, anonymizer)
+
+
+def finetune_model(model: nn.Module, train_data: List[Example], dev_data: List[Example], args,
+                   anonymizer=None) -> nn.Module:
+    """
+    Fine-tunes model on train_data, which must have been indexed with the model's own (extended) indexers, e.g. by
+    index_datasets(..., input_indexer=model.input_indexer, output_indexer=model.output_indexer). With
+    args.replay_path, a random sample of args.replay_ratio old examples per new example is mixed in to limit
+    forgetting. Training uses train_model_encdec with the usual flags (--epochs, --lr, --batch_size, checkpointing).
+    :param model: trained Seq2SeqSemanticParser or TransformerSemanticParser
+    :param anonymizer: EntityAnonymizer train_data was indexed with; defaults to the one saved with model, if any
+    :return: the fine-tuned model (the same object)
+    """
+    if anonymizer is None:
+        anonymizer = getattr(model, 'anonymizer', None)
+    if args.replay_path is not None:
+        replay = load_replay_data(args.replay_path, args.domain, model.input_indexer, model.output_indexer,
+                                  args.decoder_len_limit, anonymizer)
+        num_replay = min(len(replay), int(round(args.replay_ratio * len(train_data))))
+        train_data = train_data + random.sample(replay, num_replay)
+        print("Replaying %i of %i old examples" % (num_replay, len(replay)))
+    # The indexers were extended in place by index_datasets and load_replay_data; the model's vocabulary-sized
+    # layers still have the sizes of the embedding and output tables it was trained with
+    old_sizes = (model.input_emb.word_embedding.num_embeddings, model.output_emb.word_embedding.num_embeddings)
+    resize_to_indexers(model)
+    print("Vocabularies extended from %i/%i to %i/%i input/output types" % (old_sizes[0], old_sizes[1],
+                                                                           len(model.input_indexer),
+                                                                           len(model.output_indexer)))
+    return train_model_encdec(train_data, dev_data, model.input_indexer, model.output_indexer, args, model=model)
@@ -2,33 +2,71 @@ import tempfile
 import subprocess
 import os
 import re
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from data import *
+from entities import restore_derivations
+from predictions import PredictionWriter
+from profiling import *
 
 # YOU SHOULD NOT NEED TO LOOK AT THIS FILE.
 # This file consists of evaluation code adapted from Jia + Liang, wrapping predictions and sending them to a Java
 # backend for evaluation against the knowledge base.
 
-def evaluate(test_data: List[Example], decoder, example_freq=50, print_output=True, outfile=None, use_java=True):
+def evaluate(test_data: List[Example], decoder, example_freq=50, print_output=True, outfile=None, use_java=True,
+             pipeline_batch_size=0, pipeline_workers=2, streaming=False, progress_fn=None, staged=False,
+             predictions=None, dump_predictions=None, num_sampled_examples=0, bootstrap_samples=0):
     """
     Evaluates decoder against the data in test_data (could be dev data or test data). Prints some output
     every example_freq examples. Writes predictions to outfile if defined. Evaluation requires
     executing the model's predictions against the knowledge base. We pick the highest-scoring derivation for each
-    example with a valid denotation (if you've provided more than one).
+    example with a valid denotation (if you've provided more than one). Entity placeholders of anonymized examples are
+    replaced by the entity names first.
     :param test_data:
     :param decoder:
     :param example_freq: How often to print output
     :param print_output:
     :param outfile:
+    :param pipeline_batch_size: if > 0 and use_java, decode in batches of this size and execute each decoded batch
+    while the next one decodes (see decode_and_execute_pipelined); the results are the same
+    :param pipeline_workers: number of batches that may be executing at once in pipelined mode
+    :param streaming: stream the logical forms through the Java evaluator (see GeoqueryDomain.stream_denotations)
+    instead of writing them to a temporary file and buffering its whole output; the results are the same
+    :param progress_fn: in streaming mode, called as progress_fn(num_done, num_examples) as examples of each
+    evaluator call complete
+    :param staged: only execute a lower-ranked derivation once all higher-ranked ones of its example have failed to
+    execute (see GeoqueryDomain.compare_answers_staged); the results are the same
+    :param predictions: a PredictionStore of k-best lists for test_data (see predictions.py) to evaluate instead of
+    decoding with decoder, which may then be None
+    :param dump_predictions: prefix of a prediction store to write the decoded k-best lists of test_data to
+    :param num_sampled_examples: print this many randomly chosen examples instead of every example_freq-th
+    :param bootstrap_samples: if > 0, also print bootstrap confidence intervals of the scores from this many resamples
     :return:
     """
-    e = GeoqueryDomain()
-    pred_derivations = decoder.decode(test_data)
-    if use_java:
-        selected_derivs, denotation_correct = e.compare_answers([ex.y for ex in test_data], pred_derivations, quiet=True)
+    e = GeoqueryDomain(streaming, progress_fn, staged)
+    writer = PredictionWriter(dump_predictions) if dump_predictions is not None else None
+    if use_java and pipeline_batch_size > 0 and predictions is None:
+        selected_derivs, denotation_correct = decode_and_execute_pipelined(test_data, decoder, e, pipeline_batch_size,
+                                                                           pipeline_workers, writer)
     else:
-        selected_derivs = [derivs[0] for derivs in pred_derivations]
-        denotation_correct = [False for derivs in pred_derivations]
-    res = print_evaluation_results(test_data, selected_derivs, denotation_correct, example_freq, print_output)
+        with PROFILER.phase("decode"):
+            if predictions is not None:
+                pred_derivations = predictions.decode(test_data)
+            else:
+                pred_derivations = restore_derivations(test_data, decoder.decode(test_data))
+        if writer is not None:
+            writer.add(pred_derivations)
+        if use_java:
+            selected_derivs, denotation_correct = e.compare_answers([ex.y for ex in test_data], pred_derivations,
+                                                                    quiet=True)
+        else:
+            selected_derivs = [derivs[0] for derivs in pred_derivations]
+            denotation_correct = [False for derivs in pred_derivations]
+    if writer is not None:
+        writer.close()
+    res = print_evaluation_results(test_data, selected_derivs, denotation_correct, example_freq, print_output,
+                                   num_sampled_examples, bootstrap_samples)
     # Writes to the output file if needed
     if outfile is not None:
         with open(outfile, "w") as out:
@@ -37,6 +75,67 @@ def evaluate(test_data: List[Example], decoder, example_freq=50, print_output=Tr
         out.close()
     return res
 
+def decode_and_execute_pipelined(test_data: List[Example], decoder, domain, batch_size: int, num_workers=2,
+                                 writer=None):
+    """
+    Decodes test_data batch by batch on the calling thread while worker threads format each finished batch and run it
+    through the Java evaluator, so evaluation takes roughly max(decoding, execution) instead of their sum. Decoding
+    (torch ops) and waiting on the evaluator subprocess both release the GIL, so threads overlap them fine.
+    :param domain: GeoqueryDomain whose compare_answers executes each batch
+    :param batch_size: number of examples decoded and executed together; each batch starts one evaluator process
+    :param num_workers: number of batches that may be executing at once
+    :param writer: PredictionWriter to add each decoded batch to
+    :return: the selected derivation and denotation correctness of each example, in the order of test_data, as
+    compare_answers returns them
+    """
+    selected_derivs = []
+    denotation_correct = []
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = []
+        for start in range(0, len(test_data), batch_size):
+            batch = test_data[start:start + batch_size]
+            with PROFILER.phase("decode"):
+                pred_derivations = restore_derivations(batch, decoder.decode(batch))
+            if writer is not None:
+                writer.add(pred_derivations)
+            futures.append(pool.submit(domain.compare_answers, [ex.y for ex in batch], pred_derivations, True))
+        for future in futures:
+            derivs, correct = future.result()
+            selected_derivs.extend(derivs)
+            denotation_correct.extend(correct)
+    return selected_derivs, denotation_correct
+
+def geoquery_evaluator_command(examples_path: str) -> List[str]:
+    """
+    :param examples_path: path of a .dlog file of _parse(...) lines to execute
+    :return: the full java command line running the Geoquery evaluator on examples_path
+    """
+    return ['java', '-ea', '-server', '-Xss8m', '-cp', 'evaluator/evaluator.jar:lib/scala-compiler.jar:lib/scala-library.jar:lib/fig.jar:lib/tea.jar:lib/berkeleyParser.jar:lib/trove-2.1.0.jar',
+            'dcs.NuggetLearn', '-create', '-monitor', '-useStandardExecPoolDirStrategy', '-jarFiles', 'evaluator/evaluator.jar',
+            '+miscOptions', 'new4', '-model.verbose', '2', '-numIters', '5', '-updateType', 'full', '-miniBatchSize', 'MAX',
+            '-parser.command', '"bash lib/lowercase-parser"', '-parser.lowercase', 'true', '-useBayesianAveraging', 'true',
+            '-allowTroll', '-regularization', '0.01', '-beamSize', '100', '-features', 'pred', 'pred2', 'predarg', 'lexpred',
+            'lexnull', '-generalMaxExamples', 'MAX', '-data.permuteExamples', 'true', '-displayTypes', 'false', '-displayDens',
+            'false', '-displaySpans', 'false', '-displayMaxSetSize', '1', '-msPerLine', '0', '-int.verbose', '0', '-data.verbose',
+            '0', '-addToView', 'geo3', '-lexToName', '-lexToSetWithName', '-generalPaths', 'evaluator/domains/dbquery/geoquery/1/geoquery.dlog',
+            'evaluator/domains/dbquery/geoquery/1/lexicon.dlog', '-dlogOptions', 'lexMode=0', '+generalPaths', examples_path, '-trainFrac', '0.7',
+            '-testFrac', '0.3', '-data.random', '1']
+
+def pick_derivation(deriv_set, pred_dens, is_error_fn):
+    """
+    pick_derivations for a single example
+    :param deriv_set: the example's derivations, best first
+    :param pred_dens: their denotations
+    :return: the top-scoring derivation that executed without error (the first one if none did) and its denotation
+    """
+    for deriv, den in zip(deriv_set, pred_dens):
+        if not is_error_fn(den):
+            return deriv, den
+    if len(deriv_set) == 0:
+        # Try to avoid crashing
+        return Derivation("", 0.0, [""]), "Example FAILED TO PARSE"
+    return deriv_set[0], pred_dens[0]  # Default to first derivation
+
 # Find the top-scoring derivation that executed without error
 def pick_derivations(all_pred_dens, all_derivs, is_error_fn):
     derivs = []
@@ -51,76 +150,122 @@ def pick_derivations(all_pred_dens, all_derivs, is_error_fn):
         return (derivs, pred_dens)
 
     for deriv_set in all_derivs:
-        # What to do if 0?
-        for i in range(len(deriv_set)):
-            cur_denotation = all_pred_dens[cur_start + i]
-            if not is_error_fn(cur_denotation):
-                derivs.append(deriv_set[i])
-                pred_dens.append(cur_denotation)
-                break
-        else:
-            if len(deriv_set) == 0:
-                # Try to avoid crashing
-                derivs.append(Derivation("", 0.0, [""]))
-                pred_dens.append("Example FAILED TO PARSE")
-            else:
-                derivs.append(deriv_set[0])  # Default to first derivation
-                pred_dens.append(all_pred_dens[cur_start])
+        deriv, den = pick_derivation(deriv_set, all_pred_dens[cur_start:cur_start + len(deriv_set)], is_error_fn)
+        derivs.append(deriv)
+        pred_dens.append(den)
         cur_start += len(deriv_set)
     return (derivs, pred_dens)
 
 
 class GeoqueryDomain(object):
+    def __init__(self, streaming=False, progress_fn=None, staged=False):
+        """
+        :param streaming: execute logical forms with compare_answers_streaming instead of through a temporary file
+        :param progress_fn: called as progress_fn(num_done, num_examples) as streamed examples complete
+        :param staged: execute k-best lists rank by rank with compare_answers_staged (each stage streamed if streaming)
+        """
+        self.streaming = streaming
+        self.progress_fn = progress_fn
+        self.staged = staged
+        # Totals of compare_answers_staged over all its calls, which may run on several threads at once
+        self.exec_stats = Counter()
+        self.exec_stats_lock = threading.Lock()
+
     def postprocess_lf(self, lf):
         # Undo the variable name standardization.
-        cur_var = chr(ord('A') - 1)
-        toks = lf.split(' ')
+        return ' '.join(self.postprocess_lf_toks(lf.split(' ')))
+
+    def postprocess_lf_toks(self, toks):
+        # Token-level version of postprocess_lf: NV introduces the next variable letter (A, B, ...) and V<i> refers to
+        # the variable introduced i variables before the latest one
+        cur_var = ord('A') - 1
         new_toks = []
         for w in toks:
             if w == 'NV':
-                cur_var = chr(ord(cur_var) + 1)
-                new_toks.append(cur_var)
+                cur_var += 1
+                new_toks.append(chr(cur_var))
             elif w.startswith('V'):
-                ind = int(w[1:])
-                new_toks.append(chr(ord(cur_var) - ind))
+                new_toks.append(chr(cur_var - int(w[1:])))
             else:
                 new_toks.append(w)
-        return ' '.join(new_toks)
+        return new_toks
 
     def clean_name(self, name):
         return name.split(',')[0].replace("'", '').strip()
 
     def format_lf(self, lf):
         # Strip underscores, collapse spaces when not inside quotation marks
-        lf = self.postprocess_lf(lf)
-        toks = []
+        return self.format_lf_toks(lf.split())
+
+    def format_lf_toks(self, toks):
+        """
+        Single pass over the tokens of a standardized logical form that undoes the variable standardization, strips
+        underscores, joins quoted names and counts parentheses as it goes, then balances them. Output is identical to
+        the original postprocess_lf + format_lf pipeline.
+        :param toks: tokens of a logical form, as produced by tokenize (no whitespace inside tokens)
+        :return: the logical form in the evaluator's syntax
+        """
+        cur_var = ord('A') - 1
+        toks_out = []
         in_quotes = False
         quoted_toks = []
-        for t in lf.split():
+        num_left_paren = 0
+        num_right_paren = 0
+        for t in toks:
+            if t == '(':
+                if not in_quotes:
+                    num_left_paren += 1
+                    toks_out.append(t)
+                    continue
+            elif t == ')':
+                if not in_quotes:
+                    num_right_paren += 1
+                    toks_out.append(t)
+                    continue
+            elif t.startswith('V') or t == 'NV':
+                if t == 'NV':
+                    cur_var += 1
+                    t = chr(cur_var)
+                else:
+                    t = chr(cur_var - int(t[1:]))
+                # The original pipeline re-split the postprocessed string, dropping variables that map to whitespace
+                if t.isspace():
+                    continue
+            elif not t:
+                continue
             if in_quotes:
                 if t == "'":
                     in_quotes = False
-                    toks.append('"%s"' % ' '.join(quoted_toks))
+                    quoted = '"%s"' % ' '.join(quoted_toks)
+                    num_left_paren += quoted.count('(')
+                    num_right_paren += quoted.count(')')
+                    toks_out.append(quoted)
                     quoted_toks = []
                 else:
                     quoted_toks.append(t)
+            elif t == "'":
+                in_quotes = True
             else:
-                if t == "'":
-                    in_quotes = True
-                else:
-                    if len(t) > 1 and t.startswith('_'):
-                        toks.append(t[1:])
-                    else:
-                        toks.append(t)
-        lf = ''.join(toks)
+                if len(t) > 1 and t.startswith('_'):
+                    t = t[1:]
+                num_left_paren += t.count('(')
+                num_right_paren += t.count(')')
+                toks_out.append(t)
+        lf = ''.join(toks_out)
         # Balance parentheses
-        num_left_paren = sum(1 for c in lf if c == '(')
-        num_right_paren = sum(1 for c in lf if c == ')')
         diff = num_left_paren - num_right_paren
         if diff > 0:
             lf = lf + ')' * diff
         return lf
 
+    def format_lfs(self, lf_toks_list):
+        """
+        :param lf_toks_list: list of tokenized logical forms (e.g. the y_toks of derivations)
+        :return: format_lf_toks applied to each of them
+        """
+        format_lf_toks = self.format_lf_toks
+        return [format_lf_toks(toks) for toks in lf_toks_list]
+
     def get_denotation(self, line):
         m = re.search('\{[^}]*\}', line)
         if m:
@@ -139,9 +284,37 @@ class GeoqueryDomain(object):
         return 'FAILED' in d or 'Join failed syntactically' in d
 
     def compare_answers(self, true_answers, all_derivs, quiet=False):
-        all_lfs = ([self.format_lf(s) for s in true_answers] +
-                [self.format_lf(' '.join(d.y_toks))
-                for x in all_derivs for d in x])
+        if getattr(self, 'staged', False):
+            return self.compare_answers_staged(true_answers, all_derivs, quiet)
+        if getattr(self, 'streaming', False):
+            return self.compare_answers_streaming(true_answers, all_derivs, quiet)
+        denotations = self.execute_lfs([tokenize(s) for s in true_answers] + [d.y_toks for x in all_derivs for d in x],
+                                       quiet)
+        true_dens = denotations[:len(true_answers)]
+        if len(true_dens) == 0:
+            true_dens = ["" for i in range(0, len(true_answers))]
+        all_pred_dens = denotations[len(true_answers):]
+
+        # Find the top-scoring derivation that executed without error
+        derivs, pred_dens = pick_derivations(all_pred_dens, all_derivs, self.is_error)
+        if not quiet:
+            self.print_failures(true_dens, 'gold')
+            self.print_failures(pred_dens, 'predicted')
+        for t, p in zip(true_dens, pred_dens):
+            if not quiet:
+                print('%s: %s == %s' % (t == p, t, p))
+        return derivs, [t == p for t, p in zip(true_dens, pred_dens)]
+
+    def execute_lfs(self, lf_toks_list, quiet=False):
+        """
+        Runs the Geoquery evaluator on a temporary file of the _parse(...) lines of the given logical forms
+        :param lf_toks_list: list of tokenized logical forms
+        :return: the denotations of the result lines of the evaluator's output, in order
+        """
+        if getattr(self, 'streaming', False):
+            return list(self.stream_denotations(lf_toks_list, quiet))
+        with PROFILER.phase("format_lf"):
+            all_lfs = self.format_lfs(lf_toks_list)
         tf_lines = ['_parse([query], %s).' % lf for lf in all_lfs]
         tf = tempfile.NamedTemporaryFile(suffix='.dlog')
         for line in tf_lines:
@@ -161,16 +334,8 @@ class GeoqueryDomain(object):
         try:
             # msg = subprocess.check_output(['evaluator/geoquery', tf.name]).decode("utf-8")
             # Alternate form with the whole java command
-            msg = subprocess.check_output(['java', '-ea', '-server', '-Xss8m', '-cp', 'evaluator/evaluator.jar:lib/scala-compiler.jar:lib/scala-library.jar:lib/fig.jar:lib/tea.jar:lib/berkeleyParser.jar:lib/trove-2.1.0.jar',
-                                           'dcs.NuggetLearn', '-create', '-monitor', '-useStandardExecPoolDirStrategy', '-jarFiles', 'evaluator/evaluator.jar',
-                                           '+miscOptions', 'new4', '-model.verbose', '2', '-numIters', '5', '-updateType', 'full', '-miniBatchSize', 'MAX',
-                                           '-parser.command', '"bash lib/lowercase-parser"', '-parser.lowercase', 'true', '-useBayesianAveraging', 'true',
-                                           '-allowTroll', '-regularization', '0.01', '-beamSize', '100', '-features', 'pred', 'pred2', 'predarg', 'lexpred',
-                                           'lexnull', '-generalMaxExamples', 'MAX', '-data.permuteExamples', 'true', '-displayTypes', 'false', '-displayDens',
-                                           'false', '-displaySpans', 'false', '-displayMaxSetSize', '1', '-msPerLine', '0', '-int.verbose', '0', '-data.verbose',
-                                           '0', '-addToView', 'geo3', '-lexToName', '-lexToSetWithName', '-generalPaths', 'evaluator/domains/dbquery/geoquery/1/geoquery.dlog',
-                                           'evaluator/domains/dbquery/geoquery/1/lexicon.dlog', '-dlogOptions', 'lexMode=0', '+generalPaths', tf.name, '-trainFrac', '0.7',
-                                           '-testFrac', '0.3', '-data.random', '1'], stderr=subprocess.STDOUT).decode("utf-8")
+            with PROFILER.phase("java_evaluator"):
+                msg = subprocess.check_output(geoquery_evaluator_command(tf.name), stderr=subprocess.STDOUT).decode("utf-8")
             # Use this line instead if the subprocess call is crashing
             # msg = ""
 
@@ -181,24 +346,150 @@ class GeoqueryDomain(object):
             print(msg)
             exit()
         tf.close()
-        denotations = [self.get_denotation(line)
-                       for line in msg.split('\n')
-                       if line.startswith('        Example')]
+        return [self.get_denotation(line)
+                for line in msg.split('\n')
+                if line.startswith('        Example')]
+
+    def compare_answers_staged(self, true_answers, all_derivs, quiet=False):
+        """
+        Same results as compare_answers, executing the k-best lists lazily: the gold logical forms and the rank-1
+        derivation of every example go to the evaluator in one call, then the rank-2 derivations of only the examples
+        whose rank-1 denotation is an error, and so on. pick_derivations keeps the first derivation that executes
+        without error, so nothing after it ever needs executing. Counts of the evaluator calls and of the derivations
+        executed out of all of them are added to exec_stats once the call is done (under exec_stats_lock, as the
+        pipelined evaluation runs several calls at once on one GeoqueryDomain).
+        :return: the selected derivation and denotation correctness of each example
+        """
+        pending = [i for i, deriv_set in enumerate(all_derivs) if len(deriv_set) > 0]
+        denotations = self.execute_lfs([tokenize(s) for s in true_answers] + [all_derivs[i][0].y_toks for i in pending],
+                                       quiet)
+        stats = Counter(calls=1, executed=len(pending), derivations=sum(len(x) for x in all_derivs))
         true_dens = denotations[:len(true_answers)]
         if len(true_dens) == 0:
             true_dens = ["" for i in range(0, len(true_answers))]
-        all_pred_dens = denotations[len(true_answers):]
-
-        # Find the top-scoring derivation that executed without error
-        derivs, pred_dens = pick_derivations(all_pred_dens, all_derivs, self.is_error)
+        round_dens = denotations[len(true_answers):]
+        if len(round_dens) == 0:
+            # The evaluator failed on everything; same fallback as pick_derivations
+            derivs, pred_dens = pick_derivations([], all_derivs, self.is_error)
+            pending = []
+        else:
+            derivs = [Derivation("", 0.0, [""]) for _ in all_derivs]
+            pred_dens = ["Example FAILED TO PARSE" for _ in all_derivs]
+        rank = 0
+        while len(pending) > 0:
+            next_pending = []
+            for i, den in zip(pending, round_dens + ["Example FAILED TO PARSE"] * (len(pending) - len(round_dens))):
+                # Rank 1 is the default when no derivation executes without error
+                if rank == 0 or not self.is_error(den):
+                    derivs[i] = all_derivs[i][rank]
+                    pred_dens[i] = den
+                if self.is_error(den) and rank + 1 < len(all_derivs[i]):
+                    next_pending.append(i)
+            rank += 1
+            pending = next_pending
+            if len(pending) > 0:
+                round_dens = self.execute_lfs([all_derivs[i][rank].y_toks for i in pending], quiet)
+                stats['calls'] += 1
+                stats['executed'] += len(pending)
+        with self.exec_stats_lock:
+            self.exec_stats.update(stats)
         if not quiet:
+            print("Executed %i of %i derivations in %i evaluator calls" % (stats['executed'], stats['derivations'],
+                                                                         stats['calls']))
             self.print_failures(true_dens, 'gold')
             self.print_failures(pred_dens, 'predicted')
-        for t, p in zip(true_dens, pred_dens):
-            if not quiet:
+            for t, p in zip(true_dens, pred_dens):
                 print('%s: %s == %s' % (t == p, t, p))
         return derivs, [t == p for t, p in zip(true_dens, pred_dens)]
 
+    def stream_denotations(self, lf_toks_iter, quiet=True):
+        """
+        Runs the Geoquery evaluator with its examples file being its own stdin (/dev/stdin): a writer thread formats the
+        logical forms of lf_toks_iter and feeds their _parse(...) lines to the process as they come, while the result
+        lines are parsed as they arrive, so neither all formatted logical forms nor the whole evaluator output are ever
+        held in memory
+        :param lf_toks_iter: iterable of tokenized logical forms
+        :return: generator of the denotation of each logical form, in order
+        """
+        proc = subprocess.Popen(geoquery_evaluator_command('/dev/stdin'), stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        def feed():
+            try:
+                for toks in lf_toks_iter:
+                    line = '_parse([query], %s).' % self.format_lf_toks(toks)
+                    if not quiet:
+                        print(line)
+                    proc.stdin.write(line.encode() + b'\n')
+                proc.stdin.close()
+            except (BrokenPipeError, ValueError):
+                # The evaluator exited early; its output says why
+                pass
+
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+        # Last lines of output, for the error message if the evaluator fails
+        tail = deque(maxlen=20)
+        try:
+            for line in proc.stdout:
+                line = line.decode("utf-8")
+                tail.append(line)
+                if line.startswith('        Example'):
+                    yield self.get_denotation(line)
+        finally:
+            if proc.poll() is None and writer.is_alive():
+                proc.kill()
+            writer.join()
+            returncode = proc.wait()
+            proc.stdout.close()
+        if returncode != 0:
+            print("Error in subprocess Geoquery evaluation call. End of command output:")
+            print("".join(tail))
+            print(returncode)
+            exit()
+
+    def compare_answers_streaming(self, true_answers, all_derivs, quiet=False):
+        """
+        Same results as compare_answers, with the logical forms streamed through the evaluator (stream_denotations).
+        Each example's gold logical form is sent right before its derivations, so an example is resolved (derivation
+        picked, correctness known, progress_fn called) as soon as its last result line is read.
+        :return: the selected derivation and denotation correctness of each example
+        """
+        def lf_toks():
+            for answer, deriv_set in zip(true_answers, all_derivs):
+                yield tokenize(answer)
+                for d in deriv_set:
+                    yield d.y_toks
+
+        progress_fn = getattr(self, 'progress_fn', None)
+        derivs = []
+        correct = []
+        true_dens = []
+        pred_dens = []
+        with PROFILER.phase("java_evaluator"):
+            denotations = self.stream_denotations(lf_toks(), quiet)
+            for i, deriv_set in enumerate(all_derivs):
+                # Missing result lines count as failures, as in compare_answers
+                true_den = next(denotations, "")
+                set_dens = [next(denotations, "Example FAILED TO PARSE") for _ in deriv_set]
+                deriv, pred_den = pick_derivation(deriv_set, set_dens, self.is_error)
+                derivs.append(deriv)
+                correct.append(true_den == pred_den)
+                if not quiet:
+                    true_dens.append(true_den)
+                    pred_dens.append(pred_den)
+                if progress_fn is not None:
+                    progress_fn(i + 1, len(all_derivs))
+            # Drain the evaluator so that it exits normally
+            for _ in denotations:
+                pass
+        if not quiet:
+            self.print_failures(true_dens, 'gold')
+            self.print_failures(pred_dens, 'predicted')
+            for t, p in zip(true_dens, pred_dens):
+                print('%s: %s == %s' % (t == p, t, p))
+        return derivs, correct
+
 
 ##########################
 # UNUSED IN THIS PROJECT #
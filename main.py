@@ -2,9 +2,11 @@ import argparse
 import random
 import numpy as np
 from lf_evaluator import *
-from models import *
+from model_args import *
+from nearest_neighbor import *
 from data import *
 from utils import *
+from profiling import *
 from typing import List
 
 def _parse_args():
@@ -27,24 +29,165 @@ def _parse_args():
     parser.add_argument('--print_dataset', dest='print_dataset', default=False, action='store_true', help="Print some sample data on loading")
     parser.add_argument('--eval_from_checkpoint', default=False, action='store_true', help="Evaluate model from checkpoint")
     parser.add_argument('--model_path', type=str, default='final_model.pt', help='path to model checkpoint')
+    parser.add_argument('--ensemble_paths', type=str, nargs='+', default=None, help='evaluate the ensemble of these saved LSTM models instead of training one')
+    parser.add_argument('--anonymize_entities', default=False, action='store_true', help='replace Geobase entity names with typed placeholders (STATE0, CITY0, ...) in questions and logical forms')
+    parser.add_argument('--eval_pipeline_batch', type=int, default=0, help='decode and execute in batches of this size, executing each batch while the next decodes (0 = decode everything, then execute)')
+    parser.add_argument('--stream_java_eval', default=False, action='store_true', help='stream logical forms to the Java evaluator over stdin and parse its results as they arrive')
+    parser.add_argument('--staged_java_eval', default=False, action='store_true', help='execute k-best lists rank by rank, only for examples whose better-ranked derivations all failed to execute')
+    parser.add_argument('--dump_predictions', type=str, default=None, help='write the decoded k-best lists of the dev and blind test sets to prediction stores PREFIX.dev and PREFIX.test')
+    parser.add_argument('--from_predictions', type=str, default=None, help='evaluate the prediction stores PREFIX.dev and PREFIX.test written by --dump_predictions instead of training or loading a model')
+    parser.add_argument('--example_freq', type=int, default=50, help='print every example_freq-th example with its prediction during evaluation (0 = none)')
+    parser.add_argument('--print_sampled_examples', type=int, default=0, help='print this many randomly chosen examples during evaluation instead of every example_freq-th')
+    parser.add_argument('--bootstrap_samples', type=int, default=0, help='also print 95%% bootstrap confidence intervals of the evaluation scores from this many resamples')
+    parser.add_argument('--profile_report', type=str, default=None, help='write a JSON report of per-phase timings, throughput and peak RSS to this path')
+    parser.add_argument('--profile_trace', type=str, default=None, help='also record a trace of the run: torch.profiler Chrome trace if the path ends in .json, cProfile stats otherwise')
     add_models_args(parser) # defined in models.py
 
     args = parser.parse_args()
     return args
 
 
-if __name__ == '__main__':
-    args = _parse_args()
-    print(args)
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    # Load the training and test data
+def build_neural_decoder(args, train_data_indexed, dev_data_indexed, input_indexer, output_indexer, base_model=None,
+                         anonymizer=None, saved_models=None):
+    """
+    Trains (or distills, fine-tunes, or loads with --eval_from_checkpoint) the neural model and sets up its decoding
+    options. torch and the model code are imported here rather than at the top so that nearest-neighbor runs never
+    load them.
+    :param base_model: the --warm_start model to fine-tune, if any
+    :param anonymizer: the EntityAnonymizer the data was indexed with, if any; saved with newly trained models so that
+    serving.py anonymizes its questions the same way
+    :param saved_models: the --ensemble_paths models or the --eval_from_checkpoint model, already loaded
+    :return: the decoder to evaluate
+    """
+    import torch
+    from models import train_model_encdec, Seq2SeqSemanticParser, TransformerSemanticParser, LFGrammarConstraint, \
+        OutputShortlist
+    from entities import load_geobase_entities
+    teacher = None
+    if args.ensemble_paths is not None:
+        from ensemble import EnsembleSemanticParser
+        decoder = EnsembleSemanticParser(saved_models)
+    elif args.eval_from_checkpoint:
+        decoder = saved_models[0]
+    elif base_model is not None:
+        from finetune import finetune_model
+        decoder = finetune_model(base_model, train_data_indexed, dev_data_indexed, args, anonymizer)
+    elif args.distill_teacher is not None:
+        from distill import train_distilled_student
+        teacher = torch.load(args.distill_teacher, weights_only=False)
+        decoder = train_distilled_student(teacher, train_data_indexed, dev_data_indexed, input_indexer, output_indexer, args)
+    else:
+        decoder = train_model_encdec(train_data_indexed, dev_data_indexed, input_indexer, output_indexer, args)
+    if args.ensemble_paths is None and not args.eval_from_checkpoint:
+        if anonymizer is not None:
+            decoder.anonymizer = anonymizer
+        torch.save(decoder, args.model_path)
+    for parser in [decoder] if teacher is None else [decoder, teacher]:
+        if args.constrained_decoding:
+            parser.grammar_constraint = LFGrammarConstraint(parser.output_indexer)
+        # Speculative decoding is implemented for the LSTM backend only
+        if args.speculative_decoding and isinstance(parser, Seq2SeqSemanticParser):
+            parser.draft_parser = NearestNeighborSemanticParser(train_data_indexed)
+        if args.fused_inference and isinstance(parser, Seq2SeqSemanticParser):
+            parser.fused_inference = True
+        if args.output_shortlist and isinstance(parser, (Seq2SeqSemanticParser, TransformerSemanticParser)):
+            parser.output_shortlist = OutputShortlist(parser.input_indexer, parser.output_indexer, train_data_indexed,
+                                                      load_geobase_entities() if args.domain == 'geo' else None)
+            print("Output shortlist: %i structural symbols of %i; gold output within the shortlist on %.3f of dev" %
+                  (len(parser.output_shortlist.structural), len(parser.output_indexer),
+                   parser.output_shortlist.coverage(dev_data_indexed)))
+    if teacher is not None:
+        from distill import report_distillation_tradeoff
+        print("=======DISTILLATION TRADE-OFF ON DEV=======")
+        report_distillation_tradeoff(teacher, decoder, dev_data_indexed, use_java=args.perform_java_eval)
+    return decoder
+
+
+def print_speculative_stats(decoder):
+    """
+    Prints how much work speculative decoding (--speculative_decoding) saved per example over the decode calls since
+    the decoder's decode_stats were last cleared, e.g. all the batches of one pipelined evaluation
+    """
+    stats = getattr(decoder, 'decode_stats', None)
+    if getattr(decoder, 'draft_parser', None) is None or stats is None or stats['examples'] == 0:
+        return
+    num_examples = stats['examples']
+    print("Speculative decoding: %.2f of %.2f draft tokens accepted on average; %.2f sequential decoder calls per "
+          "example (greedy decoding: %.2f)" % (stats['accepted'] / num_examples, stats['draft'] / num_examples,
+                                              stats['decoder_calls'] / num_examples,
+                                              stats['greedy_calls'] / num_examples))
+
+
+def clear_decode_stats(decoder):
+    if getattr(decoder, 'decode_stats', None) is not None:
+        decoder.decode_stats.clear()
+
+
+def print_eval_progress(num_done, num_examples):
+    if num_done % 100 == 0 or num_done == num_examples:
+        print("Executed %i / %i examples" % (num_done, num_examples))
+
 
-    train, dev, test = load_datasets(args.train_path, args.dev_path, args.test_path, domain=args.domain)
+def saved_anonymizer(args, saved):
+    """
+    Data has to be indexed with the entity anonymization the saved models it is used with were trained with
+    :param saved: (path, model) pairs of the saved models the run evaluates or fine-tunes
+    :return: the EntityAnonymizer to index the data with, if --anonymize_entities: the one saved with the models, or a
+    new one if there are none
+    """
+    anonymizer = None
+    for path, model in saved:
+        model_anonymizer = getattr(model, 'anonymizer', None)
+        if (model_anonymizer is not None) != args.anonymize_entities:
+            trained_with = "with" if model_anonymizer is not None else "without"
+            raise ValueError("%s was trained %s entity anonymization; run %s --anonymize_entities" %
+                             (path, trained_with, trained_with))
+        if anonymizer is None:
+            anonymizer = model_anonymizer
+    if anonymizer is None and args.anonymize_entities:
+        from entities import EntityAnonymizer
+        anonymizer = EntityAnonymizer.from_geobase()
+    return anonymizer
+
+
+def dump_prefix(prefix, split):
+    return prefix + '.' + split if prefix is not None else None
+
+
+def run(args):
+    """
+    Loads and indexes the data, trains (or loads) the model and evaluates it on the dev and blind test sets
+    :param args: the parsed args bundle
+    """
+    # Load the training and test data
+    with PROFILER.phase("load_data"):
+        train, dev, test = load_datasets(args.train_path, args.dev_path, args.test_path, domain=args.domain)
     # print("\ntraining data [:5]:\n", train[:5])
 
+    # Fine-tuning starts from the vocabularies of the model being fine-tuned and extends them with the new data. Saved
+    # models are loaded before indexing since the data has to be anonymized the way they were trained.
+    base_model = None
+    saved_models = None
+    saved = []
+    if args.warm_start is not None:
+        import torch
+        base_model = torch.load(args.warm_start, weights_only=False)
+        saved.append((args.warm_start, base_model))
+    if args.from_predictions is None and (args.ensemble_paths is not None or args.eval_from_checkpoint):
+        import torch
+        paths = args.ensemble_paths if args.ensemble_paths is not None else [args.model_path]
+        saved_models = [torch.load(path, weights_only=False) for path in paths]
+        saved.extend(zip(paths, saved_models))
+    anonymizer = saved_anonymizer(args, saved)
     # literally tokenizes and then indexes both input and output
-    train_data_indexed, dev_data_indexed, test_data_indexed, input_indexer, output_indexer = index_datasets(train, dev, test, args.decoder_len_limit)
+    with PROFILER.phase("data_indexing"):
+        if base_model is not None:
+            train_data_indexed, dev_data_indexed, test_data_indexed, input_indexer, output_indexer = index_datasets(
+                train, dev, test, args.decoder_len_limit, input_indexer=base_model.input_indexer, output_indexer=base_model.output_indexer,
+                anonymizer=anonymizer)
+        else:
+            train_data_indexed, dev_data_indexed, test_data_indexed, input_indexer, output_indexer = index_datasets(
+                train, dev, test, args.decoder_len_limit, anonymizer=anonymizer)
     print("%i train exs, %i dev exs, %i input types, %i output types" % (len(train_data_indexed), len(dev_data_indexed), len(input_indexer), len(output_indexer)))
     if args.print_dataset:
         print("Input indexer: %s" % input_indexer)
@@ -52,17 +195,47 @@ if __name__ == '__main__':
         print("Here are some examples post tokenization and indexing:")
         for i in range(0, min(len(train_data_indexed), 10)):
             print(train_data_indexed[i])
-    if not args.eval_from_checkpoint:
-        if args.do_nearest_neighbor:
-            decoder = NearestNeighborSemanticParser(train_data_indexed)
-        else:
-            decoder = train_model_encdec(train_data_indexed, dev_data_indexed, input_indexer, output_indexer, args)
-            torch.save(decoder, args.model_path)
+    dev_predictions = test_predictions = None
+    if args.from_predictions is not None:
+        from predictions import PredictionStore
+        decoder = None
+        dev_predictions = PredictionStore(args.from_predictions + '.dev')
+        test_predictions = PredictionStore(args.from_predictions + '.test')
+    elif args.do_nearest_neighbor and not args.eval_from_checkpoint and args.ensemble_paths is None:
+        decoder = NearestNeighborSemanticParser(train_data_indexed)
     else:
-        decoder = torch.load(args.model_path)
+        decoder = build_neural_decoder(args, train_data_indexed, dev_data_indexed, input_indexer, output_indexer, base_model,
+                                       anonymizer, saved_models)
     print("=======DEV SET=======")
-    evaluate(dev_data_indexed, decoder, use_java=args.perform_java_eval)
+    progress_fn = print_eval_progress if args.stream_java_eval else None
+    clear_decode_stats(decoder)
+    evaluate(dev_data_indexed, decoder, use_java=args.perform_java_eval, pipeline_batch_size=args.eval_pipeline_batch,
+             streaming=args.stream_java_eval, progress_fn=progress_fn, staged=args.staged_java_eval,
+             predictions=dev_predictions, dump_predictions=dump_prefix(args.dump_predictions, 'dev'),
+             example_freq=args.example_freq, num_sampled_examples=args.print_sampled_examples,
+             bootstrap_samples=args.bootstrap_samples)
+    print_speculative_stats(decoder)
     print("=======FINAL PRINTING ON BLIND TEST=======")
-    evaluate(test_data_indexed, decoder, print_output=True, outfile="geo_test_output.tsv", use_java=args.perform_java_eval)
+    clear_decode_stats(decoder)
+    evaluate(test_data_indexed, decoder, print_output=True, outfile="geo_test_output.tsv", use_java=args.perform_java_eval,
+             pipeline_batch_size=args.eval_pipeline_batch, streaming=args.stream_java_eval, progress_fn=progress_fn,
+             staged=args.staged_java_eval, predictions=test_predictions,
+             dump_predictions=dump_prefix(args.dump_predictions, 'test'), example_freq=args.example_freq,
+             num_sampled_examples=args.print_sampled_examples, bootstrap_samples=args.bootstrap_samples)
+    print_speculative_stats(decoder)
 
 
+if __name__ == '__main__':
+    args = _parse_args()
+    print(args)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    if args.profile_report is not None:
+        PROFILER.enable()
+    if args.profile_trace is not None:
+        with Tracer(args.profile_trace):
+            run(args)
+    else:
+        run(args)
+    if args.profile_report is not None:
+        PROFILER.write_report(args.profile_report)
@@ -0,0 +1,51 @@
+# model_args.py
+# Command-line flags of the models, kept free of torch imports so entry points can build their parsers (and run the
+# nearest-neighbor baseline) without initializing torch.
+
+def add_models_args(parser):
+    """
+    Command-line arguments to the system related to your model.  Feel free to extend here.  
+    """
+    # Some common arguments for your convenience
+    parser.add_argument('--seed', type=int, default=0, help='RNG seed (default = 0)')
+    parser.add_argument('--epochs', type=int, default=20, help='num epochs to train for')
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--batch_size', type=int, default=2, help='batch size')
+
+    # 65 is all you need for GeoQuery
+    parser.add_argument('--decoder_len_limit', type=int, default=65, help='output length limit of the decoder')
+    # Memory-bounded training of the LSTM model (see Seq2SeqSemanticParser.memory_bounded_loss)
+    parser.add_argument('--activation_chunk_len', type=int, default=0, help='checkpoint decoder activations in chunks of this many steps, recomputing them during backward (0 = off)')
+    parser.add_argument('--truncated_bptt', default=False, action='store_true', help='also stop gradients at chunk boundaries, backpropagating each chunk as soon as it is decoded')
+    parser.add_argument('--report_train_memory', default=False, action='store_true', help='print peak activation memory (tensors saved for backward) and peak RSS after each epoch')
+    parser.add_argument('--sparse_embeddings', default=False, action='store_true', help='sparse gradients for the input/output embedding tables, updated with SparseAdam (dense Adam for the other parameters)')
+    # Knowledge distillation of a smaller student from a trained teacher (see distill.py)
+    parser.add_argument('--distill_teacher', type=str, default=None, help='path to a trained teacher model; trains a student against its soft outputs instead of training from scratch')
+    parser.add_argument('--student_emb_dim', type=int, default=100, help='embedding size of the distilled student')
+    parser.add_argument('--student_hidden_size', type=int, default=128, help='hidden size of the distilled student')
+    parser.add_argument('--distill_alpha', type=float, default=0.5, help='weight of the gold cross-entropy; the teacher KL term gets 1 - alpha')
+    parser.add_argument('--distill_temperature', type=float, default=2.0, help='softmax temperature for the teacher/student KL term')
+    parser.add_argument('--distill_unlabeled_path', type=str, default=None, help='file of extra questions (one per line, or tsv with the question first) labeled by the teacher\'s greedy outputs')
+    # Warm-start fine-tuning of a trained model on new data (see finetune.py)
+    parser.add_argument('--warm_start', type=str, default=None, help='path to a trained model to fine-tune on --train_path, extending its vocabularies with the new tokens')
+    parser.add_argument('--replay_path', type=str, default=None, help='old training data to mix into fine-tuning')
+    parser.add_argument('--replay_ratio', type=float, default=1.0, help='replayed old examples per new example when --replay_path is given')
+    parser.add_argument('--speculative_decoding', default=False, action='store_true', help='verify the nearest-neighbor logical form as a draft before decoding step by step (same output as greedy decoding)')
+    parser.add_argument('--constrained_decoding', default=False, action='store_true', help='only let the decoder produce well-formed logical forms (balanced parentheses and quotes, valid variable references)')
+    parser.add_argument('--fused_inference', default=False, action='store_true', help='decode the LSTM model with embeddings folded into per-token LSTM input gate tables (same output, lower per-token cost)')
+    parser.add_argument('--output_shortlist', default=False, action='store_true', help='score only the structural output symbols and the constants retrieved from the question at each decoder step')
+
+    # Feel free to add other hyperparameters for your input dimension, etc. to control your network
+    # 50-200 might be a good range to start with for embedding and LSTM sizes
+    parser.add_argument('--emb_dim', type=int, default=300, help='input and output embedding size')
+    parser.add_argument('--pretrained_embeddings', type=str, default=None, help='prefix of pretrained vectors converted with pretrained.py (.npy + .vocab) to initialize the input embeddings from; their dimension must equal --emb_dim')
+    parser.add_argument('--hidden_size', type=int, default=256, help='encoder and decoder LSTM hidden size (feed-forward size for the transformer)')
+    parser.add_argument('--model_type', type=str, default='lstm', choices=['lstm', 'transformer'], help='LSTM encoder-decoder with attention, or transformer encoder-decoder')
+    parser.add_argument('--num_layers', type=int, default=2, help='encoder and decoder layers of the transformer')
+    parser.add_argument('--num_heads', type=int, default=4, help='attention heads of the transformer (must divide --emb_dim)')
+
+    # Checkpointing: periodically save everything needed to continue a killed run exactly where it stopped
+    parser.add_argument('--checkpoint_dir', type=str, default=None, help='directory for training checkpoints (default: no checkpointing)')
+    parser.add_argument('--checkpoint_every', type=int, default=100, help='write a checkpoint every this many batches (and at the end of every epoch)')
+    parser.add_argument('--keep_checkpoints', type=int, default=3, help='number of most recent checkpoints to keep')
+    parser.add_argument('--resume', default=False, action='store_true', help='resume training from the newest checkpoint in --checkpoint_dir')
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import random
 from torch.autograd import Variable as Var
 from torch.utils.data import TensorDataset, DataLoader
@@ -10,56 +11,18 @@ from lf_evaluator import *
 import numpy as np
 from typing import List
 import time
+from collections import Counter
+from contextlib import nullcontext
+from checkpoint import *
+from profiling import *
+# Torch-free parts of the model code, re-exported so `from models import *` keeps providing them
+from model_args import *
+from nearest_neighbor import *
+from shortlist import *
 
-def add_models_args(parser):
-    """
-    Command-line arguments to the system related to your model.  Feel free to extend here.  
-    """
-    # Some common arguments for your convenience
-    parser.add_argument('--seed', type=int, default=0, help='RNG seed (default = 0)')
-    parser.add_argument('--epochs', type=int, default=10, help='num epochs to train for')
-    parser.add_argument('--lr', type=float, default=1e-3)
-    parser.add_argument('--batch_size', type=int, default=2, help='batch size')
-
-    # 65 is all you need for GeoQuery
-    parser.add_argument('--decoder_len_limit', type=int, default=65, help='output length limit of the decoder')
-
-    # Feel free to add other hyperparameters for your input dimension, etc. to control your network
-    # 50-200 might be a good range to start with for embedding and LSTM sizes
-
+# Maximum number of tokens produced for one example at decoding time
+MAX_DECODE_LEN = 100
 
-class NearestNeighborSemanticParser(object):
-    """
-    Semantic parser that uses Jaccard similarity to find the most similar input example to a particular question and
-    returns the associated logical form.
-    """
-    def __init__(self, training_data: List[Example]):
-        self.training_data = training_data
-
-    def decode(self, test_data: List[Example]) -> List[List[Derivation]]:
-        """
-        :param test_data: List[Example] to decode
-        :return: A list of k-best lists of Derivations. A Derivation consists of the underlying Example, a probability,
-        and a tokenized input string. If you're just doing one-best decoding of example ex and you
-        produce output y_tok, you can just return the k-best list [Derivation(ex, 1.0, y_tok)]
-        """
-        test_derivs = []
-        for test_ex in test_data:
-            test_words = test_ex.x_tok
-            best_jaccard = -1
-            best_train_ex = None
-            # Find the highest word overlap with the train data
-            for train_ex in self.training_data:
-                # Compute word overlap with Jaccard similarity
-                train_words = train_ex.x_tok
-                overlap = len(frozenset(train_words) & frozenset(test_words))
-                jaccard = overlap/float(len(frozenset(train_words) | frozenset(test_words)))
-                if jaccard > best_jaccard:
-                    best_jaccard = jaccard
-                    best_train_ex = train_ex
-            # Note that this is a list of a single Derivation
-            test_derivs.append([Derivation(test_ex, 1.0, best_train_ex.y_tok)])
-        return test_derivs
 
 class Seq2SeqSemanticParser(nn.Module):
     def __init__(self, input_indexer, output_indexer, emb_dim, hidden_size, embedding_dropout=0.2, bidirect=True):
@@ -80,6 +43,8 @@ class Seq2SeqSemanticParser(nn.Module):
         # self.decoder = RNNDecoder(emb_dim, hidden_size, len(output_indexer))
 
         self.loss_func = nn.CrossEntropyLoss()
+        # Counts of decoded examples, decoder calls and accepted draft tokens, summed over calls to decode until cleared
+        self.decode_stats = Counter()
 
     def forward(self, x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor, batch_size):
         """
@@ -92,13 +57,15 @@ class Seq2SeqSemanticParser(nn.Module):
 
         #################
 
-        embedded_input = self.input_emb(x_tensor)
-        encoder_output, _, h_t = self.encoder(embedded_input, inp_lens_tensor)
+        with PROFILER.phase("encoder_forward"):
+            embedded_input = self.input_emb(x_tensor)
+            encoder_output, _, h_t = self.encoder(embedded_input, inp_lens_tensor)
 
         token = self.output_indexer.index_of("<SOS>")
         h, c = h_t[0], h_t[1]
 
-        iter_loss = []
+        # One running loss tensor rather than a list of per-token losses to sum at the end
+        batch_loss = 0
 
         for batch in range(batch_size):
             start = self.output_emb(torch.LongTensor([[token]]))
@@ -106,58 +73,277 @@ class Seq2SeqSemanticParser(nn.Module):
 
             for idx in range(out_lens_tensor[batch]):
                 enc_out = encoder_output[:inp_lens_tensor[batch],batch,:].unsqueeze(0)
-                cell_output, _,(h1,c1) = self.decoder(start,h1,c1,(torch.tensor([1])), enc_out)
+                with PROFILER.phase("decoder_step"):
+                    cell_output, _,(h1,c1) = self.decoder(start,h1,c1,(torch.tensor([1])), enc_out)
 
                 target = y_tensor[batch][idx]
                 start = self.output_emb(target.unsqueeze(0).unsqueeze(0))
-                loss = self.loss_func(cell_output, y_tensor[batch][idx].unsqueeze(0).detach())
-                iter_loss.append(loss)
-        batch_loss = np.sum(iter_loss)
+                with PROFILER.phase("loss"):
+                    loss = self.loss_func(cell_output, y_tensor[batch][idx].unsqueeze(0).detach())
+                batch_loss = batch_loss + loss
 
         return batch_loss
 
+    def memory_bounded_loss(self, x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor, chunk_len: int, truncate=False):
+        """
+        Same loss as forward, computed so that training memory stays bounded as outputs and batches grow. Each
+        example's decoder runs in chunks of chunk_len teacher-forced steps under activation checkpointing: only the
+        states between chunks are kept for backward and each chunk's activations are recomputed during it. With
+        truncate (truncated backpropagation through time), gradients also stop at chunk boundaries and every chunk is
+        backpropagated as soon as it is decoded, so at most one chunk's graph is alive at a time; the encoder's gradient
+        is collected on detached copies of its outputs and backpropagated through it once at the end.
+        :param x_tensor/y_tensor: [batch size x sent len] padded input/gold output indices
+        :param inp_lens_tensor/out_lens_tensor: [batch size] input/output lengths
+        :return: the batch loss. With truncate, backward has already been run and the loss returned is detached.
+        """
+        with PROFILER.phase("encoder_forward"):
+            embedded_input = self.input_emb(x_tensor)
+            encoder_output, _, (h, c) = self.encoder(embedded_input, inp_lens_tensor)
+        if truncate:
+            enc_leaf, h_leaf, c_leaf = [t.detach().requires_grad_() for t in [encoder_output, h, c]]
+        else:
+            enc_leaf, h_leaf, c_leaf = encoder_output, h, c
+        sos = torch.LongTensor([self.output_indexer.index_of(SOS_SYMBOL)])
+        batch_loss = torch.zeros(())
+        for b in range(x_tensor.shape[0]):
+            out_len = out_lens_tensor[b].item()
+            y_in = torch.cat([sos, y_tensor[b, :out_len - 1]])
+            h1, c1 = h_leaf[b].view(1, 1, -1), c_leaf[b].view(1, 1, -1)
+            for start in range(0, out_len, chunk_len):
+                end = min(start + chunk_len, out_len)
+                enc_out = enc_leaf[:inp_lens_tensor[b], b, :].unsqueeze(0)
+                with PROFILER.phase("decoder_step"):
+                    chunk_loss, h1, c1 = torch.utils.checkpoint.checkpoint(self._decoder_chunk_loss, y_in[start:end],
+                                                                           y_tensor[b, start:end], h1, c1, enc_out,
+                                                                           use_reentrant=False)
+                if truncate:
+                    with PROFILER.phase("backward"):
+                        chunk_loss.backward()
+                    h1, c1 = h1.detach(), c1.detach()
+                    batch_loss += chunk_loss.detach()
+                else:
+                    batch_loss = batch_loss + chunk_loss
+        if truncate:
+            grads = [(t, leaf.grad) for t, leaf in [(encoder_output, enc_leaf), (h, h_leaf), (c, c_leaf)]
+                     if leaf.grad is not None]
+            with PROFILER.phase("backward"):
+                torch.autograd.backward([t for t, grad in grads], [grad for t, grad in grads])
+        return batch_loss
+
+    def _decoder_chunk_loss(self, y_in, y_out, h, c, enc_out):
+        """
+        Teacher-forced decoder steps over one chunk of an output
+        :param y_in: [chunk len] decoder inputs (previous gold tokens)
+        :param y_out: [chunk len] gold tokens
+        :return: the summed cross-entropy of the chunk and the decoder states after it
+        """
+        logits, _, (h, c) = self.decoder(self.output_emb(y_in.unsqueeze(0)), h, c, None, enc_out)
+        return F.cross_entropy(logits, y_out, reduction='sum'), h, c
+
+
+    def teacher_forced_logits(self, x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor):
+        """
+        Scores the gold outputs with one decoder pass per example (the attention decoder handles whole sequences)
+        :param x_tensor/y_tensor: [batch size x sent len] padded input/gold output indices
+        :param inp_lens_tensor/out_lens_tensor: [batch size] input/output lengths
+        :return: [batch size x max out len x output vocab size] logits of each gold position (zeros past the end)
+        """
+        embedded_input = self.input_emb(x_tensor)
+        encoder_output, _, (h, c) = self.encoder(embedded_input, inp_lens_tensor)
+        max_out_len = out_lens_tensor.max().item()
+        sos = torch.LongTensor([self.output_indexer.index_of(SOS_SYMBOL)])
+        all_logits = []
+        for b in range(x_tensor.shape[0]):
+            out_len = out_lens_tensor[b].item()
+            y_in = torch.cat([sos, y_tensor[b, :out_len - 1]]).unsqueeze(0)
+            enc_out = encoder_output[:inp_lens_tensor[b], b, :].unsqueeze(0)
+            logits, _, _ = self.decoder(self.output_emb(y_in), h[b].view(1, 1, -1), c[b].view(1, 1, -1), None, enc_out)
+            all_logits.append(F.pad(logits, (0, 0, 0, max_out_len - out_len)))
+        return torch.stack(all_logits)
 
     def decode(self, test_data: List[Example]) -> List[List[Derivation]]:
+        """
+        Greedy decoding, one example at a time. Runs with dropout off and without building autograd graphs. If the model
+        has a draft_parser (see speculative_decode), the draft it retrieves for each example is verified first.
+        Counts of the work done are added to decode_stats (see print_speculative_stats).
+        :param test_data: List[Example] to decode
+        :return: a one-best list of Derivations for each example
+        """
 
         #################
 
+        self.eval()
         unpacked =  []
+        # Models pickled before speculative decoding existed don't have the attribute
+        draft_parser = getattr(self, 'draft_parser', None)
+        if getattr(self, 'decode_stats', None) is None:
+            self.decode_stats = Counter()
+        self.decode_stats['examples'] += len(test_data)
+
+        with torch.no_grad():
+            for ex in test_data:
+                if draft_parser is not None:
+                    entry_word, prob = self.speculative_decode(ex, draft_parser.retrieve(ex).y_indexed)
+                else:
+                    entry_word, prob = self.greedy_decode(ex)
+                with PROFILER.phase("detokenize"):
+                    predicted = list(map(lambda x: self.output_indexer.get_object(x),entry_word))
+                PROFILER.count("decode_examples")
+                PROFILER.count("decode_tokens", len(entry_word) + 1)
+                unpacked.append([Derivation(ex, np.exp(prob), predicted)])
 
-        for ex in test_data:
-            entry_word = []
+        return unpacked
+
+    def encode_example(self, ex: Example):
+        """
+        :param ex: Example to encode
+        :return: the encoder outputs ([1 x sent len x hidden]) for attention and the initial decoder states h and c
+        """
+        tables = self._gate_tables()
+        if tables is not None:
+            with PROFILER.phase("encoder_forward"):
+                return tables.encode(ex.x_indexed)
+        with PROFILER.phase("encoder_forward"):
             x_tensor = self.input_emb(torch.LongTensor(ex.x_indexed).unsqueeze(0))
             input_len = torch.LongTensor([len(ex.x_indexed)])
 
             ### get encoded output and hidden state (discard context mask)
             enc_out, _, h_t = self.encoder(x_tensor, input_len)
+        enc_output = enc_out[:len(ex.x_indexed), :].permute([1, 0, 2])
 
-            #### separate hidden and cell states
-            h_n = h_t[0].unsqueeze(0)
-            c_n = h_t[1].unsqueeze(0)
-
-            token = self.output_indexer.index_of("<SOS>")
-            end_token = self.output_indexer.index_of("<EOS>")
-
-            prob = 0
-            count = 0
+        #### separate hidden and cell states
+        h_n = h_t[0].unsqueeze(0)
+        c_n = h_t[1].unsqueeze(0)
+        return enc_output, h_n, c_n
 
-            while token != end_token and count < 100:
-                emb = self.output_emb(torch.LongTensor([[token]]))
-                enc_output = enc_out[:len(ex.x_indexed), :].permute([1, 0, 2])
-                output, _, (h_n,c_n) = self.decoder(emb, h_n, c_n, torch.LongTensor([1]), enc_output)
-                prob += torch.max(F.log_softmax(output, dim=1))
-                token = torch.argmax(output)
-
-                if token.item() == end_token:
-                    break
+    def greedy_decode(self, ex: Example):
+        """
+        :param ex: Example to decode
+        :return: the predicted output token indices (without EOS) and their total log probability. If the model has a
+        grammar_constraint (see LFGrammarConstraint), only well-formed logical forms can be produced.
+        """
+        enc_output, h_n, c_n = self.encode_example(ex)
+        constraint = self._grammar_constraint()
+        state = constraint.initial_states(1) if constraint is not None else None
+        return self._continue_greedy(enc_output, h_n, c_n, self.output_indexer.index_of(SOS_SYMBOL), [], 0.0, state,
+                                     self._restrict_outputs(ex))
 
-                entry_word.append(token.item())
-                count += 1
+    def _grammar_constraint(self):
+        # Models pickled before constrained decoding existed don't have the attribute
+        return getattr(self, 'grammar_constraint', None)
 
-            predicted = list(map(lambda x: self.output_indexer.get_object(x),entry_word))
-            unpacked.append([Derivation(ex, np.exp(prob.detach()), predicted)])
+    def _restrict_outputs(self, ex: Example):
+        """
+        :return: the shortlist output indices and (weight, bias) of the output projection for ex if the model has an
+        output_shortlist (see OutputShortlist), None otherwise
+        """
+        shortlist = getattr(self, 'output_shortlist', None)
+        if shortlist is None:
+            return None
+        return shortlist.restrict(ex, self.decoder.W)
 
-        return unpacked
+    def _gate_tables(self):
+        """
+        :return: FusedGateTables for the current weights if fused_inference is set (rebuilt whenever the weights have
+        changed since they were computed), None otherwise
+        """
+        if not getattr(self, 'fused_inference', False) or self.encoder.bidirect:
+            return None
+        tables = getattr(self, 'gate_tables', None)
+        if tables is None or tables.is_stale(self):
+            tables = self.gate_tables = FusedGateTables(self)
+        return tables
+
+    def _continue_greedy(self, enc_output, h_n, c_n, token, entry_word, prob, state, restricted=None):
+        """
+        Runs greedy decoding step by step from a partial output
+        :param token: the last token of the partial output (SOS if empty), fed to the next decoder step
+        :param h_n/c_n: decoder states after consuming the partial output up to (not including) token
+        :param entry_word: partial output (extended in place)
+        :param prob: log probability of the partial output
+        :param state: grammar constraint state after the partial output, or None if unconstrained
+        :param restricted: output indices and output projection to decode with, from _restrict_outputs
+        :return: the complete output token indices (without EOS) and their log probability
+        """
+        end_token = self.output_indexer.index_of(EOS_SYMBOL)
+        constraint = self._grammar_constraint()
+        tables = self._gate_tables()
+        ids, out_weights = restricted if restricted is not None else (None, None)
+        while len(entry_word) < MAX_DECODE_LEN:
+            with PROFILER.phase("decoder_step"):
+                if tables is not None:
+                    output, h_n, c_n = tables.decoder_step(token, h_n, c_n, enc_output, out_weights)
+                else:
+                    emb = self.output_emb(torch.LongTensor([[token]]))
+                    output, _, (h_n,c_n) = self.decoder(emb, h_n, c_n, torch.LongTensor([1]), enc_output, out_weights)
+                if constraint is not None:
+                    output = constraint.apply(output, state, MAX_DECODE_LEN - len(entry_word), ids)
+                prob += torch.max(F.log_softmax(output, dim=1)).item()
+                token = torch.argmax(output).item()
+                if ids is not None:
+                    token = ids[token].item()
+            self.decode_stats['decoder_calls'] += 1
+            self.decode_stats['greedy_calls'] += 1
+
+            if token == end_token:
+                break
+            if constraint is not None:
+                state = constraint.advance(state, torch.LongTensor([token]))
+            entry_word.append(token)
+        return entry_word, prob
+
+    def speculative_decode(self, ex: Example, draft: List[int]):
+        """
+        Greedy decoding that first verifies a draft output (e.g., the logical form of the nearest training example)
+        with a single teacher-forced decoder pass: the longest prefix of the draft on which the model's argmax agrees is
+        accepted at once, the model's own token at the first disagreement comes for free, and step-by-step greedy
+        decoding only resumes from there. Produces the same output as greedy_decode, with far fewer sequential decoder
+        calls when the draft is good.
+        :param ex: Example to decode
+        :param draft: indexed draft output, ending in EOS like Example.y_indexed
+        :return: the predicted output token indices (without EOS) and their total log probability
+        """
+        if len(draft) == 0:
+            return self.greedy_decode(ex)
+        enc_output, h_n, c_n = self.encode_example(ex)
+        end_token = self.output_indexer.index_of(EOS_SYMBOL)
+        constraint = self._grammar_constraint()
+        restricted = self._restrict_outputs(ex)
+        ids, out_weights = restricted if restricted is not None else (None, None)
+        # Greedy decoding never looks at more than MAX_DECODE_LEN positions
+        draft = list(draft[:MAX_DECODE_LEN])
+        inputs = torch.LongTensor([[self.output_indexer.index_of(SOS_SYMBOL)] + draft[:-1]])
+        with PROFILER.phase("decoder_step"):
+            emb = self.output_emb(inputs)
+            output, _, _ = self.decoder(emb, h_n, c_n, None, enc_output, out_weights)
+            if constraint is not None:
+                states = constraint.states_along(draft[:-1])
+                output = constraint.apply(output, states, MAX_DECODE_LEN - torch.arange(len(draft)), ids)
+            log_probs, argmax = torch.max(F.log_softmax(output, dim=1), dim=1)
+            if ids is not None:
+                argmax = ids[argmax]
+        self.decode_stats['decoder_calls'] += 1
+        self.decode_stats['draft'] += len(draft)
+
+        disagree = (argmax != torch.LongTensor(draft)).nonzero()
+        accepted = disagree[0].item() if len(disagree) > 0 else len(draft)
+        self.decode_stats['accepted'] += accepted
+        # Greedy decoding would produce the accepted prefix plus the model's own token at the first disagreement
+        tokens = argmax[:min(accepted + 1, len(draft))].tolist()
+        if end_token in tokens:
+            tokens = tokens[:tokens.index(end_token) + 1]
+        prob = log_probs[:len(tokens)].sum().item()
+        self.decode_stats['greedy_calls'] += len(tokens)
+        if tokens[-1] == end_token:
+            return tokens[:-1], prob
+        if len(tokens) == MAX_DECODE_LEN:
+            return tokens, prob
+        # Recover the decoder states after the accepted prefix with one more (parallel in time) pass
+        with PROFILER.phase("decoder_step"):
+            _, (h_n, c_n) = self.decoder.rnn(emb[:, :len(tokens)], (h_n, c_n))
+        self.decode_stats['decoder_calls'] += 1
+        state = constraint.states_along(tokens)[-1:] if constraint is not None else None
+        return self._continue_greedy(enc_output, h_n, c_n, tokens[-1], tokens, prob, state, restricted)
 
         #################
 
@@ -192,20 +378,101 @@ class Seq2SeqSemanticParser(nn.Module):
         return (enc_output_each_word, enc_context_mask, enc_final_states_reshaped)
 
 
+class FusedGateTables(object):
+    """
+    Inference-only rewrite of Seq2SeqSemanticParser's batch-1 encoder and decoder steps. With dropout off, an
+    embedding lookup followed by the LSTM input projection is a fixed function of the token, so
+    emb @ W_ih^T + b_ih + b_hh is precomputed for every token of each (small) vocabulary. A step is then a row
+    gather plus the recurrent h @ W_hh^T, instead of EmbeddingLayer, nn.LSTM and the input matmul.
+
+    Attributes:
+        enc_gates: [input vocab size x 4 * hidden] encoder input gate pre-activations of each input token
+        dec_gates: [output vocab size x 4 * hidden] decoder input gate pre-activations of each output token
+        enc_w_hh/dec_w_hh: transposed recurrent weights, [hidden x 4 * hidden]
+    """
+    def __init__(self, model: 'Seq2SeqSemanticParser'):
+        enc_rnn, dec_rnn = model.encoder.rnn, model.decoder.rnn
+        self.sources = self._sources(model)
+        self.versions = [p._version for p in self.sources]
+        with torch.no_grad():
+            self.enc_gates = F.linear(model.input_emb.word_embedding.weight, enc_rnn.weight_ih_l0,
+                                      enc_rnn.bias_ih_l0 + enc_rnn.bias_hh_l0)
+            self.dec_gates = F.linear(model.output_emb.word_embedding.weight, dec_rnn.weight_ih_l0,
+                                      dec_rnn.bias_ih_l0 + dec_rnn.bias_hh_l0)
+            self.enc_w_hh = enc_rnn.weight_hh_l0.t().contiguous()
+            self.dec_w_hh = dec_rnn.weight_hh_l0.t().contiguous()
+        self.W = model.decoder.W
+        self.hidden_size = enc_rnn.hidden_size
+
+    @staticmethod
+    def _sources(model):
+        return [model.input_emb.word_embedding.weight, model.output_emb.word_embedding.weight] + \
+               list(model.encoder.rnn.parameters()) + list(model.decoder.rnn.parameters())
+
+    def is_stale(self, model) -> bool:
+        """
+        :return: True if the weights the tables were computed from have been replaced or updated in place since
+        """
+        sources = self._sources(model)
+        return len(sources) != len(self.sources) or \
+            any(p is not q or p._version != v for p, q, v in zip(sources, self.sources, self.versions))
+
+    @staticmethod
+    def _lstm_cell(gates_x, h, c, w_hh):
+        # PyTorch orders the gates input, forget, cell, output
+        gates = torch.addmm(gates_x, h, w_hh)
+        i, f, g, o = gates.chunk(4, dim=1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        return h, c
+
+    def encode(self, x_indexed: List[int]):
+        """
+        Same as Seq2SeqSemanticParser.encode_example for the (unidirectional) encoder
+        :return: the encoder outputs [1 x sent len x hidden] and the final states h and c, [1 x 1 x hidden] each
+        """
+        gates_x = self.enc_gates[torch.LongTensor(x_indexed)]
+        h = c = torch.zeros(1, self.hidden_size)
+        outputs = []
+        for t in range(len(x_indexed)):
+            h, c = self._lstm_cell(gates_x[t:t + 1], h, c, self.enc_w_hh)
+            outputs.append(h)
+        return torch.cat(outputs).unsqueeze(0), h.unsqueeze(0), c.unsqueeze(0)
+
+    def decoder_step(self, token: int, h_n, c_n, enc_output, out_weights=None):
+        """
+        Same as embedding token with output_emb and running RNNAttentionDecoder on it
+        :param h_n/c_n: decoder states, [1 x 1 x hidden]
+        :param enc_output: [1 x sent len x hidden] encoder outputs
+        :param out_weights: (weight, bias) rows of W to score instead of the full output vocabulary, or None
+        :return: the output logits [1 x output vocab size] and the new states h and c
+        """
+        h, c = self._lstm_cell(self.dec_gates[token:token + 1], h_n[0], c_n[0], self.dec_w_hh)
+        enc_outputs = enc_output[0]
+        with PROFILER.phase("attention"):
+            prob = F.softmax(torch.mv(enc_outputs, h[0]), dim=0)
+            attention = torch.mv(enc_outputs.t(), prob)
+        features = torch.cat([h[0], attention]).unsqueeze(0)
+        logits = F.linear(features, *out_weights) if out_weights is not None else self.W(features)
+        return logits, h.unsqueeze(0), c.unsqueeze(0)
+
+
 class EmbeddingLayer(nn.Module):
     """
     Embedding layer that has a lookup table of symbols that is [full_dict_size x input_dim]. Includes dropout.
     Works for both non-batched and batched inputs
     """
-    def __init__(self, input_dim: int, full_dict_size: int, embedding_dropout_rate: float):
+    def __init__(self, input_dim: int, full_dict_size: int, embedding_dropout_rate: float, sparse=False):
         """
         :param input_dim: dimensionality of the word vectors
         :param full_dict_size: number of words in the vocabulary
         :param embedding_dropout_rate: dropout rate to apply
+        :param sparse: produce sparse gradients covering only the rows looked up (needs a sparse-aware optimizer, see
+        make_optimizer); can also be switched later through word_embedding.sparse
         """
         super(EmbeddingLayer, self).__init__()
         self.dropout = nn.Dropout(embedding_dropout_rate)
-        self.word_embedding = nn.Embedding(full_dict_size, input_dim)
+        self.word_embedding = nn.Embedding(full_dict_size, input_dim, sparse=sparse)
 
     def forward(self, input):
         """
@@ -308,22 +575,27 @@ class RNNAttentionDecoder(nn.Module):
         self.W = nn.Linear(hidden_size*2, num_output, bias=True)
 
 
-    def forward(self, word_input, h, c, _, enc_outputs):
+    def forward(self, word_input, h, c, _, enc_outputs, out_weights=None):
+        """
+        :param out_weights: (weight, bias) rows of W to score instead of the full output vocabulary (see
+        OutputShortlist.restrict), or None
+        """
 
         lstm_output, (h,c) = self.rnn(word_input,(h,c))
         lstm_output = lstm_output.squeeze(0)
         enc_outputs = enc_outputs.squeeze(0)
 
-        ratios = torch.inner(enc_outputs, lstm_output)
-        # print("\nratios:", ratios.shape)
+        with PROFILER.phase("attention"):
+            ratios = torch.inner(enc_outputs, lstm_output)
+            # print("\nratios:", ratios.shape)
 
-        # probability vector
-        prob = F.softmax(ratios, dim=0)
-        # print("\nenc_outputs:", enc_outputs.shape)
-        # print("\nenc_outputs transposed):", enc_outputs.transpose(0,1).shape)
-        # print("\nprob:", prob.shape)
+            # probability vector
+            prob = F.softmax(ratios, dim=0)
+            # print("\nenc_outputs:", enc_outputs.shape)
+            # print("\nenc_outputs transposed):", enc_outputs.transpose(0,1).shape)
+            # print("\nprob:", prob.shape)
 
-        attention = torch.matmul(enc_outputs.transpose(0,1),prob)
+            attention = torch.matmul(enc_outputs.transpose(0,1),prob)
         # print("\natten:", attention.shape)
         # print("\nlstm_output:", lstm_output.shape)
 
@@ -332,9 +604,374 @@ class RNNAttentionDecoder(nn.Module):
 
         h_t = (h, c)
 
+        if out_weights is not None:
+            return F.linear(concat, *out_weights), [], h_t
         return self.W(concat), [], h_t
 
 
+class TransformerSemanticParser(nn.Module):
+    """
+    Transformer encoder-decoder alternative to Seq2SeqSemanticParser, with the same interface: forward returns the
+    loss of a batch for train_model_encdec and decode returns k-best lists of Derivations for evaluate. Training runs
+    over whole output sequences in parallel under a causal mask; decoding is greedy, batched over examples, and reuses
+    the keys/values of earlier output positions (KV cache) so each step only processes the newest token.
+    """
+    def __init__(self, input_indexer, output_indexer, emb_dim, hidden_size, num_layers=2, num_heads=4,
+                 embedding_dropout=0.2, dropout=0.1, max_positions=256):
+        """
+        :param emb_dim: model dimension (embedding size); must be divisible by num_heads
+        :param hidden_size: inner size of the feed-forward sublayers
+        :param num_layers: number of encoder layers and of decoder layers
+        :param num_heads: attention heads per layer
+        :param max_positions: longest input or output sequence the learned position embeddings cover
+        """
+        super(TransformerSemanticParser, self).__init__()
+        self.input_indexer = input_indexer
+        self.output_indexer = output_indexer
+
+        self.input_emb = EmbeddingLayer(emb_dim, len(input_indexer), embedding_dropout)
+        self.output_emb = EmbeddingLayer(emb_dim, len(output_indexer), embedding_dropout)
+        self.input_pos = nn.Embedding(max_positions, emb_dim)
+        self.output_pos = nn.Embedding(max_positions, emb_dim)
+
+        enc_layer = nn.TransformerEncoderLayer(emb_dim, num_heads, hidden_size, dropout=dropout, batch_first=True)
+        self.encoder = nn.TransformerEncoder(enc_layer, num_layers, enable_nested_tensor=False)
+        self.decoder = nn.ModuleList([CachedTransformerDecoderLayer(emb_dim, num_heads, hidden_size, dropout)
+                                      for _ in range(num_layers)])
+        self.W = nn.Linear(emb_dim, len(output_indexer), bias=True)
+        self.decode_batch_size = 32
+
+    def encode(self, x_tensor, inp_lens_tensor):
+        """
+        :param x_tensor: [batch size x sent len] input token indices
+        :param inp_lens_tensor: [batch size] input lengths
+        :return: the encoder outputs [batch size x sent len x emb dim] and the padding mask (True at pad positions)
+        """
+        positions = torch.arange(x_tensor.shape[1]).unsqueeze(0)
+        pad_mask = positions >= inp_lens_tensor.unsqueeze(1)
+        embedded = self.input_emb(x_tensor) + self.input_pos(positions)
+        return self.encoder(embedded, src_key_padding_mask=pad_mask), pad_mask
+
+    def decode_states(self, y_in, memory, memory_pad_mask, caches=None, start=0):
+        """
+        Runs the decoder layers
+        :param y_in: [batch size x len] decoder input tokens (SOS + gold prefix), starting at output position start
+        :param caches: per-layer KV caches to read from and extend, or None to attend causally within y_in only
+        :return: [batch size x len x emb dim] outputs of the last layer
+        """
+        positions = torch.arange(start, start + y_in.shape[1]).unsqueeze(0)
+        h = self.output_emb(y_in) + self.output_pos(positions)
+        for i, layer in enumerate(self.decoder):
+            h = layer(h, memory, memory_pad_mask, caches[i] if caches is not None else None)
+        return h
+
+    def forward(self, x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor, batch_size):
+        """
+        :param x_tensor/y_tensor: [batch size x sent len] padded input/gold output indices
+        :param inp_lens_tensor/out_lens_tensor: [batch size] input/output lengths
+        :return: summed cross-entropy of all gold output tokens in the batch
+        """
+        logits = self.teacher_forced_logits(x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor)
+        max_out_len = logits.shape[1]
+        with PROFILER.phase("loss"):
+            out_mask = torch.arange(max_out_len).unsqueeze(0) < out_lens_tensor.unsqueeze(1)
+            losses = F.cross_entropy(logits.reshape(-1, logits.shape[-1]), y_tensor[:, :max_out_len].reshape(-1),
+                                     reduction='none')
+            return (losses * out_mask.reshape(-1)).sum()
+
+    def teacher_forced_logits(self, x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor):
+        """
+        :param x_tensor/y_tensor: [batch size x sent len] padded input/gold output indices
+        :param inp_lens_tensor/out_lens_tensor: [batch size] input/output lengths
+        :return: [batch size x max out len x output vocab size] logits of each gold position
+        """
+        with PROFILER.phase("encoder_forward"):
+            memory, memory_pad_mask = self.encode(x_tensor, inp_lens_tensor)
+        max_out_len = out_lens_tensor.max().item()
+        sos = torch.full((y_tensor.shape[0], 1), self.output_indexer.index_of(SOS_SYMBOL), dtype=torch.long)
+        y_in = torch.cat([sos, y_tensor[:, :max_out_len - 1]], dim=1)
+        with PROFILER.phase("decoder_step"):
+            return self.W(self.decode_states(y_in, memory, memory_pad_mask))
+
+    def decode(self, test_data: List[Example]) -> List[List[Derivation]]:
+        """
+        Greedy decoding in batches of decode_batch_size examples, with dropout off and without building autograd graphs
+        :param test_data: List[Example] to decode
+        :return: a one-best list of Derivations for each example
+        """
+        self.eval()
+        unpacked = []
+        with torch.no_grad():
+            for start in range(0, len(test_data), self.decode_batch_size):
+                batch = test_data[start:start + self.decode_batch_size]
+                for ex, (entry_word, prob) in zip(batch, self.greedy_decode_batch(batch)):
+                    with PROFILER.phase("detokenize"):
+                        predicted = [self.output_indexer.get_object(i) for i in entry_word]
+                    PROFILER.count("decode_examples")
+                    PROFILER.count("decode_tokens", len(entry_word) + 1)
+                    unpacked.append([Derivation(ex, np.exp(prob), predicted)])
+        return unpacked
+
+    def greedy_decode_batch(self, exs: List[Example]):
+        """
+        :param exs: Examples to decode together
+        :return: for each example, the predicted output token indices (without EOS) and their total log probability.
+        If the model has a grammar_constraint (see LFGrammarConstraint), only well-formed logical forms are produced.
+        """
+        max_len = max(len(ex.x_indexed) for ex in exs)
+        x_tensor = torch.LongTensor([ex.x_indexed + [self.input_indexer.index_of(PAD_SYMBOL)] * (max_len - len(ex.x_indexed))
+                                     for ex in exs])
+        with PROFILER.phase("encoder_forward"):
+            memory, memory_pad_mask = self.encode(x_tensor, torch.LongTensor([len(ex.x_indexed) for ex in exs]))
+        end_token = self.output_indexer.index_of(EOS_SYMBOL)
+        # Models pickled before constrained decoding existed don't have the attribute
+        constraint = getattr(self, 'grammar_constraint', None)
+        states = constraint.initial_states(len(exs)) if constraint is not None else None
+        # With an output_shortlist (see OutputShortlist), only the union of the batch's shortlists is scored
+        shortlist = getattr(self, 'output_shortlist', None)
+        ids = None
+        if shortlist is not None:
+            ids, out_weights, members = shortlist.restrict_batch(exs, self.W)
+        caches = [{} for _ in self.decoder]
+        tokens = torch.full((len(exs), 1), self.output_indexer.index_of(SOS_SYMBOL), dtype=torch.long)
+        finished = torch.zeros(len(exs), dtype=torch.bool)
+        probs = torch.zeros(len(exs))
+        outputs = []
+        for step in range(MAX_DECODE_LEN):
+            with PROFILER.phase("decoder_step"):
+                decoder_states = self.decode_states(tokens, memory, memory_pad_mask, caches, start=step)[:, -1]
+                if ids is not None:
+                    logits = F.linear(decoder_states, *out_weights).masked_fill(~members, float('-inf'))
+                else:
+                    logits = self.W(decoder_states)
+                if constraint is not None:
+                    logits = constraint.apply(logits, states, MAX_DECODE_LEN - step, ids)
+                log_probs, next_tokens = torch.max(F.log_softmax(logits, dim=1), dim=1)
+                if ids is not None:
+                    next_tokens = ids[next_tokens]
+            probs += log_probs.masked_fill(finished, 0.0)
+            finished_now = finished | (next_tokens == end_token)
+            outputs.append(next_tokens.masked_fill(finished_now, end_token))
+            finished = finished_now
+            if finished.all():
+                break
+            if constraint is not None:
+                states = torch.where(finished, states, constraint.advance(states, next_tokens))
+            tokens = next_tokens.unsqueeze(1)
+        outputs = torch.stack(outputs, dim=1).tolist()
+        results = []
+        for i, row in enumerate(outputs):
+            entry_word = row[:row.index(end_token)] if end_token in row else row
+            results.append((entry_word, probs[i].item()))
+        return results
+
+
+class CachedTransformerDecoderLayer(nn.Module):
+    """
+    Post-norm Transformer decoder layer (self-attention, cross-attention over the encoder outputs, feed-forward), like
+    nn.TransformerDecoderLayer but able to decode incrementally: given a cache dict, it appends the keys/values of the
+    new positions to it and attends over everything cached so far, so no causal mask is needed.
+    """
+    def __init__(self, d_model: int, num_heads: int, ff_size: int, dropout: float):
+        super(CachedTransformerDecoderLayer, self).__init__()
+        self.num_heads = num_heads
+        self.self_qkv = nn.Linear(d_model, 3 * d_model)
+        self.self_out = nn.Linear(d_model, d_model)
+        self.cross_q = nn.Linear(d_model, d_model)
+        self.cross_kv = nn.Linear(d_model, 2 * d_model)
+        self.cross_out = nn.Linear(d_model, d_model)
+        self.ff = nn.Sequential(nn.Linear(d_model, ff_size), nn.ReLU(), nn.Dropout(dropout), nn.Linear(ff_size, d_model))
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.norm3 = nn.LayerNorm(d_model)
+        self.dropout = nn.Dropout(dropout)
+
+    def _split_heads(self, x):
+        # [batch x len x d_model] -> [batch x heads x len x d_head]
+        return x.view(x.shape[0], x.shape[1], self.num_heads, -1).transpose(1, 2)
+
+    def _merge_heads(self, x):
+        return x.transpose(1, 2).reshape(x.shape[0], x.shape[2], -1)
+
+    def forward(self, x, memory, memory_pad_mask, cache=None):
+        """
+        :param x: [batch x len x d_model] inputs for the new output positions
+        :param memory: [batch x src len x d_model] encoder outputs
+        :param memory_pad_mask: [batch x src len], True at padding
+        :param cache: dict holding the keys/values of earlier positions (filled in place), or None for full sequences
+        :return: [batch x len x d_model]
+        """
+        q, k, v = [self._split_heads(t) for t in self.self_qkv(x).chunk(3, dim=-1)]
+        dropout_p = self.dropout.p if self.training else 0.0
+        if cache is not None:
+            if 'k' in cache:
+                k = torch.cat([cache['k'], k], dim=2)
+                v = torch.cat([cache['v'], v], dim=2)
+            cache['k'], cache['v'] = k, v
+            attn = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p)
+        else:
+            attn = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+        x = self.norm1(x + self.dropout(self.self_out(self._merge_heads(attn))))
+
+        with PROFILER.phase("attention"):
+            if cache is not None and 'mem_k' in cache:
+                mem_k, mem_v = cache['mem_k'], cache['mem_v']
+            else:
+                mem_k, mem_v = [self._split_heads(t) for t in self.cross_kv(memory).chunk(2, dim=-1)]
+                if cache is not None:
+                    cache['mem_k'], cache['mem_v'] = mem_k, mem_v
+            attn_mask = ~memory_pad_mask[:, None, None, :]
+            attn = F.scaled_dot_product_attention(self._split_heads(self.cross_q(x)), mem_k, mem_v, attn_mask=attn_mask,
+                                                  dropout_p=dropout_p)
+        x = self.norm2(x + self.dropout(self.cross_out(self._merge_heads(attn))))
+        return self.norm3(x + self.dropout(self.ff(x)))
+
+
+class LFGrammarConstraint(object):
+    """
+    Finite-state approximation of the logical form grammar used to constrain decoding. The state of a hypothesis is its
+    parenthesis depth, whether it is inside a quoted name, how many variables it has introduced (NV) and its phase
+    (nothing emitted yet, opening predicate emitted, started); from it we know which output tokens keep the logical form
+    well-formed:
+      - a logical form starts with one of the opening predicates (GeoQuery's are all _answer ( ... )) and its (
+      - ) only closes an open parenthesis, and nothing but EOS may follow the parenthesis that closes the outermost one
+      - EOS only comes after that balanced closure
+      - inside quotes only name words and the closing quote are allowed
+      - V<i> must refer to one of the variables introduced so far
+    Masks over the output Indexer and the transition function are precomputed for every state, so constraining a step
+    is one gather + masked_fill over the logits and advancing is one gather, for any number of hypotheses at once.
+    """
+    # Phases of a hypothesis
+    NOT_STARTED, OPENING, STARTED = 0, 1, 2
+
+    def __init__(self, output_indexer: Indexer, max_depth=16, max_vars=10, openers=('_answer',)):
+        """
+        :param output_indexer: Indexer over output symbols
+        :param max_depth: deepest parenthesis nesting allowed (GeoQuery needs 9)
+        :param max_vars: most variables a logical form may introduce (GeoQuery needs 7)
+        :param openers: output tokens a logical form may start with
+        """
+        self.max_depth = max_depth
+        self.max_vars = max_vars
+        self.openers = set(openers)
+        num_states = self.state_id(max_depth, 1, max_vars, self.STARTED) + 1
+        vocab_size = len(output_indexer)
+        masks = np.zeros((num_states, vocab_size), dtype=bool)
+        closing_masks = np.zeros((num_states, vocab_size), dtype=bool)
+        transitions = np.zeros((num_states, vocab_size), dtype=np.int64)
+        tokens = [output_indexer.get_object(i) for i in range(vocab_size)]
+        for depth in range(max_depth + 1):
+            for in_quote in range(2):
+                for num_vars in range(max_vars + 1):
+                    for phase in range(3):
+                        state = self.state_id(depth, in_quote, num_vars, phase)
+                        for i, tok in enumerate(tokens):
+                            next_state = self._next_state(depth, in_quote, num_vars, phase, tok)
+                            if next_state is not None:
+                                masks[state, i] = True
+                                transitions[state, i] = self.state_id(*next_state)
+                                # Shortest way out when the length budget runs low: close the quote, then the parens;
+                                # a logical form that hasn't started yet has to open (and then close) one
+                                if phase == self.NOT_STARTED or tok == ("'" if in_quote else (')' if depth > 0 else (
+                                        EOS_SYMBOL if phase == self.STARTED else '('))):
+                                    closing_masks[state, i] = True
+        self.masks = torch.from_numpy(masks)
+        self.closing_masks = torch.from_numpy(closing_masks)
+        self.transitions = torch.from_numpy(transitions)
+        self.start_state = self.state_id(0, 0, 0, self.NOT_STARTED)
+
+    def state_id(self, depth, in_quote, num_vars, phase):
+        return ((depth * 2 + in_quote) * (self.max_vars + 1) + num_vars) * 3 + phase
+
+    def _next_state(self, depth, in_quote, num_vars, phase, tok):
+        """
+        :return: the (depth, in_quote, num_vars, phase) state reached by emitting tok, or None if tok isn't allowed
+        """
+        if tok in [PAD_SYMBOL, SOS_SYMBOL, UNK_SYMBOL, None]:
+            return None
+        if phase == self.NOT_STARTED:
+            return (depth, in_quote, num_vars, self.OPENING) if tok in self.openers else None
+        if phase == self.OPENING:
+            return (depth + 1, 0, num_vars, self.STARTED) if tok == '(' else None
+        finished = depth == 0 and not in_quote
+        if tok == EOS_SYMBOL:
+            return (depth, in_quote, num_vars, phase) if finished else None
+        if finished:
+            return None
+        if in_quote:
+            if tok == "'":
+                return (depth, 0, num_vars, phase)
+            if tok in ['(', ')', 'NV'] or self._var_index(tok) is not None:
+                return None
+            return (depth, in_quote, num_vars, phase)
+        if tok == '(':
+            return (depth + 1, 0, num_vars, phase) if depth < self.max_depth else None
+        if tok == ')':
+            return (depth - 1, 0, num_vars, phase)
+        if tok == "'":
+            return (depth, 1, num_vars, phase)
+        if tok == 'NV':
+            return (depth, 0, num_vars + 1, phase) if num_vars < self.max_vars else None
+        var_index = self._var_index(tok)
+        if var_index is not None:
+            return (depth, 0, num_vars, phase) if var_index < num_vars else None
+        return (depth, 0, num_vars, phase)
+
+    def _var_index(self, tok):
+        if tok.startswith('V') and tok[1:].isdigit():
+            return int(tok[1:])
+        return None
+
+    def initial_states(self, num_hyps: int):
+        """
+        :return: [num_hyps] tensor of start states
+        """
+        return torch.full((num_hyps,), self.start_state, dtype=torch.long)
+
+    def apply(self, logits, states, steps_left=None, columns=None):
+        """
+        :param logits: [num hyps x output vocab size] scores for the next token
+        :param states: [num hyps] current states
+        :param steps_left: number of tokens each hypothesis may still produce, including this one; hypotheses whose
+        budget only suffices to close their open quote and parentheses (or to open and close one, if they haven't
+        started) are forced to do so
+        :param columns: output indices the columns of logits stand for, if they only cover part of the vocabulary (e.g.
+        an OutputShortlist)
+        :return: logits with the disallowed tokens set to -inf
+        """
+        allowed = self.masks[states]
+        closing = self.closing_masks[states]
+        if columns is not None:
+            allowed, closing = allowed[:, columns], closing[:, columns]
+        if steps_left is not None:
+            depth = states // (6 * (self.max_vars + 1))
+            in_quote = (states // (3 * (self.max_vars + 1))) % 2
+            # Tokens a hypothesis in each phase still needs to open its logical form and close it again
+            to_open = torch.LongTensor([3, 2, 0])[states % 3]
+            must_close = (depth + in_quote + to_open >= steps_left).unsqueeze(1)
+            allowed = torch.where(must_close, closing, allowed)
+        return logits.masked_fill(~allowed, float('-inf'))
+
+    def states_along(self, tokens: List[int]):
+        """
+        :param tokens: output token indices, starting from the beginning of the logical form
+        :return: [len(tokens) + 1] tensor of the states before each token and after the last one. States past a token
+        that isn't allowed are meaningless.
+        """
+        states = [self.start_state]
+        for tok in tokens:
+            states.append(self.transitions[states[-1], tok].item())
+        return torch.LongTensor(states)
+
+    def advance(self, states, tokens):
+        """
+        :param states: [num hyps] current states
+        :param tokens: [num hyps] tokens emitted (must be allowed in the current states)
+        :return: [num hyps] next states
+        """
+        return self.transitions[states, tokens]
+
+
 #################
 
 
@@ -371,38 +1008,143 @@ def make_padded_output_tensor(exs, output_indexer, max_len):
     return np.array([[ex.y_indexed[i] if i < len(ex.y_indexed) else output_indexer.index_of(PAD_SYMBOL) for i in range(0, max_len)] for ex in exs])
 
 
-def train_model_encdec(train_data: List[Example], dev_data: List[Example], input_indexer, output_indexer, args) -> Seq2SeqSemanticParser:
+def make_training_dataset(train_data: List[Example], input_indexer: Indexer, output_indexer: Indexer) -> TensorDataset:
+    """
+    Pads the training examples into the tensors train_model_encdec iterates over. Built once, the result can be shared
+    between training runs (e.g. placed in shared memory by sweep.py).
+    :param train_data: indexed training examples
+    :return: TensorDataset of (input lengths, [num examples x max input len] inputs, output lengths,
+    [num examples x max output len] outputs)
+    """
+    with PROFILER.phase("data_indexing"):
+        input_max_len = np.max(np.asarray([len(ex.x_indexed) for ex in train_data]))
+        output_max_len = np.max(np.asarray([len(ex.y_indexed) for ex in train_data]))
+        # [sample size, tokenized/index length] --> shape = (480, 19) and (480, 65)
+        all_train_input_data = make_padded_input_tensor(train_data, input_indexer, input_max_len, reverse_input=False)
+        all_train_output_data = make_padded_output_tensor(train_data, output_indexer, output_max_len)
+    input_len = torch.LongTensor(np.asarray([len(ex.x_indexed) for ex in train_data]))
+    output_len = torch.LongTensor(np.asarray([len(ex.y_indexed) for ex in train_data]))
+    return TensorDataset(input_len, torch.LongTensor(all_train_input_data), output_len,
+                         torch.LongTensor(all_train_output_data))
+
+
+def _grow_embedding(embedding: nn.Embedding, num_embeddings: int) -> nn.Embedding:
+    grown = nn.Embedding(num_embeddings, embedding.embedding_dim)
+    with torch.no_grad():
+        grown.weight[:embedding.num_embeddings] = embedding.weight
+    return grown
+
+
+def _grow_linear(linear: nn.Linear, out_features: int) -> nn.Linear:
+    grown = nn.Linear(linear.in_features, out_features, bias=True)
+    with torch.no_grad():
+        grown.weight[:linear.out_features] = linear.weight
+        grown.bias[:linear.out_features] = linear.bias
+    return grown
+
+
+def resize_to_indexers(model: nn.Module):
+    """
+    Grows a trained model's input/output embeddings and output projection to the current sizes of its indexers after
+    they have been extended (see data.extend_indexers). Rows of existing symbols are kept; rows of new symbols are
+    initialized like a fresh model's.
+    :param model: Seq2SeqSemanticParser or TransformerSemanticParser
+    """
+    model.input_emb.word_embedding = _grow_embedding(model.input_emb.word_embedding, len(model.input_indexer))
+    model.output_emb.word_embedding = _grow_embedding(model.output_emb.word_embedding, len(model.output_indexer))
+    if isinstance(model, TransformerSemanticParser):
+        model.W = _grow_linear(model.W, len(model.output_indexer))
+    else:
+        model.decoder.W = _grow_linear(model.decoder.W, len(model.output_indexer))
+
+
+class MultiOptimizer(object):
+    """
+    Several optimizers over disjoint parameter sets, stepped as one (e.g. SparseAdam for the embedding tables and Adam
+    for everything else). Offers the part of the torch.optim.Optimizer interface train_model_encdec and its
+    checkpoints use.
+    """
+    def __init__(self, optimizers: List[torch.optim.Optimizer]):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return {'optimizers': [optimizer.state_dict() for optimizer in self.optimizers]}
+
+    def load_state_dict(self, state_dict):
+        if 'optimizers' not in state_dict or len(state_dict['optimizers']) != len(self.optimizers):
+            raise ValueError("Optimizer state doesn't match this MultiOptimizer (was the checkpoint written with "
+                             "another --sparse_embeddings setting?)")
+        for optimizer, state in zip(self.optimizers, state_dict['optimizers']):
+            optimizer.load_state_dict(state)
+
+
+def make_optimizer(model: nn.Module, lr: float, sparse_embeddings=False):
     """
-    Function to train the encoder-decoder model on the given data.
+    :param sparse_embeddings: switch the input and output EmbeddingLayers to sparse gradients and update them with
+    SparseAdam, which only touches the rows of the tokens in each batch (lazy Adam: a row's moments are only updated
+    when it is used), so the cost of a step doesn't grow with the vocabularies; all other parameters get dense Adam
+    :return: Adam over the model's parameter groups, or a MultiOptimizer of SparseAdam and Adam
+    """
+    embeddings = [model.input_emb.word_embedding, model.output_emb.word_embedding]
+    # Set either way: a model trained with sparse embeddings may be trained on (e.g. fine-tuned) with dense Adam
+    for embedding in embeddings:
+        embedding.sparse = sparse_embeddings
+    if sparse_embeddings:
+        embedding_params = [embedding.weight for embedding in embeddings]
+        dense_params = [p for p in model.parameters() if all(p is not q for q in embedding_params)]
+        return MultiOptimizer([torch.optim.SparseAdam(embedding_params, lr=lr), torch.optim.Adam(dense_params, lr=lr)])
+    if isinstance(model, TransformerSemanticParser):
+        parameters = [{'params':model.parameters()}]
+    else:
+        parameters = [{'params':model.encoder.parameters()},
+                      {'params':model.output_emb.parameters()},
+                      {'params':model.decoder.parameters()},
+                      {'params':model.input_emb.parameters()}]
+    return torch.optim.Adam(parameters, lr=lr)
+
+
+def train_model_encdec(train_data: List[Example], dev_data: List[Example], input_indexer, output_indexer, args, loss_fn=None,
+                       dataset: TensorDataset = None, model: nn.Module = None) -> nn.Module:
+    """
+    Function to train the encoder-decoder model on the given data. args.model_type picks the LSTM
+    (Seq2SeqSemanticParser) or transformer (TransformerSemanticParser) backend.
     :param train_data:
     :param dev_data: Development set in case you wish to evaluate during training
     :param input_indexer: Indexer of input symbols
     :param output_indexer: Indexer of output symbols
     :param args:
+    :param loss_fn: replaces the model's own loss if given; called as loss_fn(model, x_tensor, inp_lens_tensor,
+    y_tensor, out_lens_tensor) on every batch (see distill.py)
+    :param dataset: train_data already padded by make_training_dataset; train_data isn't used if given
+    :param model: model to continue training (e.g. fine-tuning, see finetune.py) instead of a new one built from args
     :return:
     """
     # Create indexed input
-    input_max_len = np.max(np.asarray([len(ex.x_indexed) for ex in train_data]))
-
-    # [sample size, tokenized/index length] --> shape = (480, 19)
-    all_train_input_data = make_padded_input_tensor(train_data, input_indexer, input_max_len, reverse_input=False)
-    all_test_input_data = make_padded_input_tensor(dev_data, input_indexer, input_max_len, reverse_input=False)
-
-    output_max_len = np.max(np.asarray([len(ex.y_indexed) for ex in train_data]))
-
-    # [sample size, tokenized/index length] --> shape = (480, 65)
-    all_train_output_data = make_padded_output_tensor(train_data, output_indexer, output_max_len)
-    all_test_output_data = make_padded_output_tensor(dev_data, output_indexer, output_max_len)
+    if dataset is None:
+        dataset = make_training_dataset(train_data, input_indexer, output_indexer)
 
     if args.print_dataset:
-        print("Train length: %i" % input_max_len)
-        print("Train output length: %i" % np.max(np.asarray([len(ex.y_indexed) for ex in train_data])))
+        all_train_input_data = dataset.tensors[1]
+        print("Train length: %i" % all_train_input_data.shape[1])
+        print("Train output length: %i" % dataset.tensors[3].shape[1])
         print("Train matrix: %s; shape = %s" % (all_train_input_data, all_train_input_data.shape))
 
     # First create a model. Then loop over epochs, loop over examples, and given some indexed words
     # call your seq-to-seq model, accumulate losses, update parameters
 
-    # hardcode these parameters before submission
+    # The defaults of these flags come from this manual sweep (batch:emb:hidden:lr:epochs -> dev accuracy)
     # 2:300:400:lr:20 -> .807
     # 2:300:256:lr:20 -> .788
     # 2:300:256:lr:30 -> .809 .795/.395 (15sec/epoch)
@@ -411,53 +1153,110 @@ def train_model_encdec(train_data: List[Example], dev_data: List[Example], input
     # 3:300:256:lr:30 -> .814 .777/.398 (15sec/epoch)
 
 
-    batch_size = 2      # default: 2
-    emb_dim = 300
-    hidden_size = 256
-    lr = args.lr        # default: 1e-3
-    epochs = 20         # default: 10
-
-
-    model = Seq2SeqSemanticParser(input_indexer, output_indexer, emb_dim, hidden_size)
+    batch_size = args.batch_size    # default: 2
+    emb_dim = args.emb_dim          # default: 300
+    hidden_size = args.hidden_size  # default: 256
+    lr = args.lr                    # default: 1e-3
+    epochs = args.epochs            # default: 20
 
-    parameters = [{'params':model.encoder.parameters()},
-                  {'params':model.output_emb.parameters()},
-                  {'params':model.decoder.parameters()},
-                  {'params':model.input_emb.parameters()}]
 
-    optimizer = torch.optim.Adam(parameters, lr=lr)
-
-    input_len = torch.LongTensor(np.asarray([len(ex.x_indexed) for ex in train_data]))
-    output_len = torch.LongTensor(np.asarray([len(ex.y_indexed) for ex in train_data]))
-    all_train_input_data = torch.LongTensor(all_train_input_data)
-    all_train_output_data = torch.LongTensor(all_train_output_data)
-
-    dataset = TensorDataset(input_len, all_train_input_data, output_len, all_train_output_data)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
-
-    for epoch in range(epochs):
+    new_model = True
+    if model is None and getattr(args, 'model_type', 'lstm') == 'transformer':
+        model = TransformerSemanticParser(input_indexer, output_indexer, emb_dim, hidden_size, num_layers=args.num_layers,
+                                          num_heads=args.num_heads)
+    elif model is None:
+        model = Seq2SeqSemanticParser(input_indexer, output_indexer, emb_dim, hidden_size)
+    else:
+        new_model = False
+    if new_model and getattr(args, 'pretrained_embeddings', None) is not None:
+        from pretrained import init_embeddings_from_pretrained
+        num_found = init_embeddings_from_pretrained(model.input_emb, input_indexer, args.pretrained_embeddings)
+        print("Initialized %i of %i input embeddings from %s" % (num_found, len(input_indexer), args.pretrained_embeddings))
+    optimizer = make_optimizer(model, lr, getattr(args, 'sparse_embeddings', False))
+
+    chunk_len = getattr(args, 'activation_chunk_len', 0)
+    truncate = getattr(args, 'truncated_bptt', False)
+    if (chunk_len > 0 or truncate) and not isinstance(model, Seq2SeqSemanticParser):
+        raise ValueError("Memory-bounded training (--activation_chunk_len, --truncated_bptt) needs the LSTM backend")
+    if truncate and chunk_len <= 0:
+        raise ValueError("--truncated_bptt needs --activation_chunk_len to set the truncation length")
+    memory = SavedTensorMemory() if getattr(args, 'report_train_memory', False) else None
+
+    checkpoint_dir = getattr(args, 'checkpoint_dir', None)
+    if getattr(args, 'resume', False) and checkpoint_dir is None:
+        raise ValueError("--resume requires --checkpoint_dir")
+    start_epoch, start_step = 0, 0
+    epoch_order = None
+    epoch_loss = []
+    ckpt = load_latest_checkpoint(checkpoint_dir) if getattr(args, 'resume', False) else None
+    if ckpt is not None:
+        model.load_state_dict(ckpt['model'])
+        if ('optimizers' in ckpt['optimizer']) != isinstance(optimizer, MultiOptimizer):
+            raise ValueError("The checkpoint in %s was written with another --sparse_embeddings setting" % checkpoint_dir)
+        optimizer.load_state_dict(ckpt['optimizer'])
+        restore_rng_state(ckpt['rng'])
+        start_epoch, start_step = ckpt['epoch'], ckpt['step']
+        epoch_order, epoch_loss = ckpt['epoch_order'], ckpt['epoch_loss']
+    elif getattr(args, 'resume', False):
+        print("No checkpoint found in %s, starting from scratch" % checkpoint_dir)
+
+    def write_checkpoint(epoch, step):
+        state = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch, 'step': step,
+                 'epoch_order': epoch_order, 'epoch_loss': epoch_loss, 'rng': capture_rng_state(),
+                 'input_indexer': input_indexer, 'output_indexer': output_indexer}
+        save_checkpoint(checkpoint_dir, state, epoch, step, keep=args.keep_checkpoints)
+
+    for epoch in range(start_epoch, epochs):
         timer = time.time()
-        epoch_loss = []
-        model.input_emb.train()
-        model.output_emb.train()
-        model.encoder.train()
-        model.decoder.train()
-
-        for batch in dataloader:
+        model.train()
+
+        # The shuffled order of the epoch is drawn up front and saved with each checkpoint so a resumed run sees the
+        # remaining batches of the epoch in the same order. The loader gets its own generator so that creating it
+        # doesn't consume the global RNG stream.
+        if epoch_order is None:
+            epoch_order = torch.randperm(len(dataset)).tolist()
+            epoch_loss = []
+        dataloader = DataLoader(dataset, batch_size=batch_size, sampler=epoch_order[start_step * batch_size:],
+                                num_workers=4, generator=torch.Generator())
+
+        for step, batch in enumerate(dataloader, start_step + 1):
             optimizer.zero_grad()
             x_tensor, inp_lens_tensor = batch[1], batch[0]
             y_tensor, out_lens_tensor = batch[3], batch[2]
 
             # accumulate loss terms
-            batch_loss  = model(x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor, batch_size)
-            epoch_loss.append(batch_loss)
-
-            batch_loss.backward()
-            optimizer.step()
+            with PROFILER.phase("train"), memory if memory is not None else nullcontext():
+                if loss_fn is not None:
+                    batch_loss = loss_fn(model, x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor)
+                elif chunk_len > 0:
+                    batch_loss = model.memory_bounded_loss(x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor,
+                                                           chunk_len, truncate)
+                else:
+                    batch_loss  = model(x_tensor, inp_lens_tensor, y_tensor, out_lens_tensor, x_tensor.shape[0])
+                epoch_loss.append(batch_loss.item())
+
+                # Truncated backpropagation has run backward chunk by chunk already
+                if batch_loss.requires_grad:
+                    with PROFILER.phase("backward"):
+                        batch_loss.backward()
+                with PROFILER.phase("optimizer_step"):
+                    optimizer.step()
+            PROFILER.count("train_examples", x_tensor.shape[0])
+            PROFILER.count("train_tokens", out_lens_tensor.sum().item())
+
+            if checkpoint_dir is not None and args.checkpoint_every > 0 and step % args.checkpoint_every == 0:
+                write_checkpoint(epoch, step)
+        start_step = 0
+        epoch_order = None
 
         print(f"\nEpoch {epoch}:")
         print(f"{np.sum(epoch_loss)/len(epoch_loss)}")
         print("Time:",time.time()-timer)
+        if memory is not None:
+            print("Peak activation memory: %.2f MB; peak RSS so far: %.1f MB" % (memory.peak_bytes / 2 ** 20, peak_rss_mb()))
+            memory.reset_peak()
+        if checkpoint_dir is not None:
+            write_checkpoint(epoch + 1, 0)
     return model
 
 
@@ -0,0 +1,47 @@
+# nearest_neighbor.py
+# The nearest-neighbor baseline parser. Torch-free, so --do_nearest_neighbor runs never import the neural stack.
+
+from typing import List
+from data import *
+
+
+class NearestNeighborSemanticParser(object):
+    """
+    Semantic parser that uses Jaccard similarity to find the most similar input example to a particular question and
+    returns the associated logical form.
+    """
+    def __init__(self, training_data: List[Example]):
+        self.training_data = training_data
+
+    def decode(self, test_data: List[Example]) -> List[List[Derivation]]:
+        """
+        :param test_data: List[Example] to decode
+        :return: A list of k-best lists of Derivations. A Derivation consists of the underlying Example, a probability,
+        and a tokenized input string. If you're just doing one-best decoding of example ex and you
+        produce output y_tok, you can just return the k-best list [Derivation(ex, 1.0, y_tok)]
+        """
+        test_derivs = []
+        for test_ex in test_data:
+            best_train_ex = self.retrieve(test_ex)
+            # Note that this is a list of a single Derivation
+            test_derivs.append([Derivation(test_ex, 1.0, best_train_ex.y_tok)])
+        return test_derivs
+
+    def retrieve(self, test_ex: Example) -> Example:
+        """
+        :param test_ex: Example to find a neighbor for
+        :return: the training Example whose question has the highest Jaccard similarity with test_ex's
+        """
+        test_words = test_ex.x_tok
+        best_jaccard = -1
+        best_train_ex = None
+        # Find the highest word overlap with the train data
+        for train_ex in self.training_data:
+            # Compute word overlap with Jaccard similarity
+            train_words = train_ex.x_tok
+            overlap = len(frozenset(train_words) & frozenset(test_words))
+            jaccard = overlap/float(len(frozenset(train_words) | frozenset(test_words)))
+            if jaccard > best_jaccard:
+                best_jaccard = jaccard
+                best_train_ex = train_ex
+        return best_train_ex
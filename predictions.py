@@ -0,0 +1,112 @@
+# predictions.py
+# Compact on-disk store of decoded k-best lists, so that re-evaluation (a different evaluator mode, reranking, new
+# metrics) doesn't have to decode again. A store is a set of .npy arrays sharing a prefix, one entry per derivation:
+#   PREFIX.tokens.npy       int32 token ids of all derivations, concatenated
+#   PREFIX.offsets.npy      int64 [num derivations + 1] start of each derivation's tokens in tokens
+#   PREFIX.scores.npy       float64 probability of each derivation
+#   PREFIX.example_ids.npy  int32 position in the evaluated dataset of each derivation's example (ascending, rank order
+#                           within an example)
+# plus PREFIX.json with the token strings the ids refer to and the number of examples. Tokens are those of the
+# derivations as evaluated (entity placeholders already restored), so the store has its own vocabulary rather than the
+# model's output indexer. Arrays are memory-mapped on load and derivations only built for the examples asked for.
+#   python main.py --dump_predictions preds/geo                     # writes preds/geo.dev.* and preds/geo.test.*
+#   python main.py --from_predictions preds/geo --staged_java_eval  # evaluates them again without a model
+
+import json
+import numpy as np
+from array import array
+from typing import List
+from data import *
+
+PREDICTION_ARRAYS = ['tokens', 'offsets', 'scores', 'example_ids']
+
+
+class PredictionWriter(object):
+    """
+    Accumulates k-best lists, possibly batch by batch, in compact arrays and writes them out as a prediction store
+    """
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.vocab = Indexer()
+        self.tokens = array('i')
+        self.offsets = array('q', [0])
+        self.scores = array('d')
+        self.example_ids = array('i')
+        self.num_examples = 0
+
+    def add(self, all_derivs: List[List[Derivation]]):
+        """
+        :param all_derivs: k-best lists of the next len(all_derivs) examples of the dataset, best first
+        """
+        for derivs in all_derivs:
+            for deriv in derivs:
+                self.tokens.extend(self.vocab.add_and_get_index(tok) for tok in deriv.y_toks)
+                self.offsets.append(len(self.tokens))
+                self.scores.append(float(deriv.p))
+                self.example_ids.append(self.num_examples)
+            self.num_examples += 1
+
+    def close(self):
+        """
+        Writes the store
+        """
+        for name in PREDICTION_ARRAYS:
+            np.save("%s.%s.npy" % (self.prefix, name), np.frombuffer(getattr(self, name), dtype=getattr(self, name).typecode))
+        with open(self.prefix + '.json', 'w') as f:
+            json.dump({'num_examples': self.num_examples,
+                       'vocab': [self.vocab.get_object(i) for i in range(len(self.vocab))]}, f)
+
+
+def dump_predictions(prefix: str, all_derivs: List[List[Derivation]]):
+    """
+    Writes the k-best lists of a whole dataset as a prediction store
+    """
+    writer = PredictionWriter(prefix)
+    writer.add(all_derivs)
+    writer.close()
+
+
+class PredictionStore(object):
+    """
+    Read side of a prediction store. The arrays are memory-mapped, so opening a store reads only its vocabulary.
+
+    Attributes:
+        tokens/offsets/scores/example_ids: the (memory-mapped) arrays described at the top of this file
+        vocab: token strings, indexed by token id
+        num_examples: number of examples of the dataset the predictions were made for
+    """
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        for name in PREDICTION_ARRAYS:
+            setattr(self, name, np.load("%s.%s.npy" % (prefix, name), mmap_mode='r'))
+        with open(prefix + '.json') as f:
+            meta = json.load(f)
+        self.vocab = meta['vocab']
+        self.num_examples = meta['num_examples']
+        # Start of each example's derivations; example_ids is sorted
+        self.example_starts = np.searchsorted(self.example_ids, np.arange(self.num_examples + 1))
+
+    def __len__(self):
+        return self.num_examples
+
+    def derivations(self, i: int, ex: Example = None) -> List[Derivation]:
+        """
+        :param i: position of the example in the dataset
+        :param ex: the Example to attach to the Derivations
+        :return: the k-best list of example i
+        """
+        start, end = self.example_starts[i], self.example_starts[i + 1]
+        offsets = self.offsets[start:end + 1]
+        toks = self.tokens[offsets[0]:offsets[-1]].tolist()
+        return [Derivation(ex, float(p), [self.vocab[t] for t in toks[offsets[j] - offsets[0]:offsets[j + 1] - offsets[0]]])
+                for j, p in enumerate(self.scores[start:end])]
+
+    def decode(self, test_data: List[Example]) -> List[List[Derivation]]:
+        """
+        Stands in for a decoder's decode: returns the stored k-best lists
+        :param test_data: the dataset the store was written for
+        """
+        if len(test_data) != self.num_examples:
+            raise ValueError("Predictions in %s are for %i examples, not %i" % (self.prefix, self.num_examples,
+                                                                              len(test_data)))
+        return [self.derivations(i, ex) for i, ex in enumerate(test_data)]
@@ -0,0 +1,117 @@
+# pretrained.py
+# Pretrained word vectors for initializing the input embeddings. A text vector file (GloVe, or word2vec/fastText .vec
+# with its "count dim" header line) is converted once into a .npy matrix plus a .vocab sidecar listing the word of
+# each row; training then memory-maps the matrix and reads only the rows of the words in the input Indexer.
+#   python pretrained.py --vectors glove.840B.300d.txt --out glove.840B.300d
+#   python main.py --pretrained_embeddings glove.840B.300d --emb_dim 300
+
+import argparse
+import time
+import numpy as np
+from typing import Tuple
+from data import *
+
+
+def _vector_lines(path: str):
+    """
+    :return: generator of the (word, values) pairs of a text vector file, skipping a word2vec-style header line.
+    Words may contain spaces (as some GloVe releases have), so the last `dim` fields of a line are the values.
+    """
+    dim = None
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for i, line in enumerate(f):
+            fields = line.rstrip('\n').rstrip(' ').split(' ')
+            if i == 0 and len(fields) == 2:
+                continue
+            if dim is None:
+                dim = len(fields) - 1
+            if len(fields) <= dim:
+                continue
+            yield ' '.join(fields[:-dim]), fields[-dim:]
+
+
+def convert_vectors(vectors_path: str, out_prefix: str) -> Tuple[int, int]:
+    """
+    Converts a text vector file into out_prefix.npy, a float32 [num words x dim] matrix, and out_prefix.vocab, the
+    word of each row one per line. Takes two passes over the file (one to size the matrix), holding its words but
+    never its vectors in memory; repeated words keep their first vector.
+    :return: the number of words and the dimension
+    """
+    seen = set()
+    dim = None
+    for word, values in _vector_lines(vectors_path):
+        dim = len(values)
+        seen.add(word)
+    if dim is None:
+        raise ValueError("No vectors found in %s" % vectors_path)
+    matrix = np.lib.format.open_memmap(out_prefix + '.npy', mode='w+', dtype=np.float32, shape=(len(seen), dim))
+    written = set()
+    with open(out_prefix + '.vocab', 'w', encoding='utf-8') as vocab:
+        for word, values in _vector_lines(vectors_path):
+            if word in written:
+                continue
+            matrix[len(written)] = np.asarray(values, dtype=np.float32)
+            written.add(word)
+            vocab.write(word + '\n')
+    matrix.flush()
+    del matrix
+    return len(written), dim
+
+
+def load_pretrained_rows(prefix: str, indexer: Indexer):
+    """
+    Reads the vectors of the words of indexer from a converted file. The .vocab sidecar is streamed keeping only the
+    rows of the words in indexer (falling back to the lowercased word when the word itself isn't there), and only
+    those rows of the memory-mapped matrix are read.
+    :return: [len(indexer) x dim] float32 array of the vectors (zero rows for missing words) and a [len(indexer)] bool
+    mask of which words were found
+    """
+    words = [indexer.get_object(i) for i in range(len(indexer))]
+    wanted = set(words) | set(w.lower() for w in words)
+    rows = {}
+    with open(prefix + '.vocab', encoding='utf-8') as vocab:
+        for row, line in enumerate(vocab):
+            word = line.rstrip('\n')
+            if word in wanted and word not in rows:
+                rows[word] = row
+    matrix = np.load(prefix + '.npy', mmap_mode='r')
+    found = np.array([w in rows or w.lower() in rows for w in words])
+    index = [rows[w] if w in rows else rows[w.lower()] for w, f in zip(words, found) if f]
+    vectors = np.zeros((len(words), matrix.shape[1]), dtype=np.float32)
+    # Sorted reads touch the pages of the mapped file in order
+    order = np.argsort(index)
+    vectors[np.flatnonzero(found)[order]] = matrix[np.asarray(index, dtype=np.int64)[order]]
+    return vectors, found
+
+
+def init_embeddings_from_pretrained(embedding_layer, indexer: Indexer, prefix: str) -> int:
+    """
+    Overwrites the rows of embedding_layer (an EmbeddingLayer over indexer) for the words that have pretrained
+    vectors; the others keep their random initialization
+    :return: the number of words initialized
+    """
+    import torch
+    vectors, found = load_pretrained_rows(prefix, indexer)
+    weight = embedding_layer.word_embedding.weight
+    if vectors.shape[1] != weight.shape[1]:
+        raise ValueError("Pretrained vectors in %s have dimension %i but the embeddings have %i (set --emb_dim)" %
+                         (prefix, vectors.shape[1], weight.shape[1]))
+    with torch.no_grad():
+        mask = torch.from_numpy(found)
+        weight[mask] = torch.from_numpy(vectors[found])
+    return int(found.sum())
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='pretrained.py')
+    parser.add_argument('--vectors', type=str, required=True, help='text vector file to convert')
+    parser.add_argument('--out', type=str, required=True, help='prefix of the .npy matrix and .vocab files to write')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    start = time.time()
+    num_words, dim = convert_vectors(args.vectors, args.out)
+    print("Converted %i %i-dimensional vectors to %s.npy and %s.vocab in %.1f sec" % (num_words, dim, args.out,
+                                                                                       args.out, time.time() - start))
@@ -0,0 +1,214 @@
+# profiling.py
+
+import json
+import time
+import resource
+from collections import Counter, defaultdict
+
+
+class _NullPhase(object):
+    """
+    Context manager that does nothing; handed out when profiling is off so instrumented hot loops pay only a call
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.times[self.name] += time.perf_counter() - self.start
+        self.profiler.counts[self.name] += 1
+        return False
+
+
+class Profiler(object):
+    """
+    Opt-in wall-clock instrumentation. Code wraps its hot phases in `with PROFILER.phase("name"):` and reports work done
+    with PROFILER.count(...); nothing is recorded unless the profiler has been enabled. Phases may nest (e.g., attention
+    is timed inside each decoder step), so phase times don't sum to the total run time.
+
+    Attributes:
+        enabled: True if phases and counters are being recorded
+        times: phase name -> total wall time in seconds
+        counts: phase name -> number of times the phase ran
+        counters: counter name -> total (e.g. train_examples, decode_tokens)
+    """
+    def __init__(self):
+        self.enabled = False
+        self.times = defaultdict(float)
+        self.counts = Counter()
+        self.counters = Counter()
+        self.start_time = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.start_time = time.perf_counter()
+
+    def phase(self, name):
+        """
+        :param name: name of the phase to time
+        :return: a context manager timing its body under name
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        """
+        Adds n to the counter name (examples, tokens, ...); used to derive throughput numbers
+        """
+        if self.enabled:
+            self.counters[name] += n
+
+    def report(self):
+        """
+        :return: a JSON-serializable dict with per-phase times and counts, examples/sec and tokens/sec for each mode
+        that reported its work (train, decode), and peak RSS of this process and its children (the Java evaluator)
+        """
+        phases = {}
+        for name in sorted(self.times.keys()):
+            phases[name] = {'total_sec': self.times[name], 'count': self.counts[name],
+                            'mean_ms': 1000.0 * self.times[name] / max(self.counts[name], 1)}
+        throughput = {}
+        for mode in ['train', 'decode']:
+            secs = self.times.get(mode, 0.0)
+            if secs > 0:
+                throughput[mode] = {'examples_per_sec': self.counters[mode + '_examples'] / secs,
+                                    'tokens_per_sec': self.counters[mode + '_tokens'] / secs}
+        # ru_maxrss is reported in kilobytes on Linux
+        return {'wall_sec': time.perf_counter() - self.start_time,
+                'phases': phases,
+                'counters': dict(self.counters),
+                'throughput': throughput,
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0}
+
+    def write_report(self, path: str):
+        with open(path, "w") as out:
+            json.dump(self.report(), out, indent=2, sort_keys=True)
+        print("Wrote profiling report to %s" % path)
+
+
+class Tracer(object):
+    """
+    Optional whole-run trace to go with the phase report. Paths ending in .json get a torch.profiler Chrome trace
+    (viewable in chrome://tracing or Perfetto); anything else gets cProfile stats readable with pstats/snakeviz.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.use_torch = path.endswith('.json')
+        self.prof = None
+
+    def __enter__(self):
+        if self.use_torch:
+            import torch.profiler
+            self.prof = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+            self.prof.__enter__()
+        else:
+            import cProfile
+            self.prof = cProfile.Profile()
+            self.prof.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.use_torch:
+            self.prof.__exit__(*exc)
+            self.prof.export_chrome_trace(self.path)
+        else:
+            self.prof.disable()
+            self.prof.dump_stats(self.path)
+        print("Wrote trace to %s" % self.path)
+        return False
+
+
+class _SavedTensor(object):
+    """
+    A tensor saved for backward while SavedTensorMemory is active; releases its storage from the count when autograd
+    drops it
+    """
+    def __init__(self, tracker, key, tensor):
+        self.tracker = tracker
+        self.key = key
+        self.tensor = tensor
+
+    def __del__(self):
+        self.tracker._release(self.key)
+
+
+class SavedTensorMemory(object):
+    """
+    Measures training activation memory: the bytes of the tensors autograd saves for backward and still holds, counted
+    once per storage. Parameters, which are held anyway, aren't counted. Use as a context manager around forward and
+    backward passes; torch is only imported when it's entered.
+
+    Attributes:
+        current_bytes: bytes held right now
+        peak_bytes: most bytes held at once since the last reset_peak
+    """
+    def __init__(self):
+        self.storages = {}
+        self.current_bytes = 0
+        self.peak_bytes = 0
+        self.hooks = None
+
+    def _pack(self, tensor):
+        if tensor.is_leaf and tensor.requires_grad:
+            return tensor
+        storage = tensor.untyped_storage()
+        key = storage.data_ptr()
+        refs, nbytes = self.storages.get(key, (0, storage.nbytes()))
+        if refs == 0:
+            self.current_bytes += nbytes
+            self.peak_bytes = max(self.peak_bytes, self.current_bytes)
+        self.storages[key] = (refs + 1, nbytes)
+        return _SavedTensor(self, key, tensor)
+
+    def _unpack(self, packed):
+        return packed.tensor if isinstance(packed, _SavedTensor) else packed
+
+    def _release(self, key):
+        refs, nbytes = self.storages[key]
+        if refs == 1:
+            del self.storages[key]
+            self.current_bytes -= nbytes
+        else:
+            self.storages[key] = (refs - 1, nbytes)
+
+    def reset_peak(self):
+        self.peak_bytes = self.current_bytes
+
+    def __enter__(self):
+        import torch.autograd.graph
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.hooks.__exit__(*exc)
+        return False
+
+
+def peak_rss_mb() -> float:
+    """
+    :return: peak resident set size of this process so far, in megabytes
+    """
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# Shared instance used by all instrumented code
+PROFILER = Profiler()
@@ -0,0 +1,203 @@
+# serving.py
+# Multi-process decoding server: the model is loaded once, frozen and moved to shared memory, then a pool of forked
+# decode workers uses those same weights. A front queue spreads micro-batches of questions across the workers.
+#   python serving.py --model_path final_model.pt --workers 4 < questions.txt > parses.tsv
+
+import argparse
+import os
+import queue
+import sys
+import time
+import torch
+import torch.multiprocessing as mp
+from typing import List
+from data import *
+from models import *
+from entities import restore_derivations
+
+
+def load_frozen_model(model_path: str, fused_inference=False, constrained_decoding=False) -> nn.Module:
+    """
+    Loads a trained parser for serving: eval mode, no gradients, and every parameter and buffer in shared memory so
+    forked workers all map the same pages instead of each holding (or copy-on-write faulting in) a private copy
+    :param fused_inference: precompute FusedGateTables (LSTM backend) before forking so workers share them too
+    :param constrained_decoding: attach an LFGrammarConstraint
+    :return: the frozen parser
+    """
+    model = torch.load(model_path, weights_only=False)
+    model.eval()
+    model.requires_grad_(False)
+    if constrained_decoding:
+        model.grammar_constraint = LFGrammarConstraint(model.output_indexer)
+    model.share_memory()
+    if fused_inference and isinstance(model, Seq2SeqSemanticParser):
+        model.fused_inference = True
+        tables = model._gate_tables()
+        for tensor in [tables.enc_gates, tables.dec_gates, tables.enc_w_hh, tables.dec_w_hh]:
+            tensor.share_memory_()
+    if constrained_decoding:
+        constraint = model.grammar_constraint
+        for tensor in [constraint.masks, constraint.closing_masks, constraint.transitions]:
+            tensor.share_memory_()
+    return model
+
+
+def _decode_worker(model, task_queue, result_queue, num_threads: int):
+    """
+    Worker loop: decodes micro-batches of (x, x_tok, x_indexed) until it receives None
+    """
+    torch.set_num_threads(num_threads)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_id, inputs = task
+        exs = [Example(x, x_tok, x_indexed, "", [], []) for (x, x_tok, x_indexed) in inputs]
+        derivs = model.decode(exs)
+        result_queue.put((batch_id, [(d[0].p, d[0].y_toks) for d in derivs]))
+
+
+def _proc_memory_mb(pid: int):
+    """
+    :return: (RSS, PSS) of the process in megabytes from /proc/<pid>/smaps_rollup, or None where that isn't available.
+    PSS charges each shared page to the processes mapping it in equal parts, so summed over the server it is the
+    real memory footprint.
+    """
+    try:
+        with open('/proc/%i/smaps_rollup' % pid) as f:
+            fields = dict((line.split()[0].rstrip(':'), line.split()[1]) for line in f if line.split()[0].endswith(':'))
+        return int(fields['Rss']) / 1024.0, int(fields['Pss']) / 1024.0
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class DecodeServer(object):
+    """
+    Pool of forked decode workers over one frozen model. Use as a context manager, or call start() and close().
+
+    Attributes:
+        model: the frozen parser (see load_frozen_model)
+        num_workers: number of decode processes
+        micro_batch_size: number of questions per queued task
+        threads_per_worker: torch threads of each worker
+        poll_interval: seconds decode waits for a result before checking that the workers are all still alive
+    """
+    def __init__(self, model: nn.Module, num_workers: int, micro_batch_size=8, threads_per_worker=1, poll_interval=1.0):
+        self.model = model
+        self.num_workers = num_workers
+        self.micro_batch_size = micro_batch_size
+        self.threads_per_worker = threads_per_worker
+        self.poll_interval = poll_interval
+        self.workers = []
+        self.next_batch_id = 0
+
+    def start(self):
+        # fork: workers inherit the model (and its shared-memory storages) without pickling it
+        ctx = mp.get_context('fork')
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        for _ in range(self.num_workers):
+            worker = ctx.Process(target=_decode_worker, args=(self.model, self.task_queue, self.result_queue,
+                                                               self.threads_per_worker), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    def close(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def decode(self, test_data: List[Example]) -> List[List[Derivation]]:
+        """
+        Spreads test_data over the workers in micro-batches and collects the results back in order. Raises
+        RuntimeError if a worker dies (e.g. killed for running out of memory, or an exception while decoding), since
+        its batch will never come back; the server should then be closed.
+        :return: a one-best list of Derivations for each example, as the model's own decode returns them
+        """
+        pending = {}
+        for start in range(0, len(test_data), self.micro_batch_size):
+            batch = test_data[start:start + self.micro_batch_size]
+            self.task_queue.put((self.next_batch_id, [(ex.x, ex.x_tok, ex.x_indexed) for ex in batch]))
+            pending[self.next_batch_id] = start
+            self.next_batch_id += 1
+        derivs = [None] * len(test_data)
+        while pending:
+            try:
+                batch_id, outputs = self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead = [worker for worker in self.workers if not worker.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError("Decode worker (pid %i) exited with code %s with %i of %i batches outstanding" %
+                                       (dead[0].pid, dead[0].exitcode, len(pending),
+                                        (len(test_data) + self.micro_batch_size - 1) // self.micro_batch_size))
+                continue
+            start = pending.pop(batch_id)
+            for i, (p, y_toks) in enumerate(outputs):
+                derivs[start + i] = [Derivation(test_data[start + i], p, y_toks)]
+        return derivs
+
+    def parse(self, questions: List[str]) -> List[List[Derivation]]:
+        """
+        :param questions: raw questions, tokenized and indexed with the model's input indexer (after entity
+        anonymization if the model was trained with --anonymize_entities)
+        :return: decode() on them, with entity names restored
+        """
+        anonymizer = getattr(self.model, 'anonymizer', None)
+        exs = []
+        for x in questions:
+            x_tok = tokenize(x)
+            if anonymizer is not None:
+                anon_x_tok, _, entities = anonymizer.anonymize(x_tok)
+                exs.append(Example(x, x_tok, index(anon_x_tok, self.model.input_indexer), "", [], [], entities))
+            else:
+                exs.append(Example(x, x_tok, index(x_tok, self.model.input_indexer), "", [], []))
+        return restore_derivations(exs, self.decode(exs))
+
+    def memory_report(self):
+        """
+        :return: RSS and PSS of the front process and of each worker, and total PSS, in megabytes (None off Linux)
+        """
+        front = _proc_memory_mb(os.getpid())
+        workers = [_proc_memory_mb(worker.pid) for worker in self.workers]
+        if front is None or any(w is None for w in workers):
+            return None
+        return {'front_rss_mb': front[0], 'worker_rss_mb': [w[0] for w in workers],
+                'total_pss_mb': front[1] + sum(w[1] for w in workers)}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='serving.py')
+    parser.add_argument('--model_path', type=str, default='final_model.pt', help='path to the trained model')
+    parser.add_argument('--workers', type=int, default=max(1, os.cpu_count()), help='number of decode processes')
+    parser.add_argument('--micro_batch_size', type=int, default=8, help='questions per task handed to a worker')
+    parser.add_argument('--threads_per_worker', type=int, default=1, help='torch threads of each worker')
+    parser.add_argument('--fused_inference', default=False, action='store_true', help='decode with FusedGateTables (LSTM backend)')
+    parser.add_argument('--constrained_decoding', default=False, action='store_true', help='only produce well-formed logical forms')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    model = load_frozen_model(args.model_path, args.fused_inference, args.constrained_decoding)
+    questions = [line.strip() for line in sys.stdin if len(line.strip()) > 0]
+    with DecodeServer(model, args.workers, args.micro_batch_size, args.threads_per_worker) as server:
+        start = time.time()
+        derivs = server.parse(questions)
+        secs = time.time() - start
+        memory = server.memory_report()
+    for x, d in zip(questions, derivs):
+        print(x + "\t" + " ".join(d[0].y_toks))
+    print("Decoded %i questions in %.2f sec (%.1f/sec) on %i workers" % (len(questions), secs, len(questions) / max(secs, 1e-9),
+                                                                      args.workers), file=sys.stderr)
+    if memory is not None:
+        print("Memory: %s" % memory, file=sys.stderr)
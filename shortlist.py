@@ -0,0 +1,109 @@
+# shortlist.py
+# Per-query output vocabulary shortlists. The decoder's output projection scores every symbol of the output Indexer at
+# every step, which dominates decoding once a domain has thousands of entity constants. A shortlist keeps the symbols
+# that structure logical forms (predicates, parentheses, variables, ...) and only the constants a lexicon index
+# retrieves from the question; the projection and softmax then run over those rows of W alone.
+
+import torch
+import torch.nn as nn
+from typing import Dict, List, Tuple
+from data import *
+from entities import EntityTrie, entity_arguments
+
+
+class OutputShortlist(object):
+    """
+    Splits the output vocabulary into constants, the symbols that only ever occur as entity arguments of the training
+    logical forms (see entity_arguments), and structural symbols, everything else. The shortlist of a question is all
+    structural symbols plus the constants retrieved from its tokens:
+      - a question token that is itself a constant retrieves it (also covers placeholders like STATE0 when the data
+        is anonymized)
+      - entity phrases of the optional lexicon (e.g. load_geobase_entities), matched with an EntityTrie, retrieve the
+        tokens of the name logical forms use for them ("mississippi river" -> mississippi)
+    Constants that some training question does not retrieve this way (e.g. usa, which questions call "the country")
+    are always kept, so every training logical form is within its question's shortlist.
+
+    Attributes:
+        structural: output indices always scored
+        constants: output indices of the constants
+        lexicon: question token -> output indices it retrieves
+    """
+    def __init__(self, input_indexer: Indexer, output_indexer: Indexer, train_data: List[Example],
+                 entities: Dict[Tuple[str, ...], Tuple[str, Tuple[str, ...]]] = None):
+        """
+        :param train_data: indexed training examples; their indexed outputs (which are anonymized if the data is)
+        define the constants
+        :param entities: question phrase tokens -> (entity type, name tokens in logical forms)
+        """
+        self.input_indexer = input_indexer
+        self.output_indexer = output_indexer
+        outputs = [[output_indexer.get_object(i) for i in ex.y_indexed if i >= 0] for ex in train_data]
+        in_args = set()
+        elsewhere = set()
+        for y_tok in outputs:
+            arg_positions = set(i for start, end, name in entity_arguments(y_tok) for i in range(start, end)
+                                if y_tok[i] != "'")
+            for i, tok in enumerate(y_tok):
+                (in_args if i in arg_positions else elsewhere).add(tok)
+        constant_toks = in_args - elsewhere
+        self.constants = set(output_indexer.index_of(tok) for tok in constant_toks)
+        self.lexicon = dict((tok, set([output_indexer.index_of(tok)])) for tok in constant_toks)
+        self.trie = None
+        if entities is not None:
+            self.trie = EntityTrie(dict((phrase, [output_indexer.index_of(tok) for tok in name if tok in constant_toks])
+                                        for phrase, (entity_type, name) in entities.items()))
+        self.structural = set(range(len(output_indexer))) - self.constants
+        for ex, y_tok in zip(train_data, outputs):
+            retrieved = self.retrieve(ex)
+            self.structural.update(self.output_indexer.index_of(tok) for tok in y_tok
+                                   if tok in constant_toks and self.output_indexer.index_of(tok) not in retrieved)
+
+    def retrieve(self, ex: Example) -> set:
+        """
+        :return: output indices of the constants retrieved from the question of ex
+        """
+        # x_tok holds the original words; anonymized placeholders only show up in x_indexed
+        toks = ex.x_tok + [self.input_indexer.get_object(i) for i in ex.x_indexed]
+        retrieved = set()
+        for tok in toks:
+            retrieved.update(self.lexicon.get(tok, ()))
+        if self.trie is not None:
+            for start, end, ids in self.trie.find(ex.x_tok):
+                retrieved.update(ids)
+        return retrieved
+
+    def candidates(self, ex: Example) -> torch.LongTensor:
+        """
+        :return: sorted output indices of the shortlist of ex
+        """
+        return torch.LongTensor(sorted(self.structural | self.retrieve(ex)))
+
+    def restrict(self, ex: Example, W: nn.Linear):
+        """
+        Gathers the rows of the output projection W for the shortlist of ex, once per query
+        :return: the shortlist output indices and the (weight, bias) to score them with; logits computed with these
+        have index k for output symbol ids[k]
+        """
+        ids = self.candidates(ex)
+        return ids, (W.weight[ids], W.bias[ids])
+
+    def restrict_batch(self, exs: List[Example], W: nn.Linear):
+        """
+        Like restrict for a batch: one gather for the union of the shortlists of exs
+        :return: the union's output indices, (weight, bias) for them and a [batch size x union size] mask of which are
+        in each example's own shortlist
+        """
+        shortlists = [self.structural | self.retrieve(ex) for ex in exs]
+        ids = torch.LongTensor(sorted(set.union(*shortlists)))
+        members = torch.BoolTensor([[i in shortlist for i in ids.tolist()] for shortlist in shortlists])
+        return ids, (W.weight[ids], W.bias[ids]), members
+
+    def coverage(self, exs: List[Example]) -> float:
+        """
+        :return: fraction of exs whose gold output is entirely within their shortlist
+        """
+        covered = 0
+        for ex in exs:
+            shortlist = self.structural | self.retrieve(ex)
+            covered += all(i in shortlist for i in ex.y_indexed)
+        return covered / max(len(exs), 1)
@@ -0,0 +1,144 @@
+# sweep.py
+# Parallel hyperparameter sweep: the data is loaded, indexed and padded once, the padded tensors are placed in shared
+# memory, and every configuration of the grid is trained (and evaluated on dev) by a pool of worker processes.
+#   python sweep.py --workers 4 --batch_sizes 2 3 4 --lrs 1e-3 5e-4 --epochs_list 20 25 30
+
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from data import *
+from lf_evaluator import *
+from models import *
+
+# Data handed to each worker once by _init_worker, rather than pickled with every run
+_WORKER_STATE = {}
+
+
+def _parse_args():
+    """
+    Command-line arguments of the sweep. The grid flags take several values each and every combination is trained;
+    all other model flags (add_models_args) are shared by all runs.
+    :return: the parsed args bundle
+    """
+    parser = argparse.ArgumentParser(description='sweep.py')
+    parser.add_argument('--train_path', type=str, default='data/geo_train.tsv', help='path to train data')
+    parser.add_argument('--dev_path', type=str, default='data/geo_dev.tsv', help='path to dev data')
+    parser.add_argument('--domain', type=str, default='geo', help='domain (geo for geoquery)')
+    parser.add_argument('--no_java_eval', dest='perform_java_eval', default=True, action='store_false', help='run evaluation of constructed query against java backend')
+    parser.add_argument('--workers', type=int, default=max(1, os.cpu_count() // 2), help='number of runs trained at once')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='torch threads of each worker (default: cores / workers)')
+    parser.add_argument('--out', type=str, default='sweep_results.json', help='path to write the results table to (JSON)')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=None, help='values of --batch_size to sweep')
+    parser.add_argument('--emb_dims', type=int, nargs='+', default=None, help='values of --emb_dim to sweep')
+    parser.add_argument('--hidden_sizes', type=int, nargs='+', default=None, help='values of --hidden_size to sweep')
+    parser.add_argument('--lrs', type=float, nargs='+', default=None, help='values of --lr to sweep')
+    parser.add_argument('--epochs_list', type=int, nargs='+', default=None, help='values of --epochs to sweep')
+    add_models_args(parser) # defined in models.py
+    args = parser.parse_args()
+    args.print_dataset = False
+    return args
+
+
+# Sweep flag -> the model flag it sets
+SWEEP_FLAGS = [('batch_sizes', 'batch_size'), ('emb_dims', 'emb_dim'), ('hidden_sizes', 'hidden_size'),
+               ('lrs', 'lr'), ('epochs_list', 'epochs')]
+
+
+def sweep_configs(args) -> List[dict]:
+    """
+    :return: one dict of model flag overrides per point of the grid; unswept flags keep the value in args
+    """
+    grid = [[(flag, value) for value in getattr(args, sweep_flag)] if getattr(args, sweep_flag) is not None
+            else [(flag, getattr(args, flag))] for sweep_flag, flag in SWEEP_FLAGS]
+    return [dict(point) for point in itertools.product(*grid)]
+
+
+def config_name(config: dict) -> str:
+    # Same batch:emb:hidden:lr:epochs notation as the sweep notes in train_model_encdec
+    return "%i:%i:%i:%g:%i" % (config['batch_size'], config['emb_dim'], config['hidden_size'], config['lr'],
+                               config['epochs'])
+
+
+def _init_worker(dataset_tensors, dev_data, input_indexer, output_indexer, args, num_threads):
+    torch.set_num_threads(num_threads)
+    _WORKER_STATE.update(dataset=TensorDataset(*dataset_tensors), dev_data=dev_data, input_indexer=input_indexer,
+                         output_indexer=output_indexer, args=args)
+
+
+def _run_config(config: dict):
+    """
+    Trains and evaluates one configuration in a worker
+    :return: a row of the results table
+    """
+    state = _WORKER_STATE
+    run_args = argparse.Namespace(**vars(state['args']))
+    run_args.__dict__.update(config)
+    if run_args.checkpoint_dir is not None:
+        run_args.checkpoint_dir = os.path.join(run_args.checkpoint_dir, config_name(config).replace(':', '_'))
+    random.seed(run_args.seed)
+    np.random.seed(run_args.seed)
+    torch.manual_seed(run_args.seed)
+    dataset = state['dataset']
+    start = time.time()
+    model = train_model_encdec(None, state['dev_data'], state['input_indexer'], state['output_indexer'], run_args,
+                               dataset=dataset)
+    train_sec = time.time() - start
+    exact, token_acc, denotation = evaluate(state['dev_data'], model, print_output=False,
+                                            use_java=run_args.perform_java_eval)
+    return dict(config, name=config_name(config), exact=exact, token=token_acc,
+                denotation=denotation if run_args.perform_java_eval else None, train_sec=train_sec,
+                total_sec=time.time() - start, examples_per_sec=run_args.epochs * len(dataset) / train_sec)
+
+
+def run_sweep(args) -> List[dict]:
+    """
+    Builds the padded training tensors once, moves them to shared memory and trains every configuration of the grid
+    on a process pool of args.workers workers with args.threads_per_worker torch threads each
+    :return: the results table, one row per configuration in grid order
+    """
+    train = load_dataset(args.train_path, domain=args.domain)
+    dev = load_dataset(args.dev_path, domain=args.domain)
+    train_data_indexed, dev_data_indexed, _, input_indexer, output_indexer = index_datasets(train, dev, [], args.decoder_len_limit)
+    dataset = make_training_dataset(train_data_indexed, input_indexer, output_indexer)
+    for tensor in dataset.tensors:
+        tensor.share_memory_()
+    configs = sweep_configs(args)
+    num_threads = args.threads_per_worker or max(1, os.cpu_count() // args.workers)
+    print("Sweeping %i configurations on %i workers with %i threads each" % (len(configs), args.workers, num_threads))
+    # spawn rather than fork: forking a process that has already run torch ops can deadlock in the children. The
+    # shared tensors are passed to the workers by handle, not copied.
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=mp.get_context('spawn'), initializer=_init_worker,
+                             initargs=(dataset.tensors, dev_data_indexed, input_indexer, output_indexer, args,
+                                       num_threads)) as pool:
+        results = list(pool.map(_run_config, configs))
+    return results
+
+
+def print_results(results: List[dict]):
+    """
+    Prints the results table, best dev exact match first
+    """
+    print("%-22s %8s %8s %11s %10s %10s" % ("batch:emb:hidden:lr:ep", "exact", "token", "denotation", "train_sec", "exs/sec"))
+    for row in sorted(results, key=lambda row: -row['exact']):
+        denotation = "%11.3f" % row['denotation'] if row['denotation'] is not None else "%11s" % "-"
+        print("%-22s %8.3f %8.3f %s %10.1f %10.1f" % (row['name'], row['exact'], row['token'], denotation,
+                                                      row['train_sec'], row['examples_per_sec']))
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    print(args)
+    start = time.time()
+    results = run_sweep(args)
+    print_results(results)
+    print("Sweep took %.1f sec" % (time.time() - start))
+    with open(args.out, "w") as out:
+        json.dump(results, out, indent=2)
+    print("Wrote sweep results to %s" % args.out)
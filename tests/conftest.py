@@ -0,0 +1,39 @@
+# tests/conftest.py
+# Shared fixtures: the indexed GeoQuery data and a small LSTM parser trained briefly on it with a fixed seed, so its
+# greedy outputs look like logical forms (most end in EOS well before MAX_DECODE_LEN) and are reproducible.
+
+import pytest
+import torch
+from data import load_datasets, index_datasets
+
+
+@pytest.fixture(scope='session')
+def geo_data():
+    """
+    :return: indexed train, dev and test examples and the input and output indexers
+    """
+    train, dev, test = load_datasets('data/geo_train.tsv', 'data/geo_dev.tsv', 'data/geo_test.tsv', domain='geo')
+    return index_datasets(train, dev, test, 65)
+
+
+@pytest.fixture(scope='session')
+def tiny_parser(geo_data):
+    """
+    :return: Seq2SeqSemanticParser with 16-dimensional embeddings and 32 hidden units after two epochs over 100
+    training examples
+    """
+    from models import Seq2SeqSemanticParser
+    train_data, dev_data, test_data, input_indexer, output_indexer = geo_data
+    torch.manual_seed(0)
+    model = Seq2SeqSemanticParser(input_indexer, output_indexer, 16, 32)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    model.train()
+    for epoch in range(2):
+        for ex in train_data[:100]:
+            optimizer.zero_grad()
+            loss = model(torch.LongTensor([ex.x_indexed]), torch.LongTensor([len(ex.x_indexed)]),
+                         torch.LongTensor([ex.y_indexed]), torch.LongTensor([len(ex.y_indexed)]), 1)
+            loss.backward()
+            optimizer.step()
+    model.eval()
+    return model
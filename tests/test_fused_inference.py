@@ -0,0 +1,56 @@
+# tests/test_fused_inference.py
+# FusedGateTables (--fused_inference) against the unfused embedding + nn.LSTM modules it replaces.
+
+import copy
+import torch
+from benchmarks.common import check_fused_inference
+from models import FusedGateTables
+
+
+def test_gate_tables_match_embedding_and_input_projection(tiny_parser):
+    tables = FusedGateTables(tiny_parser)
+    for emb, rnn, gates in [(tiny_parser.input_emb, tiny_parser.encoder.rnn, tables.enc_gates),
+                            (tiny_parser.output_emb, tiny_parser.decoder.rnn, tables.dec_gates)]:
+        with torch.no_grad():
+            tokens = torch.arange(gates.shape[0]).unsqueeze(0)
+            expected = emb(tokens)[0] @ rnn.weight_ih_l0.t() + rnn.bias_ih_l0 + rnn.bias_hh_l0
+        assert torch.allclose(gates, expected, atol=1e-5)
+
+
+def test_encoder_and_decoder_steps_match(tiny_parser, geo_data):
+    # Encoder outputs and states, and decoder logits and states along each gold output
+    assert check_fused_inference(tiny_parser, geo_data[1][:10], atol=1e-5) <= 1e-5
+
+
+def test_greedy_outputs_match(tiny_parser, geo_data):
+    dev_data = geo_data[1][:20]
+    model = copy.deepcopy(tiny_parser)
+    model.fused_inference = False
+    unfused = model.decode(dev_data)
+    model.fused_inference = True
+    fused = model.decode(dev_data)
+    for u, f in zip(unfused, fused):
+        assert f[0].y_toks == u[0].y_toks
+        assert abs(f[0].p - u[0].p) <= 1e-5 * max(u[0].p, 1e-30)
+
+
+def test_tables_go_stale_after_a_parameter_update(tiny_parser, geo_data):
+    train_data, dev_data = geo_data[0], geo_data[1]
+    model = copy.deepcopy(tiny_parser)
+    model.fused_inference = True
+    tables = model._gate_tables()
+    assert not tables.is_stale(model)
+    assert model._gate_tables() is tables
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    ex = train_data[0]
+    loss = model(torch.LongTensor([ex.x_indexed]), torch.LongTensor([len(ex.x_indexed)]),
+                 torch.LongTensor([ex.y_indexed]), torch.LongTensor([len(ex.y_indexed)]), 1)
+    loss.backward()
+    optimizer.step()
+    model.eval()
+    assert tables.is_stale(model)
+    # Decoding rebuilds the tables from the updated weights
+    fused = model.decode(dev_data[:5])
+    assert model.gate_tables is not tables and not model.gate_tables.is_stale(model)
+    model.fused_inference = False
+    assert [d[0].y_toks for d in fused] == [d[0].y_toks for d in model.decode(dev_data[:5])]
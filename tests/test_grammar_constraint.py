@@ -0,0 +1,58 @@
+# tests/test_grammar_constraint.py
+# Run from the repository root (python -m pytest tests) so data/ and the top-level modules resolve.
+
+import torch
+from data import load_datasets, index_datasets, EOS_SYMBOL
+from models import LFGrammarConstraint
+
+
+def _constraint():
+    train, dev, test = load_datasets('data/geo_train.tsv', 'data/geo_dev.tsv', 'data/geo_test.tsv', domain='geo')
+    train_data, dev_data, test_data, input_indexer, output_indexer = index_datasets(train, dev, test, 65)
+    return LFGrammarConstraint(output_indexer), output_indexer, train_data
+
+
+def _accepts(constraint, output_indexer, y_tok):
+    """
+    :return: True if y_tok followed by EOS is allowed token by token from the start state
+    """
+    state = constraint.start_state
+    for tok in y_tok + [EOS_SYMBOL]:
+        idx = output_indexer.index_of(tok)
+        if idx < 0 or not constraint.masks[state, idx]:
+            return False
+        state = constraint.transitions[state, idx].item()
+    return True
+
+
+def test_accepts_gold_logical_forms():
+    constraint, output_indexer, data = _constraint()
+    for ex in data:
+        assert _accepts(constraint, output_indexer, ex.y_tok), " ".join(ex.y_tok)
+
+
+def test_rejects_leading_junk():
+    constraint, output_indexer, data = _constraint()
+    gold = data[0].y_tok
+    for junk in [[','], ['('], [')'], ['_state'], ['_answer'], ['NV'], ["'"]]:
+        assert not _accepts(constraint, output_indexer, junk + gold), junk
+    assert not _accepts(constraint, output_indexer, [',', '(', ')'])
+    allowed = torch.nonzero(constraint.masks[constraint.start_state]).flatten().tolist()
+    assert [output_indexer.get_object(i) for i in allowed] == ['_answer']
+
+
+def test_length_budget_forces_well_formed_output():
+    constraint, output_indexer, data = _constraint()
+    vocab_size = len(output_indexer)
+    for budget in range(3, 8):
+        state = constraint.initial_states(1)
+        y_tok = []
+        for steps_left in range(budget, 0, -1):
+            # Uniform scores: the first allowed token wins, so nothing but the mask steers the output
+            logits = constraint.apply(torch.zeros(1, vocab_size), state, steps_left)
+            token = torch.argmax(logits, dim=1)
+            if token.item() == output_indexer.index_of(EOS_SYMBOL):
+                break
+            y_tok.append(output_indexer.get_object(token.item()))
+            state = constraint.advance(state, token)
+        assert _accepts(constraint, output_indexer, y_tok), (budget, y_tok)
@@ -0,0 +1,91 @@
+# tests/test_speculative_decoding.py
+# Speculative decoding (--speculative_decoding) must produce exactly the outputs of plain greedy decoding, whatever the
+# draft.
+
+import copy
+from data import EOS_SYMBOL
+from models import LFGrammarConstraint, MAX_DECODE_LEN
+from nearest_neighbor import NearestNeighborSemanticParser
+
+
+class FixedDrafts(object):
+    """
+    Stands in for NearestNeighborSemanticParser as a draft_parser: retrieves a fixed draft for each example
+    """
+    def __init__(self, drafts):
+        self.drafts = drafts
+
+    def retrieve(self, ex):
+        return FixedDraft(self.drafts[id(ex)])
+
+
+class FixedDraft(object):
+    def __init__(self, y_indexed):
+        self.y_indexed = y_indexed
+
+
+def _decode_with_draft(model, dev_data, draft_parser):
+    model.draft_parser = draft_parser
+    model.decode_stats.clear()
+    return model.decode(dev_data)
+
+
+def _assert_same_outputs(speculative, greedy):
+    for s, g in zip(speculative, greedy):
+        assert s[0].y_toks == g[0].y_toks
+        assert abs(s[0].p - g[0].p) <= 1e-5 * max(g[0].p, 1e-30)
+
+
+def _greedy(model, dev_data):
+    model.draft_parser = None
+    return model.decode(dev_data), [model.greedy_decode(ex)[0] for ex in dev_data]
+
+
+def test_fully_accepted_draft(tiny_parser, geo_data):
+    dev_data = geo_data[1][:10]
+    model = copy.deepcopy(tiny_parser)
+    greedy, greedy_ids = _greedy(model, dev_data)
+    end_token = model.output_indexer.index_of(EOS_SYMBOL)
+    for i, (ex, ids) in enumerate(zip(dev_data, greedy_ids)):
+        draft = ids + [end_token]
+        speculative = _decode_with_draft(model, [ex], FixedDrafts({id(ex): draft}))
+        _assert_same_outputs(speculative, greedy[i:i + 1])
+        if len(ids) < MAX_DECODE_LEN:
+            # The whole output, EOS included, comes out of the single verification pass
+            assert model.decode_stats['accepted'] == len(draft)
+            assert model.decode_stats['decoder_calls'] == 1
+
+
+def test_draft_diverging_at_the_first_step(tiny_parser, geo_data):
+    dev_data = geo_data[1][:10]
+    model = copy.deepcopy(tiny_parser)
+    greedy, greedy_ids = _greedy(model, dev_data)
+    end_token = model.output_indexer.index_of(EOS_SYMBOL)
+    drafts = {}
+    for ex, ids in zip(dev_data, greedy_ids):
+        # A gold-looking draft whose first token is not the model's
+        first = ids[0] if len(ids) > 0 else end_token
+        wrong = next(i for i in range(3, len(model.output_indexer)) if i != first)
+        drafts[id(ex)] = [wrong] + ex.y_indexed[1:]
+    speculative = _decode_with_draft(model, dev_data, FixedDrafts(drafts))
+    _assert_same_outputs(speculative, greedy)
+    assert model.decode_stats['accepted'] == 0
+    assert model.decode_stats['examples'] == len(dev_data)
+
+
+def test_nearest_neighbor_drafts(tiny_parser, geo_data):
+    train_data, dev_data = geo_data[0], geo_data[1][:20]
+    model = copy.deepcopy(tiny_parser)
+    greedy, _ = _greedy(model, dev_data)
+    speculative = _decode_with_draft(model, dev_data, NearestNeighborSemanticParser(train_data))
+    _assert_same_outputs(speculative, greedy)
+    assert model.decode_stats['draft'] > 0
+
+
+def test_nearest_neighbor_drafts_with_grammar_constraint(tiny_parser, geo_data):
+    train_data, dev_data = geo_data[0], geo_data[1][:20]
+    model = copy.deepcopy(tiny_parser)
+    model.grammar_constraint = LFGrammarConstraint(model.output_indexer)
+    greedy, _ = _greedy(model, dev_data)
+    speculative = _decode_with_draft(model, dev_data, NearestNeighborSemanticParser(train_data))
+    _assert_same_outputs(speculative, greedy)
@@ -0,0 +1,100 @@
+# tests/test_staged_evaluation.py
+# Staged execution of k-best lists (--staged_java_eval) against executing every derivation and picking with
+# pick_derivations, using a stand-in for the Java evaluator that looks up canned denotations.
+
+import json
+import os
+import sys
+import pytest
+from data import Derivation
+from lf_evaluator import GeoqueryDomain
+
+# Denotation of each logical form, in the evaluator's syntax; anything else fails to execute
+DENOTATIONS = {
+    'texas': '{texas}',
+    'ohio': '{ohio}',
+    'austin': '{austin}',
+    'joined': 'Join failed syntactically',
+}
+
+STUB_EVALUATOR = '''#!%s
+import json, os, sys
+denotations = json.load(open(os.environ['STUB_DENOTATIONS']))
+path = sys.argv[sys.argv.index('+generalPaths') + 1]
+with open(path) as f:
+    for line in f:
+        lf = line.strip()[len('_parse([query], '):-len(').')]
+        den = denotations.get(lf, 'FAILED TO EXECUTE')
+        print('        Example %%s' %% den, flush=True)
+'''
+
+# Exits without printing any result line, as the evaluator does when its Java setup is broken
+SILENT_EVALUATOR = '''#!%s
+'''
+
+
+def _install_evaluator(tmp_path, monkeypatch, source):
+    java = tmp_path / 'java'
+    java.write_text(source % sys.executable)
+    java.chmod(0o755)
+    denotations = tmp_path / 'denotations.json'
+    denotations.write_text(json.dumps(DENOTATIONS))
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('STUB_DENOTATIONS', str(denotations))
+
+
+def _k_best(*lfs):
+    return [Derivation(None, 0.5 ** rank, lf.split()) for rank, lf in enumerate(lfs)]
+
+
+# Gold logical forms and k-best lists of: rank 1 correct; rank 1 and 2 failing; every rank failing (the rank-1
+# derivation is kept); an empty list; a single failing derivation; rank 1 executing to a wrong answer
+TRUE_ANSWERS = ['_texas', '_austin', '_ohio', '_texas', '_ohio', '_ohio']
+ALL_DERIVS = [
+    _k_best('_texas', '_bogus', '_ohio'),
+    _k_best('_bogus', '_joined', '_austin', '_texas'),
+    _k_best('_bogus', '_joined', '_nonsense'),
+    [],
+    _k_best('_joined'),
+    _k_best('_texas', '_ohio'),
+]
+
+
+def _results(domain, capsys):
+    """
+    :return: selected derivations (as token lists and probabilities), correctness and the printed gold == predicted
+    denotation lines of domain.compare_answers on the examples above
+    """
+    capsys.readouterr()
+    derivs, correct = domain.compare_answers(TRUE_ANSWERS, ALL_DERIVS, quiet=False)
+    printed = [line for line in capsys.readouterr().out.split('\n') if ' == ' in line]
+    return [(d.y_toks, d.p) for d in derivs], correct, printed
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_staged_matches_eager(tmp_path, monkeypatch, capsys, streaming):
+    _install_evaluator(tmp_path, monkeypatch, STUB_EVALUATOR)
+    eager = _results(GeoqueryDomain(streaming=streaming), capsys)
+    staged_domain = GeoqueryDomain(streaming=streaming, staged=True)
+    staged = _results(staged_domain, capsys)
+    assert staged == eager
+    derivs, correct, printed = staged
+    assert derivs == [(['_texas'], 1.0), (['_austin'], 0.25), (['_bogus'], 1.0), ([''], 0.0), (['_joined'], 1.0),
+                      (['_texas'], 1.0)]
+    assert correct == [True, True, False, False, False, False]
+    assert printed[1] == 'True: {austin} == {austin}'
+    assert printed[3] == 'False: {texas} == Example FAILED TO PARSE'
+    # Ranks 1 to 3 of the second and third examples are executed, in three calls
+    assert staged_domain.exec_stats == {'calls': 3, 'executed': 9, 'derivations': 13}
+    # Statistics accumulate over calls
+    staged_domain.compare_answers(TRUE_ANSWERS, ALL_DERIVS, quiet=True)
+    assert staged_domain.exec_stats == {'calls': 6, 'executed': 18, 'derivations': 26}
+
+
+def test_staged_matches_eager_without_evaluator_output(tmp_path, monkeypatch, capsys):
+    _install_evaluator(tmp_path, monkeypatch, SILENT_EVALUATOR)
+    eager = _results(GeoqueryDomain(), capsys)
+    staged_domain = GeoqueryDomain(staged=True)
+    assert _results(staged_domain, capsys) == eager
+    assert eager[0] == [([''], 0.0)] * len(ALL_DERIVS)
+    assert staged_domain.exec_stats == {'calls': 1, 'executed': 5, 'derivations': 13}